@@ -4,13 +4,36 @@ from argparse import Namespace
 from collections import Counter
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, TextIO
+from queue import Queue, Full
+from threading import Event, Thread
+from typing import Iterator, Optional, TextIO
 
+from config import METADATA_CACHE_FILE, LIBRARY_INDEX_FILE, DISCOVERY_QUEUE_SIZE, PREDICTION_HISTORY_FILE, \
+    JOURNAL_FILE, OUTCOME_CACHE_FILE, STOP_FILE, TUNING_CACHE_FILE, DEDUP_INDEX_FILE
+from dedup import DedupIndex
+from encoders import EncoderSelector
 from filechecker import check_file_ext
+from fileparser import FileMetadata, probe_file
+from job import Job
+from journal import Journal
+from lease import LeaseManager
+from library_index import LibraryIndex
+from metrics import FILES_SCANNED, QUEUE_DEPTH
+from predictor import SizePredictor
+from priority import QueueOrder
+from metadata_cache import MetadataCache
+from outcome_cache import OutcomeCache
+from staging import Staging
+from tuner import Tuner
+from watcher import Watcher
 
 logger = logging.getLogger('reencode_job.app')
 
 
+class DiscoveryCancelled(Exception):
+    """Raised in the discovery thread once jobs are no longer consumed"""
+
+
 @dataclass
 class Args:
     """App arguments parsed by argparse"""
@@ -36,6 +59,38 @@ class Args:
     """Represented by the optional --force-reencode parameter"""
     is_watch_enabled: bool
     """Represented by the optional -w/--watch parameter"""
+    is_cache_enabled: bool
+    """Represented by the optional --no-cache parameter"""
+    is_index_enabled: bool
+    """Represented by the optional --no-index parameter"""
+    is_journal_enabled: bool
+    """Represented by the optional --no-journal parameter"""
+    is_outcome_cache_enabled: bool
+    """Represented by the optional --retry-all parameter"""
+    prefetch_depth: int
+    """Represented by the optional --lookahead parameter"""
+    max_jobs: int
+    """Represented by the optional -j/--jobs parameter"""
+    queue_order: QueueOrder
+    """Represented by the optional --order parameter"""
+    queue_window: int
+    """Represented by the optional --order-window parameter"""
+    prediction_action: str
+    """Represented by the optional --prediction parameter"""
+    metrics_port: int
+    """Represented by the optional --metrics-port parameter"""
+    is_split_enabled: bool
+    """Represented by the optional --split parameter"""
+    lease_dir: Optional[Path]
+    """Represented by the optional --shared parameter"""
+    control_port: int
+    """Represented by the optional --control-port parameter"""
+    staging_dir: Optional[Path]
+    """Represented by the optional --staging parameter"""
+    is_tuning_enabled: bool
+    """Represented by the optional --tune parameter"""
+    is_dedup_enabled: bool
+    """Represented by the optional --dedup parameter"""
 
 
 class App:
@@ -43,9 +98,23 @@ class App:
     args: Args
 
     is_interrupted: bool
+    is_draining: bool
     glob_filter: Optional[str]
     files: list[Path]
     outs: list[Path]
+    metadata_cache: Optional[MetadataCache]
+    watcher: Optional[Watcher]
+    library_index: Optional[LibraryIndex]
+    predictor: Optional[SizePredictor]
+    journal: Optional[Journal]
+    outcome_cache: Optional[OutcomeCache]
+    encoders: EncoderSelector
+    leases: Optional[LeaseManager]
+    staging: Optional[Staging]
+    tuner: Optional[Tuner]
+    dedup: Optional[DedupIndex]
+    is_first_scan: bool
+    is_discovery_done: bool
 
     def __init__(self, args: Namespace):
         logger.info('Starting new job with params: %s', args)
@@ -60,17 +129,83 @@ class App:
                          args.filelist,
                          args.verbose,
                          args.force_reencode,
-                         args.watch)
+                         args.watch,
+                         not args.no_cache,
+                         not args.no_index,
+                         not args.no_journal,
+                         not args.retry_all,
+                         args.lookahead,
+                         args.jobs,
+                         QueueOrder(args.order),
+                         args.order_window,
+                         args.prediction,
+                         args.metrics_port,
+                         args.split,
+                         args.shared,
+                         args.control_port,
+                         args.staging,
+                         args.tune,
+                         args.dedup)
 
         self.glob_filter = args.filter
         self.is_interrupted = False
+        self.is_draining = False
         self.files = []
         self.outs = []
+        self.metadata_cache = MetadataCache(METADATA_CACHE_FILE) if self.args.is_cache_enabled else None
+        self.watcher = Watcher(self.args.content_path) if self.args.is_watch_enabled else None
+        self.library_index = LibraryIndex(LIBRARY_INDEX_FILE) if self.args.is_index_enabled else None
+        self.predictor = SizePredictor(PREDICTION_HISTORY_FILE) if self.args.prediction_action != 'off' else None
+        self.journal = Journal(JOURNAL_FILE) if self.args.is_journal_enabled else None
+        self.outcome_cache = OutcomeCache(OUTCOME_CACHE_FILE) if self.args.is_outcome_cache_enabled else None
+        self.encoders = EncoderSelector()
+        self.leases = LeaseManager(self.__resolve_lease_dir(), library_root=self.__library_root()) \
+            if self.args.lease_dir else None
+        self.staging = Staging(self.args.staging_dir) if self.args.staging_dir else None
+        self.tuner = Tuner(TUNING_CACHE_FILE) if self.args.is_tuning_enabled else None
+        self.dedup = DedupIndex(DEDUP_INDEX_FILE) if self.args.is_dedup_enabled else None
+        self.is_first_scan = True
+        self.is_discovery_done = False
+        self._discovery_queue = None
+        self._discovery_cancelled = Event()
+        QUEUE_DEPTH.labels('discovery').set_function(
+            lambda: self._discovery_queue.qsize() if self._discovery_queue else 0)
+
+        if self.journal is not None:
+            self.journal.recover()
+            self.journal.start(self.args.content_path)
+        if self.leases is not None:
+            self.leases.start()
+        if self.staging is not None:
+            self.staging.start()
+
+    def __library_root(self) -> Path:
+        content_path = self.args.content_path
+        return content_path if content_path.is_dir() else content_path.parent
+
+    def __resolve_lease_dir(self) -> Path:
+        """Relative lease directories are stored in the library shared by the nodes"""
+        return self.__library_root() / self.args.lease_dir
 
     def signal_handler(self, signum, _):
         self.is_interrupted = True
         logger.warning('Interrupted by signal %d', signum)
 
+    @property
+    def is_stop_requested(self) -> bool:
+        """Whether running jobs should be left to finish without starting new ones"""
+        return self.is_draining or STOP_FILE.exists()
+
+    def output_for(self, filename: Path) -> Path:
+        if self.args.output_path and filename.is_relative_to(self.args.content_path):
+            return self.args.output_path / filename.relative_to(self.args.content_path)
+        return Path(filename.parent, f"{filename.stem}_reencoded.mp4")
+
+    def probe(self, file_path: Path) -> Optional[FileMetadata]:
+        if self.metadata_cache is not None:
+            return self.metadata_cache.probe(file_path)
+        return probe_file(file_path)
+
     @staticmethod
     def _log_ext_summary(ext_summary: Counter):
         if ext_summary:
@@ -84,12 +219,11 @@ class App:
             logger.error('Extension "%s" not in whitelist', ext)
             sys.exit(3)
 
-        self.files.append(self.args.content_path)
         if self.args.output_path:
-            self.outs.append(self.args.output_path)
+            self._add_job(self.args.content_path, self.args.output_path)
         else:
-            self.outs.append(Path(self.args.content_path.parent,
-                                  f"{self.args.content_path.stem}_reencoded.mp4"))
+            self._add_job(self.args.content_path,
+                          Path(self.args.content_path.parent, f"{self.args.content_path.stem}_reencoded.mp4"))
 
     def _scan_filelist(self):
         ext_summary = Counter()
@@ -110,30 +244,23 @@ class App:
 
             is_valid, ext = check_file_ext(file_path)
             if is_valid:
-                self.files.append(file_path)
-                self.outs.append(Path(file_path.parent,
-                                      f"{file_path.stem}_reencoded.mp4"))
+                self._add_job(file_path, Path(file_path.parent, f"{file_path.stem}_reencoded.mp4"))
             else:
                 ext_summary.update((ext,))
 
     def __scan_filelist_inout(self, filelist: TextIO, ext_summary: Counter):
-        for i, line in enumerate(filelist):
-            file_path = Path(line.strip())
+        # Lines alternate between input and output files
+        for input_line, output_line in zip(filelist, filelist):
+            file_path = Path(input_line.strip())
+            if not file_path.exists():
+                logger.warning('File "%s" does not exist', file_path)
+                continue
 
-            if i % 2 == 0:
-                # Read input file
-                if not file_path.exists():
-                    logger.warning('File "%s" does not exist', file_path)
-                    continue
-
-                is_valid, ext = check_file_ext(file_path)
-                if is_valid:
-                    self.files.append(file_path)
-                else:
-                    ext_summary.update((ext,))
+            is_valid, ext = check_file_ext(file_path)
+            if is_valid:
+                self._add_job(file_path, Path(output_line.strip()))
             else:
-                # Read output file
-                self.outs.append(file_path)
+                ext_summary.update((ext,))
 
     def _scan_directory(self):
         if self.glob_filter:
@@ -152,7 +279,27 @@ class App:
         logger.debug('Scanned %d files', files_count)
         self._log_ext_summary(ext_summary)
 
+    def __scan_index(self):
+        def on_file(filename: Path, is_changed: bool):
+            # Files left unchanged since the previous scan of this run have already been processed
+            if is_changed or self.is_first_scan:
+                self._process_file(filename)
+
+        diff = self.library_index.rescan(self.args.content_path, on_file)
+        logger.debug('Scanned %s directories (%s unchanged): %d added, %d modified, %d removed',
+                     diff.scanned_directories + diff.skipped_directories, diff.skipped_directories,
+                     len(diff.added), len(diff.modified), len(diff.removed))
+
+        if self.metadata_cache is not None:
+            for filename in diff.removed:
+                self.metadata_cache.invalidate(filename)
+        self._log_ext_summary(diff.ext_summary)
+
     def __scan_walk(self):
+        if self.library_index is not None:
+            self.__scan_index()
+            return
+
         directories_count: int = 0
         files_count: int = 0
         ext_summary = Counter()
@@ -173,17 +320,36 @@ class App:
         if not is_valid:
             return False
 
-        self.files.append(filename)
-        if self.args.output_path:
-            self.outs.append(
-                self.args.output_path /
-                filename.relative_to(self.args.content_path)
-            )
-        else:
-            self.outs.append(Path(filename.parent,
-                                  f"{filename.stem}_reencoded.mp4"))
+        if self.watcher is not None and not self.watcher.is_settled(filename):
+            # File is probably still being written, wait for it to settle before processing it
+            logger.debug('"%s" was modified recently, postponing', filename)
+            self.watcher.track(filename)
+            return True
+
+        self._add_job(filename, self.output_for(filename))
         return True
 
+    def _add_job(self, input_filename: Path, output_filename: Path):
+        if self.journal is not None and not self.journal.queue(input_filename, output_filename):
+            logger.debug('"%s" was already processed before the restart', input_filename)
+            return
+
+        self.files.append(input_filename)
+        self.outs.append(output_filename)
+        FILES_SCANNED.inc()
+
+        if self._discovery_queue is None:
+            return
+
+        job = Job(len(self.files), input_filename, output_filename)
+        while not self._discovery_cancelled.is_set():
+            try:
+                self._discovery_queue.put(job, timeout=1)
+                return
+            except Full:
+                continue
+        raise DiscoveryCancelled()
+
     def init_job(self):
         # Check if dry run flag is set
         if self.args.is_dry_run_enabled:
@@ -198,3 +364,75 @@ class App:
             self._scan_file()
         else:
             self._scan_directory()
+        self.is_first_scan = False
+
+    def init_job_from(self, paths: list[Path]):
+        """Initialize the job with the given files from the content path only"""
+        self.files.clear()
+        self.outs.clear()
+
+        for filename in paths:
+            relative_path = filename.relative_to(self.args.content_path)
+            if self.glob_filter and not relative_path.match(self.glob_filter):
+                continue
+            self._process_file(filename)
+        logger.debug('%d changed files to process', len(self.files))
+
+    def init_job_from_journal(self):
+        """Initialize the job with the files left unfinished by an interrupted pass"""
+        self.files.clear()
+        self.outs.clear()
+
+        for input_filename, output_filename in self.journal.pending():
+            if input_filename.exists():
+                self._add_job(input_filename, output_filename)
+            else:
+                logger.warning('File "%s" does not exist', input_filename)
+        self.is_first_scan = False
+        logger.debug('%d files left to process from the journal', len(self.files))
+
+    def discover(self, paths: Optional[list[Path]] = None) -> Iterator[Job]:
+        """Initialize the job in a background thread, yielding jobs as soon as they are found
+
+        Discovery is bounded by DISCOVERY_QUEUE_SIZE, see init_job_from for paths.
+        """
+        self._discovery_queue = Queue(maxsize=DISCOVERY_QUEUE_SIZE)
+        self._discovery_cancelled.clear()
+        self.is_discovery_done = False
+
+        thread = Thread(target=self.__discovery_thread, args=(paths,), name='discovery', daemon=True)
+        thread.start()
+        try:
+            while (item := self._discovery_queue.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self._discovery_cancelled.set()
+            thread.join()
+            self._discovery_queue = None
+
+    def __discovery_thread(self, paths: Optional[list[Path]]):
+        result: Optional[BaseException] = None
+        try:
+            if paths is not None:
+                self.init_job_from(paths)
+            elif self.is_first_scan and self.journal is not None and self.journal.is_discovery_done:
+                self.init_job_from_journal()
+            else:
+                self.init_job()
+            if self.journal is not None:
+                self.journal.mark_discovery_done()
+        except DiscoveryCancelled:
+            logger.debug('Discovery cancelled')
+        except BaseException as e:
+            result = e
+        finally:
+            self.is_discovery_done = True
+
+        while not self._discovery_cancelled.is_set():
+            try:
+                self._discovery_queue.put(result, timeout=1)
+                return
+            except Full:
+                continue
@@ -0,0 +1,83 @@
+from argparse import Namespace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import App
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+
+
+def make_args(path: Path, **kwargs):
+    args = dict(path=path, output=None, dry_run=False, remove=False, replace=False, overwrite=False,
+                clean_on_error=False, filelist=False, verbose=False, force_reencode=False, watch=False,
+                no_cache=True, no_index=True, no_journal=True, retry_all=True, lookahead=0, jobs=1, order='scan', order_window=0,
+                prediction='off', metrics_port=0, split=False, shared=None, control_port=0, staging=None, tune=False, dedup=False, filter=None)
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+class AppTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.videos = []
+        for i in range(5):
+            video = self.root / f'video_{i}.mp4'
+            video.write_bytes(b'\0')
+            self.videos.append(video)
+        (self.root / 'notes.txt').write_text('notes')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_discover_yields_jobs(self):
+        app = App(make_args(self.root, filter='*'))
+        jobs = list(app.discover())
+        self.assertCountEqual([job.input_filename for job in jobs], self.videos)
+        self.assertEqual([job.index for job in jobs], list(range(1, 6)))
+        self.assertTrue(app.is_discovery_done)
+        self.assertEqual(len(app.files), 5)
+
+    def test_discover_with_index(self):
+        with patch('app.LIBRARY_INDEX_FILE', self.root / 'cache' / 'library.sqlite'):
+            app = App(make_args(self.root, no_index=False))
+        jobs = list(app.discover())
+        app.library_index.close()
+        self.assertCountEqual([job.input_filename for job in jobs], self.videos)
+
+    def test_probe_fills_empty_metadata_cache(self):
+        with patch('app.METADATA_CACHE_FILE', self.root / 'cache' / 'metadata.sqlite'):
+            app = App(make_args(self.root, no_cache=False))
+        metadata = FileMetadata(self.videos[0], 1, 30.0,
+                                AudioMetadata('aac', 48_000, 2, 192_000, {}),
+                                VideoMetadata('hevc', 1920, 1080, '16:9', 30.0, 2_000_000, {}),
+                                {})
+        with patch('metadata_cache.probe_file', return_value=metadata) as probe_file:
+            app.probe(self.videos[0])
+            app.probe(self.videos[0])
+        app.metadata_cache.close()
+        probe_file.assert_called_once()
+
+    def test_discover_is_bounded(self):
+        app = App(make_args(self.root, filter='*'))
+        with patch('app.DISCOVERY_QUEUE_SIZE', 1):
+            jobs = app.discover()
+            next(jobs)
+            jobs.close()
+        self.assertLess(len(app.files), 5)
+
+    def test_discover_raises_discovery_errors(self):
+        app = App(make_args(self.root / 'notes.txt'))
+        with self.assertRaises(SystemExit):
+            list(app.discover())
+
+    def test_discover_filelist_with_outputs(self):
+        filelist = self.root / 'filelist.txt'
+        filelist.write_text('\n'.join((str(self.root / 'missing.mp4'), 'missing_out.mp4',
+                                       str(self.videos[0]), 'out_0.mp4',
+                                       str(self.videos[1]), 'out_1.mp4')))
+        app = App(make_args(filelist, filelist=True, output=Path('out')))
+        jobs = list(app.discover())
+        self.assertEqual([(job.input_filename, job.output_filename) for job in jobs],
+                         [(self.videos[0], Path('out_0.mp4')), (self.videos[1], Path('out_1.mp4'))])
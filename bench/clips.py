@@ -0,0 +1,164 @@
+import random
+import struct
+from json import dumps as dump_json, loads as load_json
+from pathlib import Path
+from typing import Optional, Union
+
+MAGIC = b'BENCHCLIP '
+
+VIDEO_PROFILES = (
+    # codec, width, height, fps, video bitrate
+    ('h264', 1920, 1080, 30, 8_000_000),
+    ('h264', 3840, 2160, 60, 40_000_000),
+    ('hevc', 1920, 1080, 30, 2_000_000),
+    ('hevc', 1920, 1080, 30, 6_000_000),
+    ('mpeg4', 1280, 720, 25, 3_000_000),
+)
+NON_VIDEO_EXTENSIONS = ('.srt', '.nfo', '.jpg')
+
+
+def write_clip(file_path: Union[str, Path], clip: dict):
+    """Write a stub video file whose metadata is stored as a JSON header"""
+    Path(file_path).write_bytes(MAGIC + dump_json(clip).encode() + b'\n')
+
+
+def read_clip(file_path: Union[str, Path]) -> Optional[dict]:
+    try:
+        with open(file_path, 'rb') as file:
+            header = file.readline()
+    except OSError:
+        return None
+    if not header.startswith(MAGIC):
+        return None
+    return load_json(header[len(MAGIC):])
+
+
+def random_clip(rng: random.Random) -> dict:
+    codec, width, height, fps, video_bitrate = rng.choice(VIDEO_PROFILES)
+    duration = rng.uniform(60, 3600)
+    audio_bitrate = rng.choice((128_000, 192_000, 320_000))
+    return {'video_codec': codec, 'width': width, 'height': height, 'fps': fps,
+            'video_bitrate': video_bitrate, 'audio_codec': rng.choice(('aac', 'ac3')),
+            'sample_rate': 48_000, 'channels': rng.choice((2, 6)), 'audio_bitrate': audio_bitrate,
+            'duration': round(duration, 3), 'size': int(duration * (video_bitrate + audio_bitrate) / 8)}
+
+
+def generate_tree(root: Path, files: int, files_per_directory: int = 100, seed: int = 0) -> int:
+    """Generate a library of stub clips, one in ten files is not a video
+
+    Returns the number of video files generated.
+    """
+    rng = random.Random(seed)
+    videos = 0
+    for i in range(files):
+        directory = root / f'show_{i // (files_per_directory * 10):04d}' / f'season_{i // files_per_directory:05d}'
+        if i % files_per_directory == 0:
+            directory.mkdir(parents=True, exist_ok=True)
+
+        if i % 10 == 9:
+            (directory / f'episode_{i:06d}{rng.choice(NON_VIDEO_EXTENSIONS)}').write_bytes(b'\0')
+            continue
+        write_clip(directory / f'Author - Episode {i:06d}.{rng.choice(("mkv", "mp4"))}', random_clip(rng))
+        videos += 1
+    return videos
+
+
+MP4_VIDEO_ENTRIES = {'h264': b'avc1', 'hevc': b'hvc1', 'mpeg4': b'mp4v'}
+MATROSKA_VIDEO_CODECS = {'h264': 'V_MPEG4/ISO/AVC', 'hevc': 'V_MPEGH/ISO/HEVC', 'mpeg4': 'V_MPEG4/ISO/ASP'}
+MATROSKA_AUDIO_CODECS = {'aac': 'A_AAC', 'ac3': 'A_AC3'}
+AAC_FREQUENCY_INDEXES = {96000: 0, 88200: 1, 64000: 2, 48000: 3, 44100: 4, 32000: 5, 24000: 6, 22050: 7}
+
+
+def aac_config(sample_rate: int, channels: int) -> bytes:
+    return (2 << 11 | AAC_FREQUENCY_INDEXES[sample_rate] << 7 | channels << 3).to_bytes(2, 'big')
+
+
+def box(box_type: bytes, *payloads: bytes) -> bytes:
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+
+def descriptor(tag: int, *payloads: bytes) -> bytes:
+    payload = b''.join(payloads)
+    return bytes((tag, 0x80, 0x80, 0x80, len(payload))) + payload
+
+
+def esds(object_type: int, stream_type: int, specific_info: bytes = b'') -> bytes:
+    config = descriptor(0x04, bytes((object_type, stream_type)), bytes(11),
+                        descriptor(0x05, specific_info) if specific_info else b'')
+    return box(b'esds', bytes(4), descriptor(0x03, bytes(3), config, descriptor(0x06, b'\x02')))
+
+
+def mp4_track(handler: bytes, timescale: int, sample_count: int, sample_delta: int, sample_size: int,
+              sample_entry: bytes) -> bytes:
+    duration = sample_count * sample_delta
+    stbl = box(b'stbl',
+               box(b'stsd', struct.pack('>II', 0, 1), sample_entry),
+               box(b'stts', struct.pack('>IIII', 0, 1, sample_count, sample_delta)),
+               box(b'stsc', struct.pack('>IIIII', 0, 1, 1, sample_count, 1)),
+               box(b'stsz', struct.pack('>III', 0, sample_size, sample_count)),
+               box(b'stco', struct.pack('>III', 0, 1, 0)))
+    return box(b'trak',
+               box(b'tkhd', bytes(84)),
+               box(b'mdia',
+                   box(b'mdhd', struct.pack('>IIIIIHH', 0, 0, 0, timescale, duration, 0x55C4, 0)),
+                   box(b'hdlr', struct.pack('>II4s', 0, 0, handler), bytes(13)),
+                   box(b'minf', stbl)))
+
+
+def write_mp4(file_path: Union[str, Path], clip: dict):
+    """Write the headers of a MP4 file with the properties of the clip, the media data is left empty"""
+    fps, sample_rate = clip['fps'], clip['sample_rate']
+    frames, audio_frames = int(clip['duration'] * fps), int(clip['duration'] * sample_rate / 1024)
+
+    entry_type = MP4_VIDEO_ENTRIES[clip['video_codec']]
+    video_config = esds(0x20, 0x11) if entry_type == b'mp4v' else box(b'avcC' if entry_type == b'avc1' else b'hvcC')
+    video_entry = box(entry_type, bytes(6), struct.pack('>H', 1), bytes(16),
+                      struct.pack('>HHIIIH', clip['width'], clip['height'], 0x480000, 0x480000, 0, 1),
+                      bytes(32), struct.pack('>Hh', 0x18, -1), video_config)
+    audio_entry = box(b'mp4a', bytes(6), struct.pack('>H', 1), bytes(8),
+                      struct.pack('>HHHHI', clip['channels'], 16, 0, 0, sample_rate << 16),
+                      esds(0x40, 0x15, aac_config(sample_rate, clip['channels'])))
+
+    moov = box(b'moov',
+               box(b'mvhd', struct.pack('>IIIII', 0, 0, 0, 1000, round(clip['duration'] * 1000)), bytes(80)),
+               mp4_track(b'vide', fps * 1000, frames, 1000, clip['video_bitrate'] // (8 * fps), video_entry),
+               mp4_track(b'soun', sample_rate, audio_frames, 1024, clip['audio_bitrate'] * 1024 // (8 * sample_rate),
+                         audio_entry))
+    Path(file_path).write_bytes(box(b'ftyp', b'isom', bytes(4), b'isomiso2mp41') + moov + box(b'mdat'))
+
+
+def element(element_id: int, *payloads: Union[bytes, int, float, str]) -> bytes:
+    payload = b''
+    for value in payloads:
+        if isinstance(value, float):
+            value = struct.pack('>d', value)
+        elif isinstance(value, int):
+            value = value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big')
+        elif isinstance(value, str):
+            value = value.encode('ascii')
+        payload += value
+    size = (0x01 << 56 | len(payload)).to_bytes(8, 'big')
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + size + payload
+
+
+def write_matroska(file_path: Union[str, Path], clip: dict):
+    """Write the headers of a Matroska file with the properties of the clip, the clusters are left empty"""
+    audio_codec = MATROSKA_AUDIO_CODECS[clip['audio_codec']]
+    audio_track = [element(0xD7, 2), element(0x83, 2), element(0x86, audio_codec)]
+    if audio_codec == 'A_AAC':
+        audio_track.append(element(0x63A2, aac_config(clip['sample_rate'], clip['channels'])))
+    audio_track.append(element(0xE1, element(0xB5, float(clip['sample_rate'])), element(0x9F, clip['channels'])))
+
+    segment = element(0x18538067,
+                      element(0x1549A966, element(0x2AD7B1, 1_000_000), element(0x4489, clip['duration'] * 1000.0),
+                              element(0x4D80, 'bench')),
+                      element(0x1654AE6B,
+                              element(0xAE, element(0xD7, 1), element(0x83, 1),
+                                      element(0x86, MATROSKA_VIDEO_CODECS[clip['video_codec']]),
+                                      element(0x23E383, round(1_000_000_000 / clip['fps'])),
+                                      element(0xE0, element(0xB0, clip['width']), element(0xBA, clip['height']))),
+                              element(0xAE, *audio_track)),
+                      element(0x1F43B675, element(0xE7, 0)))
+    header = element(0x1A45DFA3, element(0x4286, 1), element(0x42F7, 1), element(0x4282, 'matroska'))
+    Path(file_path).write_bytes(header + segment)
@@ -0,0 +1,344 @@
+"""Benchmark harness measuring the orchestration overhead and the encode throughput
+
+Stub mode runs against a generated library with fake ffprobe/ffmpeg executables, real mode
+encodes short lavfi clips with the CPU encoders, fails if the native container parser reads
+other metadata than ffprobe on them and times both. Results are written as JSON and can be
+compared between commits:
+
+    python3 -m bench.harness stub -o base.json
+    python3 -m bench.harness compare base.json new.json
+"""
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+from dataclasses import fields
+from pathlib import Path
+from random import Random
+from subprocess import run, DEVNULL, CalledProcessError
+from tempfile import TemporaryDirectory
+from typing import Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+FAKE_BIN = Path(__file__).resolve().parent / 'fake_bin'
+sys.path.insert(0, str(ROOT))
+
+from app import App  # noqa: E402
+from bench.clips import generate_tree, random_clip, write_matroska, write_mp4  # noqa: E402
+from filechecker import check_file  # noqa: E402
+from container_parser import parse_container  # noqa: E402
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata, missing_fields, probe_file  # noqa: E402
+from job import Job  # noqa: E402
+from library_index import LibraryIndex  # noqa: E402
+from metadata_cache import MetadataCache  # noqa: E402
+from prefetcher import Prefetcher  # noqa: E402
+from priority import QueueOrder, RankedQueue  # noqa: E402
+
+HIGHER_IS_BETTER_SUFFIX = '_per_second'
+
+
+def make_args(path: Path, **kwargs) -> Namespace:
+    args = dict(path=path, output=None, dry_run=False, remove=False, replace=False, overwrite=False,
+                clean_on_error=False, filelist=False, verbose=False, force_reencode=False, watch=False,
+                no_cache=True, no_index=True, no_journal=True, retry_all=True, lookahead=8, jobs=1,
+                order='scan', order_window=0, prediction='off', metrics_port=0, split=False, shared=None, control_port=0, staging=None, tune=False, dedup=False, filter=None)
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+@contextmanager
+def timer(results: dict, name: str):
+    start = time.perf_counter()
+    yield
+    results[name] = round(time.perf_counter() - start, 4)
+
+
+@contextmanager
+def fake_binaries():
+    path = os.environ.get('PATH', '')
+    os.environ['PATH'] = f'{FAKE_BIN}{os.pathsep}{path}'
+    try:
+        yield
+    finally:
+        os.environ['PATH'] = path
+
+
+def rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 2) if seconds else 0.0
+
+
+def commit_id() -> Optional[str]:
+    try:
+        result = run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True)
+    except (OSError, CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def run_main(content_path: Path, state_dir: Path, *args: str, env: Optional[dict] = None) -> float:
+    """Run main.py in a subprocess, returns the wall time"""
+    start = time.perf_counter()
+    run([sys.executable, str(ROOT / 'bench' / 'run_main.py'), str(content_path), *args],
+        env={**os.environ, 'BENCH_STATE_DIR': str(state_dir), **(env or {})},
+        stdout=DEVNULL, stderr=DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def log_stats(state_dir: Path) -> tuple[int, int]:
+    """Total size and line count of the logs written by a run"""
+    size = lines = 0
+    for log_file in (state_dir / 'logs').iterdir():
+        content = log_file.read_bytes()
+        size += len(content)
+        lines += content.count(b'\n')
+    return size, lines
+
+
+def bench_scan(root: Path, state_dir: Path, metrics: dict) -> list[Job]:
+    app = App(make_args(root, filter=None))
+    with timer(metrics, 'scan_walk_seconds'):
+        jobs = list(app.discover())
+    metrics['scan_walk_files_per_second'] = rate(len(jobs), metrics['scan_walk_seconds'])
+
+    app.library_index = LibraryIndex(state_dir / 'library.sqlite')
+    app.is_first_scan = True
+    with timer(metrics, 'scan_index_cold_seconds'):
+        list(app.discover())
+    with timer(metrics, 'scan_index_warm_seconds'):
+        list(app.discover())
+    app.library_index.close()
+    return jobs
+
+
+def bench_probe(root: Path, state_dir: Path, jobs: list[Job], metrics: dict):
+    app = App(make_args(root))
+    app.metadata_cache = MetadataCache(state_dir / 'metadata.sqlite')
+    with fake_binaries():
+        for name in ('probe_cold', 'probe_cached'):
+            fresh_jobs = [Job(job.index, job.input_filename, job.output_filename) for job in jobs]
+            with timer(metrics, f'{name}_seconds'), Prefetcher(app, fresh_jobs, app.args.prefetch_depth) as prefetcher:
+                probed = sum(1 for job in prefetcher if job.metadata)
+            metrics[f'{name}_files_per_second'] = rate(probed, metrics[f'{name}_seconds'])
+    app.metadata_cache.close()
+
+
+def bench_native_probe(files: list[Path], metrics: dict, rounds: int = 1, is_ffprobe_compared: bool = False):
+    """Probe the files with the native container parser, and with ffprobe alone when compared"""
+    modes = (('native_probe', True), ('ffprobe', False)) if is_ffprobe_compared else (('native_probe', True),)
+    for name, is_native in modes:
+        with timer(metrics, f'{name}_seconds'):
+            probed = sum(1 for _ in range(rounds) for file in files if probe_file(file, is_native=is_native))
+        metrics[f'{name}_files_per_second'] = rate(probed, metrics[f'{name}_seconds'])
+
+
+def metadata_fields(metadata: FileMetadata) -> dict:
+    values = {}
+    for field in fields(metadata):
+        value = getattr(metadata, field.name)
+        if isinstance(value, (AudioMetadata, VideoMetadata)):
+            values.update((f'{field.name}.{name}', item) for name, item in metadata_fields(value).items())
+        else:
+            values[field.name] = value
+    return values
+
+
+def compare_native_probe(files: list[Path]) -> list[str]:
+    """Fields of the metadata the native container parser reads differently from ffprobe"""
+    differences = []
+    for file in files:
+        parsed = parse_container(file)
+        if parsed is None or (missing := missing_fields(parsed)):
+            differences.append(f'{file.name}: not read by the native parser'
+                               + (f', missing {", ".join(missing)}' if parsed is not None else ''))
+            continue
+        native, ffprobe = probe_file(file, is_native=True), probe_file(file, is_native=False)
+        if native is None or ffprobe is None:
+            differences.append(f'{file.name}: probed by {"ffprobe" if native is None else "the native parser"} only')
+            continue
+        native_fields = metadata_fields(native)
+        for name, expected in metadata_fields(ffprobe).items():
+            value = native_fields[name]
+            # ffprobe prints durations and rates rounded to the microsecond
+            if value != expected and not (isinstance(value, float) and isinstance(expected, float)
+                                          and math.isclose(value, expected, rel_tol=1e-6)):
+                differences.append(f'{file.name}: {name} is {value!r} instead of {expected!r}')
+    return differences
+
+
+def generate_containers(root: Path, count: int) -> list[Path]:
+    """Generate MP4 and Matroska headers of random clips with codecs the native parser reads"""
+    root.mkdir()
+    rng = Random(0)
+    files = []
+    for i in range(count):
+        clip = {**random_clip(rng), 'audio_codec': 'aac'}
+        if clip['video_codec'] == 'mpeg4':
+            clip['video_codec'] = 'h264'
+        file = root / f'Container {i:06d}.{"mkv" if i % 2 else "mp4"}'
+        (write_matroska if i % 2 else write_mp4)(file, clip)
+        files.append(file)
+    return files
+
+
+def bench_queue(jobs: list[Job], metrics: dict):
+    rng = Random(0)
+    for job in jobs:
+        clip = random_clip(rng)
+        job.metadata = FileMetadata(job.input_filename, clip['size'], clip['duration'],
+                                    AudioMetadata(clip['audio_codec'], clip['sample_rate'], clip['channels'],
+                                                  clip['audio_bitrate'], {}),
+                                    VideoMetadata(clip['video_codec'], clip['width'], clip['height'], '16:9',
+                                                  clip['fps'], clip['video_bitrate'], {}),
+                                    {})
+        job.errors = check_file(job.metadata)
+        job.is_probed = True
+
+    with timer(metrics, 'queue_rank_seconds'):
+        ranked = sum(1 for _ in RankedQueue(jobs, QueueOrder.SAVINGS, 0))
+    metrics['queue_rank_jobs_per_second'] = rate(ranked, metrics['queue_rank_seconds'])
+
+
+def bench_end_to_end(jobs: list[Job], state_dir: Path, max_jobs: int, metrics: dict):
+    filelist = state_dir / 'filelist.txt'
+    filelist.write_text(''.join(f'{job.input_filename}\n' for job in jobs), encoding='ascii')
+    with fake_binaries():
+        seconds = run_main(filelist, state_dir, '-f', '--no-index', '--prediction', 'off', '-j', str(max_jobs),
+                           env={'BENCH_FFMPEG_SECONDS': '0'})
+    metrics['end_to_end_seconds'] = round(seconds, 4)
+    metrics['end_to_end_files_per_second'] = rate(len(jobs), seconds)
+
+    log_size, log_lines = log_stats(state_dir)
+    metrics['log_bytes_per_file'] = round(log_size / len(jobs), 1)
+    metrics['log_lines_per_file'] = round(log_lines / len(jobs), 1)
+
+
+def run_stub(args: Namespace) -> dict:
+    metrics = {}
+    with TemporaryDirectory() as tmp_dir:
+        root, state_dir = Path(tmp_dir, 'library'), Path(tmp_dir, 'state')
+        state_dir.mkdir()
+        with timer(metrics, 'generate_seconds'):
+            generate_tree(root, args.files)
+
+        jobs = bench_scan(root, state_dir, metrics)
+        bench_probe(root, state_dir, jobs[:args.probe_files], metrics)
+        bench_native_probe(generate_containers(Path(tmp_dir, 'containers'), args.probe_files), metrics)
+        bench_queue(jobs, metrics)
+        bench_end_to_end(jobs[:args.encode_files], state_dir, args.jobs, metrics)
+    return metrics
+
+
+def generate_real_clips(root: Path, count: int, duration: int):
+    root.mkdir()
+    for i in range(count):
+        run(['ffmpeg', '-hide_banner', '-v', 'error', '-y',
+             '-f', 'lavfi', '-i', f'testsrc=duration={duration}:size=1920x1080:rate=60',
+             '-f', 'lavfi', '-i', f'sine=frequency={440 + i * 110}:duration={duration}',
+             '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', '8M',
+             '-c:a', 'aac', '-b:a', '256k', '-ac', '2',
+             str(root / f'Bench - Clip {i}.mp4')], check=True)
+
+
+def remux_clips(clips: list[Path], root: Path) -> list[Path]:
+    root.mkdir()
+    outputs = []
+    for clip in clips:
+        output = root / f'{clip.stem}.mkv'
+        run(['ffmpeg', '-hide_banner', '-v', 'error', '-y', '-i', str(clip), '-c', 'copy', str(output)], check=True)
+        outputs.append(output)
+    return outputs
+
+
+def run_real(args: Namespace) -> dict:
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        raise SystemExit('Real mode requires ffmpeg and ffprobe in PATH')
+
+    metrics = {}
+    with TemporaryDirectory() as tmp_dir:
+        root, state_dir = Path(tmp_dir, 'clips'), Path(tmp_dir, 'state')
+        state_dir.mkdir()
+        with timer(metrics, 'generate_seconds'):
+            generate_real_clips(root, args.clips, args.duration)
+        clips = sorted(root.glob('*.mp4'))
+        clips += remux_clips(clips, Path(tmp_dir, 'remuxed'))
+        if differences := compare_native_probe(clips):
+            raise SystemExit('Native parser differs from ffprobe:\n' + '\n'.join(differences))
+        bench_native_probe(clips, metrics, args.probe_rounds, is_ffprobe_compared=True)
+
+        seconds = run_main(root, state_dir, '--no-index', '--prediction', 'off', '-j', str(args.jobs),
+                           env={'BENCH_ENCODER_BACKENDS': 'cpu'})
+        metrics['encode_seconds'] = round(seconds, 4)
+        metrics['encode_realtime_per_second'] = rate(args.clips * args.duration, seconds)
+        metrics['encode_files_per_second'] = rate(args.clips, seconds)
+        outputs = list(root.glob('*_reencoded.mp4'))
+        metrics['encoded_files'] = len(outputs)
+        metrics['output_bytes'] = sum(output.stat().st_size for output in outputs)
+    return metrics
+
+
+def compare(base: dict, new: dict, threshold: float) -> list[str]:
+    """Return the metrics that regressed by more than threshold"""
+    regressions = []
+    print(f'{"metric":<36} {"base":>14} {"new":>14} {"change":>9}')
+    for name in sorted(base['metrics'].keys() & new['metrics'].keys()):
+        base_value, new_value = base['metrics'][name], new['metrics'][name]
+        change = (new_value - base_value) / base_value if base_value else 0.0
+        is_regression = -change > threshold if name.endswith(HIGHER_IS_BETTER_SUFFIX) else change > threshold
+        if is_regression and not name.startswith('generate') and name not in ('encoded_files', 'output_bytes'):
+            regressions.append(name)
+        print(f'{name:<36} {base_value:>14} {new_value:>14} {change:>+8.1%}{" !" if name in regressions else ""}')
+    return regressions
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = ArgumentParser(description='Benchmark the reencode job')
+    commands = parser.add_subparsers(dest='mode', required=True)
+
+    stub = commands.add_parser('stub', help='measure orchestration overhead with fake ffprobe/ffmpeg')
+    stub.add_argument('--files', type=int, default=100_000, help='number of files in the generated library')
+    stub.add_argument('--probe-files', type=int, default=2_000, help='number of files probed')
+    stub.add_argument('--encode-files', type=int, default=500, help='number of files processed end to end')
+
+    real = commands.add_parser('real', help='encode lavfi clips with the CPU encoders')
+    real.add_argument('--clips', type=int, default=4, help='number of clips encoded')
+    real.add_argument('--duration', type=int, default=10, help='duration of each clip in seconds')
+    real.add_argument('--probe-rounds', type=int, default=25, help='number of times each clip is probed')
+
+    for mode in (stub, real):
+        mode.add_argument('-j', '--jobs', type=int, default=1, help='number of files encoded concurrently')
+        mode.add_argument('-o', '--output', type=Path, help='write results to this JSON file')
+
+    comparison = commands.add_parser('compare', help='compare two results files')
+    comparison.add_argument('base', type=Path)
+    comparison.add_argument('new', type=Path)
+    comparison.add_argument('--threshold', type=float, default=0.1,
+                            help='relative change above which a metric is reported as a regression')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'compare':
+        base, new = (json.loads(path.read_text(encoding='utf-8')) for path in (args.base, args.new))
+        regressions = compare(base, new, args.threshold)
+        if regressions:
+            print(f'Regressions: {", ".join(regressions)}')
+        return 1 if regressions else 0
+
+    metrics = run_stub(args) if args.mode == 'stub' else run_real(args)
+    params = {key: value for key, value in vars(args).items() if key not in ('mode', 'output')}
+    results = {'mode': args.mode, 'commit': commit_id(), 'timestamp': time.time(),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'cpu_count': os.cpu_count(), 'params': params, 'metrics': metrics}
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output + '\n', encoding='utf-8')
+    print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,29 @@
+"""Run main.py with its state redirected to BENCH_STATE_DIR
+
+BENCH_ENCODER_BACKENDS optionally restricts the encoder backends, comma separated.
+"""
+import os
+import runpy
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import config  # noqa: E402
+
+state_dir = Path(os.environ['BENCH_STATE_DIR'])
+(state_dir / 'logs').mkdir(parents=True, exist_ok=True)
+config.LOG_LOCATION = str(state_dir / 'logs')
+config.STOP_FILE = state_dir / 'stop.lock'
+config.METADATA_CACHE_FILE = state_dir / 'metadata.sqlite'
+config.LIBRARY_INDEX_FILE = state_dir / 'library.sqlite'
+config.PREDICTION_HISTORY_FILE = state_dir / 'predictions.sqlite'
+config.JOURNAL_FILE = state_dir / 'journal.sqlite'
+config.OUTCOME_CACHE_FILE = state_dir / 'outcomes.sqlite'
+if backends := os.environ.get('BENCH_ENCODER_BACKENDS'):
+    config.ENCODER_BACKENDS = backends.split(',')
+    config.CRITERIAS['video']['codec_encoder'] = None
+
+sys.argv[0] = str(ROOT / 'main.py')
+runpy.run_path(str(ROOT / 'main.py'), run_name='__main__')
@@ -0,0 +1,52 @@
+import io
+from contextlib import redirect_stdout
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from bench.clips import generate_tree, random_clip, read_clip, write_clip, write_mp4
+from bench.harness import compare, compare_native_probe, fake_binaries
+from container_parser import parse_container
+from fileparser import probe_file
+
+
+class BenchTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_generate_tree(self):
+        self.assertEqual(generate_tree(self.root, 250, files_per_directory=50), 225)
+        self.assertEqual(len(list(self.root.rglob('*.*'))), 250)
+
+    def test_fake_ffprobe(self):
+        clip = random_clip(Random(0))
+        write_clip(self.root / 'clip.mp4', clip)
+        with fake_binaries():
+            metadata = probe_file(self.root / 'clip.mp4')
+        self.assertEqual(read_clip(self.root / 'clip.mp4'), clip)
+        self.assertEqual((metadata.file_size, metadata.duration), (clip['size'], clip['duration']))
+        self.assertEqual(metadata.video.codec, clip['video_codec'])
+
+    def test_compare_native_probe(self):
+        clip = {**random_clip(Random(0)), 'video_codec': 'h264', 'audio_codec': 'aac'}
+        write_mp4(self.root / 'clip.mp4', clip)
+        write_clip(self.root / 'stub.mp4', clip)
+        ffprobe_output = parse_container(self.root / 'clip.mp4')
+        with patch('fileparser.run_ffprobe', return_value=ffprobe_output):
+            self.assertEqual(compare_native_probe([self.root / 'clip.mp4']), [])
+            ffprobe_output['streams'][0]['bit_rate'] = '1000'
+            self.assertEqual(compare_native_probe([self.root / 'clip.mp4', self.root / 'stub.mp4']),
+                             [f'clip.mp4: video.bitrate is {clip["video_bitrate"]} instead of 1000',
+                              'stub.mp4: not read by the native parser'])
+
+    def test_compare_reports_regressions(self):
+        base = {'metrics': {'scan_walk_files_per_second': 1000, 'end_to_end_seconds': 10, 'generate_seconds': 1}}
+        new = {'metrics': {'scan_walk_files_per_second': 800, 'end_to_end_seconds': 10.5, 'generate_seconds': 2}}
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(compare(base, new, 0.1), ['scan_walk_files_per_second'])
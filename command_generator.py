@@ -1,6 +1,8 @@
 from pathlib import Path
+from typing import Optional
 
 from config import CRITERIAS
+from encoders import EncoderBackend, Tuning, configured_backend, target_codec
 from filechecker import FileCheckError
 from fileparser import AudioMetadata, FileMetadata, VideoMetadata
 
@@ -32,23 +34,40 @@ def generate_audio_params(metadata: AudioMetadata, errors: FileCheckError):
     return params
 
 
-def generate_video_params(metadata: VideoMetadata, errors: FileCheckError):
+def generate_video_params(metadata: VideoMetadata,
+                          errors: FileCheckError,
+                          backend: Optional[EncoderBackend] = None,
+                          tuning: Optional[Tuning] = None):
     params = []
+    backend = backend or configured_backend()
 
     if check_flag_any(errors, FileCheckError.ALL_VIDEO):
-        video_codec = CRITERIAS['video']['codec_encoder']
-        params.extend(('-c:v', video_codec if video_codec else metadata.codec))
+        video_codec = target_codec() or metadata.codec
+        encoder = backend.encoder_for(video_codec)
+        if tuning is not None and tuning.encoder != encoder:
+            # Tunings are only valid for the encoder they were searched with
+            tuning = None
+        if encoder:
+            params.extend(backend.video_params(video_codec, tuning))
+        else:
+            # Let ffmpeg pick its default encoder for codecs the backend can't encode
+            params.extend(('-c:v', video_codec))
 
     if errors & FileCheckError.VIDEO_RESOLUTION:
         width, height = CRITERIAS['video']['resolution']
         resolution = f'{height}:{width}' if metadata.is_portrait else f'{width}:{height}'
-        params.extend(('-vf', f"scale={resolution}"))
+        params.extend(('-vf', f"{backend.scale_filter}={resolution}"))
 
     if errors & FileCheckError.VIDEO_FPS:
         params.extend(('-r', CRITERIAS['video']['fps']))
 
     if errors & FileCheckError.VIDEO_BITRATE:
-        params.extend(('-b:v', CRITERIAS['video']['bitrate']['target']))
+        target = CRITERIAS['video']['bitrate']['target']
+        if tuning is not None:
+            # Constant quality encodes are capped to the target instead of aiming at it
+            params.extend(('-maxrate', target, '-bufsize', 2 * target))
+        else:
+            params.extend(('-b:v', target))
 
     return params
 
@@ -78,8 +97,13 @@ def generate_tag_params(input_file: Path):
 def generate_ffmpeg_command(input_file: Path,
                             output_file: Path,
                             metadata: FileMetadata,
-                            errors: FileCheckError):
+                            errors: FileCheckError,
+                            threads: Optional[int] = None,
+                            progress_url: Optional[str] = None,
+                            backend: Optional[EncoderBackend] = None,
+                            tuning: Optional[Tuning] = None):
     params = []
+    backend = backend or configured_backend()
 
     if errors == FileCheckError.NONE:
         params.extend(('-c', 'copy'))
@@ -94,11 +118,99 @@ def generate_ffmpeg_command(input_file: Path,
         if check_flag_none(errors, FileCheckError.ALL_VIDEO):
             params.extend(('-c:v', 'copy'))
         else:
-            params.extend(generate_video_params(metadata.video, errors))
+            params.extend(generate_video_params(metadata.video, errors, backend, tuning))
+
+    params.extend(generate_tag_params(input_file))
+
+    if threads:
+        params.extend(('-threads', threads))
+
+    global_params = []
+    if progress_url:
+        global_params.extend(('-progress', progress_url, '-nostats'))
+
+    return list(map(str, ('ffmpeg', '-hide_banner', '-y', *global_params,
+                          *backend.input_params,
+                          '-i', input_file,
+                          *params,
+                          output_file)))
+
+
+def generate_split_command(input_file: Path, segment_pattern: Path, segment_seconds: int):
+    """Split the video stream on keyframes into segments without re-encoding"""
+    return list(map(str, ('ffmpeg', '-hide_banner', '-y', '-v', 'error',
+                          '-i', input_file,
+                          '-map', '0:v:0', '-c', 'copy',
+                          '-f', 'segment', '-segment_time', segment_seconds, '-reset_timestamps', 1,
+                          segment_pattern)))
+
+
+def generate_segment_command(segment_file: Path,
+                             output_file: Path,
+                             metadata: FileMetadata,
+                             errors: FileCheckError,
+                             threads: Optional[int] = None,
+                             backend: Optional[EncoderBackend] = None,
+                             tuning: Optional[Tuning] = None):
+    """Encode the video stream of a segment, audio is handled when concatenating segments"""
+    backend = backend or configured_backend()
+    params = generate_video_params(metadata.video, errors, backend, tuning)
+    if threads:
+        params.extend(('-threads', threads))
+
+    return list(map(str, ('ffmpeg', '-hide_banner', '-y', '-progress', 'pipe:1', '-nostats',
+                          *backend.input_params,
+                          '-i', segment_file,
+                          '-an',
+                          *params,
+                          output_file)))
+
+
+def generate_sample_command(input_file: Path,
+                            output_file: Path,
+                            metadata: FileMetadata,
+                            errors: FileCheckError,
+                            start: float,
+                            seconds: float,
+                            tuning: Tuning,
+                            threads: Optional[int] = None,
+                            backend: Optional[EncoderBackend] = None):
+    """Encode the video stream of a short excerpt with the given tuning"""
+    backend = backend or configured_backend()
+    params = generate_video_params(metadata.video, errors, backend, tuning)
+    if threads:
+        params.extend(('-threads', threads))
+
+    return list(map(str, ('ffmpeg', '-hide_banner', '-y', '-v', 'error',
+                          *backend.input_params,
+                          '-ss', f'{start:.3f}', '-t', f'{seconds:.3f}',
+                          '-i', input_file,
+                          '-an',
+                          *params,
+                          output_file)))
 
+
+def generate_concat_command(segment_list: Path,
+                            input_file: Path,
+                            output_file: Path,
+                            metadata: FileMetadata,
+                            errors: FileCheckError):
+    """Join the encoded segments with the audio of the original file
+
+    Only the first audio stream is kept, the one described by the metadata and selected
+    without explicit mapping when the file is encoded in a single pass.
+    """
+    params = []
+    if check_flag_none(errors, FileCheckError.ALL_AUDIO):
+        params.extend(('-c:a', 'copy'))
+    else:
+        params.extend(generate_audio_params(metadata.audio, errors))
     params.extend(generate_tag_params(input_file))
 
-    return list(map(str, ('ffmpeg', '-hide_banner', '-y', '-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda',
+    return list(map(str, ('ffmpeg', '-hide_banner', '-y', '-v', 'error',
+                          '-f', 'concat', '-safe', 0, '-i', segment_list,
                           '-i', input_file,
+                          '-map', '0:v:0', '-map', '1:a:0?', '-map_metadata', 1,
+                          '-c:v', 'copy',
                           *params,
                           output_file)))
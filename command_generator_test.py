@@ -74,3 +74,12 @@ class TestCommandGenerator(TestCase):
                                       '-c:v', 'hevc_nvenc',
                                       '-vf', 'scale=1920:1080',
                                       'output_path'])
+
+    def test_generate_ffmpeg_command_with_threads(self):
+        with patch('command_generator.generate_tag_params'):
+            result = generate_ffmpeg_command(Path("input_path"),
+                                             Path("output_path"),
+                                             self.metadata,
+                                             FileCheckError.AUDIO_BITRATE,
+                                             threads=4)
+            self.assertEqual(result[-3:], ['-threads', '4', 'output_path'])
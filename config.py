@@ -1,8 +1,13 @@
+from os import cpu_count
 from pathlib import Path
 
 LOG_LOCATION = '/app/logs'
 LOG_DATE_FORMAT = '%Y-%m-%d_%H-%M-%S.log'
 LOG_MESSAGE_FORMAT = '[%(levelname)s]:%(asctime)s %(message)s'
+FFMPEG_LOG_LINES = 200
+"""Last lines of ffmpeg output kept per encode, logged when the encode fails or in verbose mode"""
+EVENT_LOG_FILE = None
+"""Default path of the JSON-lines event log set with --event-log, None disables it"""
 
 EXT_WHITELIST = ['.avi', '.mp4', '.mov', '.mkv', '.m4v', '.wmv']
 
@@ -29,3 +34,117 @@ CRITERIAS = {
 }
 
 STOP_FILE = Path('/app/lock/stop.lock')
+LEASE_DIR = Path('.reencode_leases')
+"""Lease directory used with --shared, relative paths are resolved against the content path"""
+LEASE_TTL = 10 * 60
+"""Seconds without heartbeat after which the lease of a crashed node is reclaimed"""
+LEASE_HEARTBEAT_INTERVAL = 60
+
+METADATA_CACHE_FILE = Path('/app/cache/metadata.sqlite')
+METADATA_CACHE_MAX_ENTRIES = 250_000
+
+LIBRARY_INDEX_FILE = Path('/app/cache/library.sqlite')
+PREDICTION_HISTORY_FILE = Path('/app/cache/predictions.sqlite')
+JOURNAL_FILE = Path('/app/cache/journal.sqlite')
+JOURNAL_BATCH_SIZE = 500
+"""Number of discovered files committed to the journal at once, transitions are committed right away"""
+OUTCOME_CACHE_FILE = Path('/app/cache/outcomes.sqlite')
+TUNING_CACHE_FILE = Path('/app/cache/tuning.sqlite')
+DEDUP_INDEX_FILE = Path('/app/cache/dedup.sqlite')
+
+DISCOVERY_QUEUE_SIZE = 1_000
+PREFETCH_DEPTH = 8
+PROBE_WORKERS = 4
+PROBE_NATIVE = True
+"""Read MP4 and Matroska headers in process, ffprobe is only run for the files the parser can't read confidently"""
+PROBE_LEAN = True
+"""Only ask ffprobe for the fields in use, a full probe is run when some of them are missing"""
+PROBE_SIZE = 2_000_000
+"""Bytes read by the lean probe to detect streams, None keeps the ffprobe default"""
+PROBE_ANALYZE_DURATION = 2_000_000
+"""Microseconds of media analyzed by the lean probe, None keeps the ffprobe default"""
+
+MAX_CONCURRENT_JOBS = 1
+LANE_LIMITS = {
+    'video': 1,
+    'audio': 4,
+    'remux': 2
+}
+SCHEDULER_BACKLOG = 256
+"""Jobs waiting for an encode slot across all lanes, submitting more blocks until some of them start"""
+FFMPEG_THREADS = cpu_count() or 1
+ENCODER_BACKENDS = ['nvenc', 'qsv', 'vaapi', 'cpu']
+"""Encoder backends by order of preference, the ones ffmpeg doesn't support are ignored"""
+
+WATCH_QUIESCENCE_SECONDS = 60
+WATCH_RESCAN_INTERVAL = 6 * 3600
+WATCH_POLL_INTERVAL = 30
+
+QUEUE_ORDER = 'scan'
+QUEUE_WINDOW = 0
+"""Number of probed files ranked at once, 0 ranks every file of the pass before encoding"""
+ENCODE_SPEED_ESTIMATES = {
+    'video': 2.0,
+    'audio': 40.0,
+    'remux': 100.0
+}
+"""Expected encode speed of each lane in x realtime, video speed is given for 1080p"""
+
+PREDICTION_ACTION = 'deprioritize'
+"""What to do with files not expected to save enough space: off, skip or deprioritize"""
+PREDICTION_MIN_SAMPLES = 5
+"""Number of past encodes needed before trusting the history of similar files"""
+PREDICTION_MAX_SAMPLES = 50
+"""Number of most recent encodes of similar files a prediction is made from, older ones are removed"""
+PREDICTION_MAX_AGE = 180 * 24 * 3600
+"""Seconds after which a past encode is no longer used for predictions and removed"""
+PREDICTION_RESAMPLE_INTERVAL = 20
+"""One in this many files skipped because of their predicted size is encoded anyway to refresh the history"""
+MIN_PREDICTED_SAVINGS = 0.0
+"""Minimum fraction of the input size an encode is expected to save"""
+
+EARLY_ABORT_MIN_PROGRESS = 0.1
+"""Fraction of the input that must be encoded before trusting the projected output size"""
+EARLY_ABORT_RATIO = 1.0
+"""Abort encodes whose projected output size exceeds this ratio of the input size, 0 disables it"""
+
+METRICS_PORT = 0
+"""Port of the OpenMetrics endpoint, 0 disables it"""
+CONTROL_PORT = 0
+"""Port of the control plane API, 0 disables it"""
+CONTROL_HOST = '127.0.0.1'
+"""Interface the control plane listens on, the API is not authenticated"""
+METRICS_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+"""Upper bounds in seconds of the stage latency histogram buckets"""
+
+OUTCOME_RETRY_BACKOFF = 7 * 24 * 3600
+"""Seconds before retrying a file whose encode was unsuccessful, doubled on each new attempt"""
+OUTCOME_MAX_BACKOFF = 90 * 24 * 3600
+OUTPUT_DURATION_TOLERANCE = 0.01
+"""Maximum relative difference between the input and output durations of a valid output"""
+
+STAGING_DIR = Path('/tmp/reencode_job')
+"""Default local scratch directory of --staging, prefer a SSD or tmpfs"""
+STAGING_BUDGET = 50 * 1024 ** 3
+"""Bytes of scratch space used by the staged inputs and outputs, files that don't fit are processed in place"""
+STAGING_WAIT_TIMEOUT = 60
+"""Seconds an encode waits for the copy of its input in progress, the input is then read in place"""
+COPY_CHUNK_SIZE = 64 * 1024 ** 2
+"""Bytes copied per system call when staging and finalizing files"""
+
+SPLIT_MIN_DURATION = 30 * 60
+"""Minimum duration in seconds of the files encoded as parallel segments with --split"""
+SPLIT_SEGMENT_SECONDS = 120
+"""Target duration of a segment, segments are cut on the next keyframe"""
+SPLIT_THREADS_PER_SEGMENT = 2
+"""Encoder threads of each segment, FFMPEG_THREADS / SPLIT_THREADS_PER_SEGMENT segments are encoded at once"""
+
+TUNING_SAMPLES = 3
+"""Number of evenly spaced excerpts encoded with each candidate setting when tuning with --tune"""
+TUNING_SAMPLE_SECONDS = 5
+"""Duration of an excerpt, files shorter than twice the sampled duration are not tuned"""
+
+DEDUP_SAMPLE_SIZE = 1024 ** 2
+"""Bytes hashed at the start, middle and end of a file to fingerprint it with --dedup"""
+DEDUP_HARDLINK = False
+"""Hardlink the output of a duplicate when the filesystem can't reflink it, instead of copying it"""
@@ -0,0 +1,426 @@
+import logging
+import mmap
+import struct
+from fractions import Fraction
+from pathlib import Path
+from typing import Iterator, Optional
+
+logger = logging.getLogger('reencode_job.container_parser')
+
+MP4_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+MATROSKA_EXTENSIONS = ('.mkv', '.webm')
+
+MP4_VIDEO_CODECS = {
+    b'avc1': 'h264',
+    b'avc3': 'h264',
+    b'hvc1': 'hevc',
+    b'hev1': 'hevc',
+    b'av01': 'av1',
+    b'vp09': 'vp9',
+}
+MP4_OBJECT_TYPES = {
+    0x20: 'mpeg4',
+    0x40: 'aac',
+}
+MATROSKA_VIDEO_CODECS = {
+    'V_MPEG4/ISO/AVC': 'h264',
+    'V_MPEGH/ISO/HEVC': 'hevc',
+    'V_AV1': 'av1',
+    'V_VP9': 'vp9',
+    'V_VP8': 'vp8',
+}
+# Codecs whose bitrate ffprobe only knows from the bitstream are left to ffprobe
+MATROSKA_AUDIO_CODECS = {
+    'A_AAC': 'aac',
+    'A_OPUS': 'opus',
+    'A_VORBIS': 'vorbis',
+    'A_FLAC': 'flac',
+}
+AAC_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+AAC_CHANNELS = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 8}
+OPUS_SAMPLE_RATE = 48000
+
+EBML_HEADER = 0x1A45DFA3
+EBML_DOC_TYPE = 0x4282
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_CODEC_PRIVATE = 0x63A2
+MKV_DEFAULT_DURATION = 0x23E383
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_AUDIO = 0xE1
+MKV_SAMPLING_FREQUENCY = 0xB5
+MKV_OUTPUT_SAMPLING_FREQUENCY = 0x78B5
+MKV_CHANNELS = 0x9F
+MKV_CLUSTER = 0x1F43B675
+MKV_TRACK_VIDEO = 1
+MKV_TRACK_AUDIO = 2
+EBML_UNKNOWN_SIZE = -1
+
+
+class UnsupportedContainer(Exception):
+    """Raised when the headers can't be read with the same result ffprobe would give"""
+
+
+def parse_container(file_path: Path) -> Optional[dict]:
+    """Read the stream properties from the MP4 or Matroska headers of the file
+
+    Returns the properties in the format of the ffprobe JSON output, or None when the
+    container isn't supported or some of the values can't be trusted to match ffprobe,
+    in which case the file should be probed with ffprobe.
+    """
+    suffix = file_path.suffix.lower()
+    if suffix in MP4_EXTENSIONS:
+        parser = parse_mp4
+    elif suffix in MATROSKA_EXTENSIONS:
+        parser = parse_matroska
+    else:
+        return None
+
+    try:
+        with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            streams, duration = parser(data)
+            file_size = len(data)
+    except (OSError, ValueError) as e:
+        logger.debug('Unable to read "%s": %s', file_path, e)
+        return None
+    except (UnsupportedContainer, StopIteration, struct.error, IndexError) as e:
+        logger.debug('Falling back to ffprobe for "%s": %s', file_path, e or type(e).__name__)
+        return None
+
+    return {'streams': streams,
+            'format': {'filename': str(file_path), 'size': str(file_size), 'duration': f'{duration:.6f}'}}
+
+
+# MP4
+
+def iter_boxes(data, start: int, end: int) -> Iterator[tuple[bytes, int, int]]:
+    """Yield the type, payload offset and end offset of the boxes between start and end"""
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, start)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, start + 8)
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header or start + size > end:
+            raise UnsupportedContainer(f'truncated {box_type!r} box')
+        yield box_type, start + header, start + size
+        start += size
+
+
+def find_box(data, start: int, end: int, *path: bytes) -> Optional[tuple[int, int]]:
+    """Payload and end offsets of the first box found at the given path"""
+    for box_type, payload, box_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            return (payload, box_end) if len(path) == 1 else find_box(data, payload, box_end, *path[1:])
+    return None
+
+
+def read_duration_box(data, start: int) -> tuple[int, int]:
+    """Timescale and duration of a mvhd or mdhd full box"""
+    if data[start] == 1:
+        return struct.unpack_from('>IQ', data, start + 20)
+    return struct.unpack_from('>II', data, start + 12)
+
+
+def read_descriptor(data, start: int) -> tuple[int, int, int]:
+    """Tag, payload offset and end offset of a MPEG-4 descriptor"""
+    tag = data[start]
+    size = 0
+    offset = start + 1
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        size = size << 7 | byte & 0x7F
+        if not byte & 0x80:
+            break
+    return tag, offset, offset + size
+
+
+def read_esds(data, start: int, end: int) -> tuple[int, bytes]:
+    """Object type and decoder specific info of an esds box"""
+    tag, offset, _ = read_descriptor(data, start + 4)
+    if tag != 0x03:
+        raise UnsupportedContainer('no ES descriptor')
+    flags = data[offset + 2]
+    offset += 3
+    if flags & 0x80:
+        offset += 2
+    if flags & 0x40:
+        offset += 1 + data[offset]
+    if flags & 0x20:
+        offset += 2
+
+    tag, offset, config_end = read_descriptor(data, offset)
+    if tag != 0x04:
+        raise UnsupportedContainer('no decoder config descriptor')
+    object_type = data[offset]
+    specific_info = b''
+    if offset + 13 < config_end:
+        tag, info_start, info_end = read_descriptor(data, offset + 13)
+        if tag == 0x05:
+            specific_info = bytes(data[info_start:min(info_end, end)])
+    return object_type, specific_info
+
+
+def read_audio_specific_config(config: bytes) -> tuple[int, int]:
+    """Sample rate and channels of an AAC AudioSpecificConfig"""
+    if len(config) < 2:
+        raise UnsupportedContainer('no AAC decoder config')
+    bits = int.from_bytes(config[:5].ljust(5, b'\0'), 'big')
+    object_type = bits >> 35
+    if object_type in (5, 29, 31):
+        # SBR and PS double the sample rate announced in the config
+        raise UnsupportedContainer(f'AAC object type {object_type}')
+    frequency_index = bits >> 31 & 0xF
+    if frequency_index == 0xF:
+        sample_rate = bits >> 7 & 0xFFFFFF
+        channel_config = bits >> 3 & 0xF
+    elif frequency_index < len(AAC_SAMPLE_RATES):
+        sample_rate = AAC_SAMPLE_RATES[frequency_index]
+        channel_config = bits >> 27 & 0xF
+    else:
+        raise UnsupportedContainer(f'AAC frequency index {frequency_index}')
+    if channel_config not in AAC_CHANNELS:
+        raise UnsupportedContainer(f'AAC channel configuration {channel_config}')
+    return sample_rate, AAC_CHANNELS[channel_config]
+
+
+def read_sample_table(data, start: int, end: int, timescale: int) -> tuple[Optional[str], int, int]:
+    """Frame rate, total sample size and total duration in timescale units of a stbl box"""
+    stts = find_box(data, start, end, b'stts')
+    stsz = find_box(data, start, end, b'stsz')
+    if stts is None or stsz is None:
+        raise UnsupportedContainer('no stts or stsz box')
+
+    entries, = struct.unpack_from('>I', data, stts[0] + 4)
+    deltas = [struct.unpack_from('>II', data, stts[0] + 8 + i * 8) for i in range(entries)]
+    duration = sum(sample_count * delta for sample_count, delta in deltas)
+
+    sample_size, sample_count = struct.unpack_from('>II', data, stsz[0] + 4)
+    if sample_size:
+        data_size = sample_size * sample_count
+    else:
+        data_size = sum(struct.unpack_from(f'>{sample_count}I', data, stsz[0] + 12))
+    if not sample_count or not duration:
+        raise UnsupportedContainer('empty sample table')
+
+    # ffprobe only trusts the timescale for the frame rate when the sample durations are constant
+    frame_rate = None
+    if entries == 1 or (entries == 2 and deltas[1][0] == 1):
+        fraction = Fraction(timescale, deltas[0][1])
+        frame_rate = f'{fraction.numerator}/{fraction.denominator}'
+    return frame_rate, data_size, duration
+
+
+def read_mp4_track(data, start: int, end: int) -> Optional[dict]:
+    mdhd = find_box(data, start, end, b'mdia', b'mdhd')
+    hdlr = find_box(data, start, end, b'mdia', b'hdlr')
+    stbl = find_box(data, start, end, b'mdia', b'minf', b'stbl')
+    if mdhd is None or hdlr is None or stbl is None:
+        raise UnsupportedContainer('incomplete track')
+    handler = bytes(data[hdlr[0] + 8:hdlr[0] + 12])
+    if handler not in (b'vide', b'soun'):
+        return None
+
+    stsd = find_box(data, *stbl, b'stsd')
+    if stsd is None:
+        raise UnsupportedContainer('no stsd box')
+    entry_count, = struct.unpack_from('>I', data, stsd[0] + 4)
+    if entry_count != 1:
+        raise UnsupportedContainer(f'{entry_count} sample descriptions')
+    entry_type, entry, entry_end = next(iter_boxes(data, stsd[0] + 8, stsd[1]))
+
+    timescale, _ = read_duration_box(data, mdhd[0])
+    frame_rate, data_size, duration = read_sample_table(data, *stbl, timescale)
+    bitrate = (data_size * 8 * timescale + duration // 2) // duration
+
+    if handler == b'vide':
+        if entry_type == b'mp4v':
+            esds = find_box(data, entry + 78, entry_end, b'esds')
+            codec = MP4_OBJECT_TYPES.get(read_esds(data, *esds)[0]) if esds else None
+        else:
+            codec = MP4_VIDEO_CODECS.get(entry_type)
+        if codec is None or codec == 'aac':
+            raise UnsupportedContainer(f'video sample entry {entry_type!r}')
+        if frame_rate is None:
+            raise UnsupportedContainer('variable frame rate')
+        width, height = struct.unpack_from('>HH', data, entry + 24)
+        return {'codec_type': 'video', 'codec_name': codec, 'width': width, 'height': height,
+                'r_frame_rate': frame_rate, 'bit_rate': str(bitrate)}
+
+    version, = struct.unpack_from('>H', data, entry + 8)
+    if version != 0:
+        raise UnsupportedContainer(f'QuickTime sound description version {version}')
+    if entry_type == b'mp4a':
+        esds = find_box(data, entry + 28, entry_end, b'esds')
+        if esds is None or read_esds(data, *esds)[0] != 0x40:
+            raise UnsupportedContainer('mp4a without AAC config')
+        sample_rate, channels = read_audio_specific_config(read_esds(data, *esds)[1])
+        codec = 'aac'
+    elif entry_type == b'Opus':
+        dops = find_box(data, entry + 28, entry_end, b'dOps')
+        if dops is None:
+            raise UnsupportedContainer('Opus without dOps box')
+        sample_rate, channels, codec = OPUS_SAMPLE_RATE, data[dops[0] + 1], 'opus'
+    else:
+        raise UnsupportedContainer(f'audio sample entry {entry_type!r}')
+    return {'codec_type': 'audio', 'codec_name': codec, 'sample_rate': str(sample_rate), 'channels': channels,
+            'bit_rate': str(bitrate)}
+
+
+def parse_mp4(data) -> tuple[list[dict], float]:
+    moov = find_box(data, 0, len(data), b'moov')
+    if moov is None:
+        raise UnsupportedContainer('no moov box')
+    if find_box(data, *moov, b'mvex') is not None:
+        raise UnsupportedContainer('fragmented file')
+    mvhd = find_box(data, *moov, b'mvhd')
+    if mvhd is None:
+        raise UnsupportedContainer('no mvhd box')
+    timescale, duration = read_duration_box(data, mvhd[0])
+    if not timescale or not duration:
+        raise UnsupportedContainer('no movie duration')
+
+    streams = []
+    for box_type, payload, box_end in iter_boxes(data, *moov):
+        if box_type == b'trak' and (stream := read_mp4_track(data, payload, box_end)) is not None:
+            streams.append(stream)
+    return streams, duration / timescale
+
+
+# Matroska
+
+def read_vint(data, start: int, is_size: bool = True) -> tuple[int, int]:
+    """Value and end offset of an EBML variable size integer, the marker bit is kept for IDs"""
+    first = data[start]
+    length = 9 - first.bit_length()
+    if length > 8:
+        raise UnsupportedContainer('invalid EBML integer')
+    value = int.from_bytes(data[start:start + length], 'big')
+    if is_size:
+        value &= (1 << 7 * length) - 1
+        if value == (1 << 7 * length) - 1:
+            value = EBML_UNKNOWN_SIZE
+    return value, start + length
+
+
+def iter_elements(data, start: int, end: int) -> Iterator[tuple[int, int, int]]:
+    """Yield the ID, payload offset and end offset of the EBML elements between start and end"""
+    while start < end:
+        element_id, offset = read_vint(data, start, is_size=False)
+        size, offset = read_vint(data, offset)
+        element_end = end if size == EBML_UNKNOWN_SIZE else offset + size
+        if element_end > end:
+            raise UnsupportedContainer(f'truncated element {element_id:#x}')
+        yield element_id, offset, element_end
+        start = element_end
+
+
+def read_elements(data, start: int, end: int) -> dict[int, tuple[int, int]]:
+    return {element_id: (payload, element_end) for element_id, payload, element_end in iter_elements(data, start, end)}
+
+
+def read_uint(data, element: Optional[tuple[int, int]], default: Optional[int] = None) -> Optional[int]:
+    return int.from_bytes(data[element[0]:element[1]], 'big') if element else default
+
+
+def read_float(data, element: Optional[tuple[int, int]]) -> Optional[float]:
+    if element is None:
+        return None
+    size = element[1] - element[0]
+    if size not in (4, 8):
+        raise UnsupportedContainer('invalid EBML float')
+    return struct.unpack_from('>f' if size == 4 else '>d', data, element[0])[0]
+
+
+def read_string(data, element: Optional[tuple[int, int]]) -> str:
+    return bytes(data[element[0]:element[1]]).rstrip(b'\0').decode('ascii', 'replace') if element else ''
+
+
+def read_matroska_track(data, start: int, end: int) -> Optional[dict]:
+    elements = read_elements(data, start, end)
+    track_type = read_uint(data, elements.get(MKV_TRACK_TYPE))
+    codec_id = read_string(data, elements.get(MKV_CODEC_ID))
+
+    if track_type == MKV_TRACK_VIDEO:
+        codec = MATROSKA_VIDEO_CODECS.get(codec_id)
+        video = elements.get(MKV_VIDEO)
+        default_duration = read_uint(data, elements.get(MKV_DEFAULT_DURATION))
+        if codec is None or video is None or not default_duration:
+            raise UnsupportedContainer(f'video track {codec_id}')
+        # ffprobe reduces the frame rate with both terms limited to 30000
+        fraction = Fraction(1_000_000_000, default_duration).limit_denominator(30000)
+        if fraction.numerator > 30000:
+            raise UnsupportedContainer(f'frame rate {fraction}')
+        video_elements = read_elements(data, *video)
+        return {'codec_type': 'video', 'codec_name': codec,
+                'width': read_uint(data, video_elements.get(MKV_PIXEL_WIDTH), 0),
+                'height': read_uint(data, video_elements.get(MKV_PIXEL_HEIGHT), 0),
+                'r_frame_rate': f'{fraction.numerator}/{fraction.denominator}'}
+
+    if track_type == MKV_TRACK_AUDIO:
+        codec = MATROSKA_AUDIO_CODECS.get(codec_id.split('/', 1)[0])
+        audio = elements.get(MKV_AUDIO)
+        if codec is None or audio is None:
+            raise UnsupportedContainer(f'audio track {codec_id}')
+        audio_elements = read_elements(data, *audio)
+        if MKV_OUTPUT_SAMPLING_FREQUENCY in audio_elements:
+            raise UnsupportedContainer('output sampling frequency')
+        sample_rate = int(read_float(data, audio_elements.get(MKV_SAMPLING_FREQUENCY)) or 8000)
+        channels = read_uint(data, audio_elements.get(MKV_CHANNELS), 1)
+
+        if codec == 'opus':
+            sample_rate = OPUS_SAMPLE_RATE
+        elif codec == 'aac' and (codec_private := elements.get(MKV_CODEC_PRIVATE)):
+            if read_audio_specific_config(bytes(data[slice(*codec_private)])) != (sample_rate, channels):
+                raise UnsupportedContainer('AAC config differs from the track')
+        return {'codec_type': 'audio', 'codec_name': codec, 'sample_rate': str(sample_rate), 'channels': channels}
+
+    return None
+
+
+def parse_matroska(data) -> tuple[list[dict], float]:
+    header_id, header, header_end = next(iter_elements(data, 0, len(data)))
+    if header_id != EBML_HEADER:
+        raise UnsupportedContainer('no EBML header')
+    doc_type = read_string(data, read_elements(data, header, header_end).get(EBML_DOC_TYPE))
+    if doc_type not in ('matroska', 'webm'):
+        raise UnsupportedContainer(f'document type {doc_type}')
+
+    segment_id, segment, segment_end = next(iter_elements(data, header_end, len(data)))
+    if segment_id != MKV_SEGMENT:
+        raise UnsupportedContainer('no segment')
+
+    info = tracks = None
+    for element_id, payload, element_end in iter_elements(data, segment, segment_end):
+        if element_id == MKV_INFO:
+            info = read_elements(data, payload, element_end)
+        elif element_id == MKV_TRACKS:
+            tracks = (payload, element_end)
+        elif element_id == MKV_CLUSTER:
+            break
+        if info is not None and tracks is not None:
+            break
+    if info is None or tracks is None:
+        raise UnsupportedContainer('no Info or Tracks before the first cluster')
+
+    duration = read_float(data, info.get(MKV_DURATION))
+    if not duration:
+        raise UnsupportedContainer('no segment duration')
+    timecode_scale = read_uint(data, info.get(MKV_TIMECODE_SCALE), 1_000_000)
+
+    streams = []
+    for element_id, payload, element_end in iter_elements(data, *tracks):
+        if element_id == MKV_TRACK_ENTRY and (stream := read_matroska_track(data, payload, element_end)) is not None:
+            streams.append(stream)
+    return streams, duration * timecode_scale / 1_000_000_000
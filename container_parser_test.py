@@ -0,0 +1,80 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from bench.clips import box, write_clip, write_matroska, write_mp4
+from container_parser import parse_container, read_audio_specific_config, UnsupportedContainer
+from fileparser import probe_file
+
+CLIP = {'video_codec': 'h264', 'width': 1920, 'height': 1080, 'fps': 30, 'video_bitrate': 8_000_000,
+        'audio_codec': 'aac', 'sample_rate': 48_000, 'channels': 6, 'audio_bitrate': 192_000,
+        'duration': 1200.5, 'size': 0}
+
+
+class ContainerParserTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_mp4(self):
+        write_mp4(self.root / 'clip.mp4', CLIP)
+        video, audio = (json_output := parse_container(self.root / 'clip.mp4'))['streams']
+        self.assertEqual(video, {'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080,
+                                 'r_frame_rate': '30/1', 'bit_rate': '7999920'})
+        self.assertEqual(audio, {'codec_type': 'audio', 'codec_name': 'aac', 'sample_rate': '48000', 'channels': 6,
+                                 'bit_rate': '192000'})
+        self.assertEqual(json_output['format']['duration'], '1200.500000')
+        self.assertEqual(json_output['format']['size'], str((self.root / 'clip.mp4').stat().st_size))
+
+    def test_mp4_mpeg4_visual(self):
+        write_mp4(self.root / 'clip.m4v', {**CLIP, 'video_codec': 'mpeg4', 'fps': 25})
+        video, _ = parse_container(self.root / 'clip.m4v')['streams']
+        self.assertEqual((video['codec_name'], video['r_frame_rate']), ('mpeg4', '25/1'))
+
+    def test_matroska(self):
+        write_matroska(self.root / 'clip.mkv', CLIP)
+        video, audio = (json_output := parse_container(self.root / 'clip.mkv'))['streams']
+        # ffprobe doesn't report stream bitrates for Matroska
+        self.assertEqual(video, {'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080,
+                                 'r_frame_rate': '30/1'})
+        self.assertEqual(audio, {'codec_type': 'audio', 'codec_name': 'aac', 'sample_rate': '48000', 'channels': 6})
+        self.assertEqual(json_output['format']['duration'], '1200.500000')
+
+    def test_unsupported_files_fall_back(self):
+        write_matroska(self.root / 'mpeg4.mkv', {**CLIP, 'video_codec': 'mpeg4'})
+        write_matroska(self.root / 'ac3.mkv', {**CLIP, 'audio_codec': 'ac3'})
+        write_clip(self.root / 'stub.mp4', CLIP)
+        (self.root / 'empty.mkv').write_bytes(b'')
+        write_mp4(self.root / 'clip.avi', CLIP)
+        write_mp4(self.root / 'truncated.mp4', CLIP)
+        with open(self.root / 'truncated.mp4', 'r+b') as file:
+            file.truncate(200)
+        (self.root / 'fragmented.mp4').write_bytes(box(b'moov', box(b'mvex')))
+
+        for name in ('mpeg4.mkv', 'ac3.mkv', 'stub.mp4', 'empty.mkv', 'clip.avi', 'truncated.mp4', 'fragmented.mp4'):
+            with self.subTest(name):
+                self.assertIsNone(parse_container(self.root / name))
+
+    def test_audio_specific_config(self):
+        self.assertEqual(read_audio_specific_config(bytes((0x11, 0x90))), (48_000, 2))
+        with self.assertRaises(UnsupportedContainer):
+            # HE-AAC announces half of the output sample rate
+            read_audio_specific_config(bytes((0x2B, 0x10, 0x88, 0x00)))
+
+    def test_probe_file_skips_ffprobe(self):
+        write_mp4(self.root / 'clip.mp4', CLIP)
+        with patch('fileparser.run') as ffprobe:
+            metadata = probe_file(self.root / 'clip.mp4', is_native=True)
+        ffprobe.assert_not_called()
+        self.assertEqual((metadata.video.codec, metadata.video.frame_rate, metadata.audio.channels), ('h264', 30.0, 6))
+        self.assertEqual(metadata.filepath, self.root / 'clip.mp4')
+
+    def test_probe_file_falls_back_to_ffprobe(self):
+        write_matroska(self.root / 'clip.mkv', {**CLIP, 'audio_codec': 'ac3'})
+        with patch('fileparser.run_ffprobe', return_value=None) as ffprobe:
+            self.assertIsNone(probe_file(self.root / 'clip.mkv', is_native=True))
+        ffprobe.assert_called_once()
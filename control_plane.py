@@ -0,0 +1,274 @@
+import glob
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as dump_json, loads as load_json, JSONDecodeError
+from pathlib import Path
+from queue import Queue, Empty
+from typing import Callable, Optional
+
+from app import App
+from config import CONTROL_HOST
+from filechecker import check_file_ext
+from job import Job
+from prefetcher import prepare_job
+from scheduler import Scheduler
+from worker import Worker
+
+logger = logging.getLogger('reencode_job.control_plane')
+
+
+class ControlError(Exception):
+    """Raised when a request can't be fulfilled, carries the HTTP status to answer with"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def job_info(job: Job, state: str, slot: Optional[int] = None) -> dict:
+    info = {'path': str(job.input_filename), 'output': str(job.output_filename), 'state': state,
+            'priority': job.priority, 'lane': job.lane.value if job.is_probed else None, 'slot': slot}
+    if job.progress:
+        duration = job.metadata.duration if job.metadata else None
+        info['progress'] = {'out_time': job.progress.out_time,
+                            'duration': duration,
+                            'percent': round(min(job.progress.out_time / duration, 1) * 100, 2) if duration else None,
+                            'speed': job.progress.speed,
+                            'total_size': job.progress.total_size}
+    return info
+
+
+class ControlPlane:
+    """Local HTTP/JSON API to submit and control the jobs of a running instance
+
+        GET  /jobs                         queued and running jobs with their progress
+        POST /jobs                         {"paths": [...], "priority": 0}, glob patterns are expanded
+        POST /jobs/{pause,resume,cancel}   {"path": ...}
+        POST /jobs/priority                {"path": ..., "priority": 0}
+        POST /drain                        finish running jobs without starting new ones
+
+    Submitted files are probed by an intake thread and handed to the scheduler of the
+    current pass, files with a positive priority start before the files of the scan. Between
+    the passes of watch mode, submitted files start a new pass, see is_idle.
+    """
+
+    def __init__(self, app: App, port: int, host: str = CONTROL_HOST):
+        self.app = app
+        self._intake: Queue[Job] = Queue()
+        self._probing: Optional[Job] = None
+        self._scheduler: Optional[Scheduler] = None
+        self._attached = threading.Condition()
+        self._stop = threading.Event()
+        self._intake_thread = threading.Thread(target=self.__intake_loop, name='control-intake', daemon=True)
+
+        handler = type('ControlHandler', (_ControlHandler,), {'control_plane': self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='control-plane', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._intake_thread.start()
+        self._thread.start()
+        logger.info('Serving control plane on port %d', self.port)
+        return self
+
+    def close(self):
+        self._stop.set()
+        with self._attached:
+            self._attached.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        self._intake_thread.join()
+
+    def attach(self, scheduler: Scheduler):
+        """Hand submitted jobs to the scheduler of the current pass"""
+        with self._attached:
+            self._scheduler = scheduler
+            self._attached.notify_all()
+
+    @property
+    def is_idle(self) -> bool:
+        """Whether every submitted file was handed to a scheduler or dropped"""
+        return self._intake.unfinished_tasks == 0
+
+    def detach(self):
+        with self._attached:
+            self._scheduler = None
+
+    def wait(self, should_stop: Callable[[], bool], interval: float = 1):
+        """Block until should_stop returns True, submitted jobs keep being processed"""
+        while not should_stop():
+            self._stop.wait(interval)
+
+    def __intake_loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self._intake.get(timeout=1)
+            except Empty:
+                continue
+            if self.app.is_stop_requested or self.app.is_interrupted:
+                self._intake.task_done()
+                continue
+
+            self._probing = job
+            try:
+                prepare_job(self.app, job)
+                if job.is_skipped:
+                    Worker(self.app, job).work()
+                    continue
+
+                with self._attached:
+                    while self._scheduler is None and not self._stop.is_set():
+                        self._attached.wait(timeout=1)
+                    scheduler = self._scheduler
+                if scheduler is not None:
+                    scheduler.submit(job)
+            except Exception as e:
+                logger.exception('Unhandled exception', exc_info=e)
+            finally:
+                self._probing = None
+                self._intake.task_done()
+
+    def enqueue(self, patterns: list[str], priority: int = 0) -> list[str]:
+        """Submit files matching the given paths or glob patterns, returns the submitted files"""
+        if self.app.is_stop_requested:
+            raise ControlError(503, 'Draining, no new jobs are accepted')
+
+        submitted = []
+        for pattern in patterns:
+            for filename in sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]:
+                file_path = Path(filename)
+                if not file_path.is_file() or not check_file_ext(file_path)[0]:
+                    continue
+                self.app.files.append(file_path)
+                job = Job(len(self.app.files), file_path, self.app.output_for(file_path), priority=priority)
+                if self.app.journal is not None:
+                    self.app.journal.queue(job.input_filename, job.output_filename)
+                self._intake.put(job)
+                submitted.append(str(file_path))
+
+        logger.info('Submitted %d files with priority %d', len(submitted), priority)
+        return submitted
+
+    def jobs(self) -> list[dict]:
+        infos = [job_info(job, 'submitted') for job in list(self._intake.queue)]
+        if probing := self._probing:
+            infos.append(job_info(probing, 'probing'))
+        if scheduler := self._scheduler:
+            infos.extend(job_info(worker.job, 'paused' if worker.is_paused else 'running', worker.slot)
+                         for worker in scheduler.running_workers())
+            infos.extend(job_info(job, 'queued') for job in scheduler.pending_jobs())
+        return infos
+
+    def __worker(self, path: str) -> Worker:
+        worker = self._scheduler.find_worker(Path(path)) if self._scheduler else None
+        if worker is None:
+            raise ControlError(404, f'"{path}" is not running')
+        return worker
+
+    def pause(self, path: str):
+        if not self.__worker(path).pause():
+            raise ControlError(409, f'"{path}" is not encoding or can not be paused')
+
+    def resume(self, path: str):
+        if not self.__worker(path).resume():
+            raise ControlError(409, f'"{path}" is not paused')
+
+    def cancel(self, path: str):
+        file_path = Path(path)
+        with self._intake.mutex:
+            submitted = [job for job in self._intake.queue if job.input_filename == file_path]
+            for job in submitted:
+                self._intake.queue.remove(job)
+        for _ in submitted:
+            self._intake.task_done()
+        if submitted or (self._scheduler and self._scheduler.cancel(file_path)):
+            logger.info('Cancelled "%s"', path)
+            return
+        self.__worker(path).cancel()
+
+    def reprioritize(self, path: str, priority: int):
+        file_path = Path(path)
+        with self._intake.mutex:
+            for job in self._intake.queue:
+                if job.input_filename == file_path:
+                    job.priority = priority
+                    return
+        if not (self._scheduler and self._scheduler.reprioritize(file_path, priority)):
+            raise ControlError(404, f'"{path}" is not queued')
+
+    def drain(self):
+        logger.info('Drain requested, waiting for running jobs to finish...')
+        self.app.is_draining = True
+
+
+class _ControlHandler(BaseHTTPRequestHandler):
+    control_plane: ControlPlane
+
+    def __send_json(self, status: int, content):
+        body = dump_json(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            content = load_json(self.rfile.read(length) or b'{}')
+        except (JSONDecodeError, UnicodeDecodeError) as e:
+            raise ControlError(400, f'Invalid JSON: {e}')
+        if not isinstance(content, dict):
+            raise ControlError(400, 'Expected a JSON object')
+        return content
+
+    @staticmethod
+    def __field(content: dict, name: str, kind: type, default=None):
+        value = content.get(name, default)
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise ControlError(400, f'"{name}" must be a {kind.__name__}')
+        return value
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/jobs':
+            self.__send_json(404, {'error': 'Not found'})
+            return
+        self.__send_json(200, {'draining': self.control_plane.app.is_stop_requested,
+                               'jobs': self.control_plane.jobs()})
+
+    def do_POST(self):
+        control_plane = self.control_plane
+        route = self.path.split('?', 1)[0]
+        try:
+            content = self.__read_json()
+            if route == '/jobs':
+                paths = self.__field(content, 'paths', list)
+                if not all(isinstance(path, str) for path in paths):
+                    raise ControlError(400, '"paths" must be a list of strings')
+                submitted = control_plane.enqueue(paths, self.__field(content, 'priority', int, 0))
+                self.__send_json(202, {'submitted': submitted})
+                return
+
+            if route == '/drain':
+                control_plane.drain()
+            elif route in ('/jobs/pause', '/jobs/resume', '/jobs/cancel'):
+                getattr(control_plane, route.rsplit('/', 1)[1])(self.__field(content, 'path', str))
+            elif route == '/jobs/priority':
+                control_plane.reprioritize(self.__field(content, 'path', str), self.__field(content, 'priority', int))
+            else:
+                raise ControlError(404, 'Not found')
+            self.__send_json(200, {'ok': True})
+        except ControlError as e:
+            self.__send_json(e.status, {'error': str(e)})
+        except Exception as e:
+            logger.exception('Unhandled exception', exc_info=e)
+            self.__send_json(500, {'error': 'Internal error'})
+
+    def log_message(self, fmt, *args):
+        logger.debug('%s - %s', self.address_string(), fmt % args)
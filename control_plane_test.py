@@ -0,0 +1,130 @@
+import time
+from json import dumps as dump_json, loads as load_json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from app import App
+from app_test import make_args
+from control_plane import ControlPlane
+from ffmpeg_progress import ProgressUpdate
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from job import Job
+
+
+def probed(_, job: Job):
+    job.metadata = FileMetadata(job.input_filename, 100, 60.0,
+                                AudioMetadata('aac', 48_000, 2, 192_000, {}),
+                                VideoMetadata('h264', 1920, 1080, '16:9', 30.0, 8_000_000, {}),
+                                {})
+    job.errors = FileCheckError.VIDEO_CODEC
+    job.is_probed = True
+    return job
+
+
+class ControlPlaneTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        for name in ('a.mkv', 'b.mkv', 'notes.txt'):
+            (self.root / name).write_bytes(b'\0')
+
+        self.app = App(make_args(self.root))
+        self.scheduler = MagicMock()
+        self.scheduler.running_workers.return_value = []
+        self.scheduler.pending_jobs.return_value = []
+        self.scheduler.find_worker.return_value = None
+        self.control_plane = ControlPlane(self.app, 0, '127.0.0.1').start()
+        self.control_plane.attach(self.scheduler)
+
+    def tearDown(self):
+        self.control_plane.close()
+        self.tmp_dir.cleanup()
+
+    def request(self, path: str, content: dict = None):
+        url = f'http://127.0.0.1:{self.control_plane.port}{path}'
+        data = dump_json(content).encode() if content is not None else None
+        try:
+            with urlopen(Request(url, data, method='POST' if data else 'GET')) as response:
+                return response.status, load_json(response.read())
+        except HTTPError as e:
+            return e.code, load_json(e.read())
+
+    def wait_submitted(self, count: int):
+        deadline = time.monotonic() + 5
+        while self.scheduler.submit.call_count < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return [call.args[0] for call in self.scheduler.submit.call_args_list]
+
+    def test_enqueue_glob(self):
+        with patch('control_plane.prepare_job', side_effect=probed):
+            status, content = self.request('/jobs', {'paths': [str(self.root / '*')], 'priority': 5})
+            jobs = self.wait_submitted(2)
+
+        self.assertEqual(status, 202)
+        self.assertEqual(content['submitted'], [str(self.root / 'a.mkv'), str(self.root / 'b.mkv')])
+        self.assertEqual([job.input_filename.name for job in jobs], ['a.mkv', 'b.mkv'])
+        self.assertEqual([job.priority for job in jobs], [5, 5])
+        self.assertEqual(jobs[0].output_filename, self.root / 'a_reencoded.mp4')
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.request('/jobs', {'paths': 'a.mkv'})[0], 400)
+        self.assertEqual(self.request('/jobs', {'paths': ['a.mkv'], 'priority': 'high'})[0], 400)
+        self.assertEqual(self.request('/unknown', {})[0], 404)
+        self.assertEqual(self.request('/jobs/pause', {'path': str(self.root / 'a.mkv')})[0], 404)
+
+    def test_list_jobs_with_progress(self):
+        job = probed(None, Job(1, self.root / 'a.mkv', self.root / 'a_reencoded.mp4'))
+        job.progress = ProgressUpdate(30.0, 50, 2.0, 60.0, False)
+        worker = MagicMock(job=job, slot=0, is_paused=False)
+        self.scheduler.running_workers.return_value = [worker]
+        self.scheduler.pending_jobs.return_value = [Job(2, self.root / 'b.mkv', self.root / 'b_reencoded.mp4')]
+
+        status, content = self.request('/jobs')
+        self.assertEqual(status, 200)
+        running, queued = content['jobs']
+        self.assertEqual((running['state'], running['lane'], running['slot']), ('running', 'video', 0))
+        self.assertEqual(running['progress']['percent'], 50.0)
+        self.assertEqual((queued['state'], queued['path']), ('queued', str(self.root / 'b.mkv')))
+
+    def test_pause_resume_cancel(self):
+        worker = MagicMock()
+        self.scheduler.find_worker.return_value = worker
+        self.scheduler.cancel.return_value = None
+        path = str(self.root / 'a.mkv')
+
+        self.assertEqual(self.request('/jobs/pause', {'path': path})[0], 200)
+        worker.resume.return_value = False
+        self.assertEqual(self.request('/jobs/resume', {'path': path})[0], 409)
+        self.assertEqual(self.request('/jobs/cancel', {'path': path})[0], 200)
+        worker.pause.assert_called_once()
+        worker.cancel.assert_called_once()
+        self.scheduler.find_worker.assert_called_with(Path(path))
+
+    def test_drain(self):
+        self.assertEqual(self.request('/drain', {}), (200, {'ok': True}))
+        self.assertTrue(self.app.is_stop_requested)
+        status, _ = self.request('/jobs', {'paths': [str(self.root / 'a.mkv')]})
+        self.assertEqual(status, 503)
+
+    def test_unexpected_error(self):
+        with (patch.object(self.control_plane, 'enqueue', side_effect=RuntimeError('boom')),
+              self.assertLogs('reencode_job.control_plane', 'ERROR')):
+            self.assertEqual(self.request('/jobs', {'paths': []}), (500, {'error': 'Internal error'}))
+
+    def test_submitted_files_keep_intake_busy_until_scheduled(self):
+        self.control_plane.detach()
+        self.assertTrue(self.control_plane.is_idle)
+        with patch('control_plane.prepare_job', side_effect=probed):
+            self.request('/jobs', {'paths': [str(self.root / 'a.mkv')]})
+            time.sleep(0.1)
+            # A watch mode between passes wakes up on this and attaches the scheduler of a new pass
+            self.assertFalse(self.control_plane.is_idle)
+            self.control_plane.attach(self.scheduler)
+            self.wait_submitted(1)
+        self.control_plane.wait(lambda: self.control_plane.is_idle, interval=0.01)
+        self.assertTrue(self.control_plane.is_idle)
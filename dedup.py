@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+from config import DEDUP_SAMPLE_SIZE, DEDUP_HARDLINK
+from outcome_cache import criteria_hash
+from staging import atomic_copy, fsync_directory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('reencode_job.dedup')
+
+FICLONE = 0x40049409
+"""ioctl sharing the extents of a file on Btrfs, XFS and other copy on write filesystems"""
+
+
+def sampled_hash(file_path: Path, size: int, sample_size: int = DEDUP_SAMPLE_SIZE) -> str:
+    """Hash of the size and of the first, middle and last blocks of a file, small files are hashed whole"""
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    if size == 0:
+        return digest.hexdigest()
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        if size <= 3 * sample_size:
+            digest.update(view)
+        else:
+            for offset in (0, (size - sample_size) // 2, size - sample_size):
+                digest.update(view[offset:offset + sample_size])
+    return digest.hexdigest()
+
+
+def full_hash(file_path: Path) -> str:
+    with open(file_path, 'rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def _replace_with(link, source: Path, destination: Path):
+    partial = destination.with_name(f'.{destination.name}.partial')
+    partial.unlink(missing_ok=True)
+    try:
+        link(source, partial)
+        os.replace(partial, destination)
+    except OSError:
+        partial.unlink(missing_ok=True)
+        raise
+    fsync_directory(destination.parent)
+
+
+def _reflink(source: Path, destination: Path):
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+
+def reuse_file(source: Path, destination: Path, is_hardlink_allowed: bool = DEDUP_HARDLINK) -> str:
+    """Make the destination a copy of the source, sharing its blocks when the filesystem allows it
+
+    Returns how the file was reused: reflink, hardlink or copy.
+    """
+    if fcntl is not None:
+        try:
+            _replace_with(_reflink, source, destination)
+            return 'reflink'
+        except OSError:
+            pass
+    if is_hardlink_allowed:
+        try:
+            _replace_with(os.link, source, destination)
+            return 'hardlink'
+        except OSError:
+            pass
+    atomic_copy(source, destination)
+    return 'copy'
+
+
+class DedupIndex:
+    """Persistent index of the content of the encoded inputs, used to reuse the output of duplicates
+
+    Files are fingerprinted by their size and a hash of a few sampled blocks. The full content
+    is only hashed when the fingerprints of two files collide, and is hashed before an encoded
+    input is removed or replaced so that later duplicates can still be confirmed. Fingerprints
+    are only considered valid as long as the file size, mtime and inode match the ones recorded,
+    encodes recorded with other criterias are ignored.
+    """
+
+    def __init__(self, db_path: Path, sample_size: int = DEDUP_SAMPLE_SIZE):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.sample_size = sample_size
+        self.criteria = criteria_hash()
+
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                             'path TEXT PRIMARY KEY, '
+                             'size INTEGER NOT NULL, '
+                             'mtime_ns INTEGER NOT NULL, '
+                             'inode INTEGER NOT NULL, '
+                             'sample TEXT NOT NULL, '
+                             'digest TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS encodes ('
+                             'input TEXT PRIMARY KEY, '
+                             'size INTEGER NOT NULL, '
+                             'mtime_ns INTEGER NOT NULL, '
+                             'inode INTEGER NOT NULL, '
+                             'sample TEXT NOT NULL, '
+                             'digest TEXT, '
+                             'criteria TEXT NOT NULL, '
+                             'output TEXT NOT NULL, '
+                             'output_size INTEGER NOT NULL, '
+                             'output_mtime_ns INTEGER NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS encodes_sample ON encodes (size, sample)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM encodes').fetchone()[0]
+
+    def fingerprint(self, file_path: Path, is_digest_needed: bool = False) -> Optional[tuple[int, str, Optional[str]]]:
+        """Size, sampled hash and full hash if already known, of a file that still exists"""
+        key = str(file_path)
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            return None
+        identity = stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, inode, sample, digest FROM fingerprints '
+                                   'WHERE path = ?', (key,)).fetchone()
+        try:
+            if row is not None and tuple(row[:3]) == identity:
+                sample, digest = row[3:]
+            else:
+                sample, digest = sampled_hash(file_path, stat.st_size, self.sample_size), None
+            if digest is None and is_digest_needed:
+                digest = full_hash(file_path)
+        except (OSError, ValueError) as e:
+            # ValueError is raised when mapping a file truncated since it was stat
+            logger.warning('Failed to fingerprint "%s": %s', file_path, e)
+            return None
+        if row is None or (sample, digest) != tuple(row[3:]) or tuple(row[:3]) != identity:
+            with self._lock, self._db:
+                self._db.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?)',
+                                 (key, *identity, sample, digest))
+        return stat.st_size, sample, digest
+
+    def find_encoded(self, file_path: Path) -> Optional[Path]:
+        """Output of a previous encode of the same content with the current criterias"""
+        if (fingerprint := self.fingerprint(file_path)) is None:
+            return None
+        size, sample, digest = fingerprint
+
+        with self._lock:
+            rows = self._db.execute('SELECT input, mtime_ns, inode, digest, output, output_size, output_mtime_ns '
+                                    'FROM encodes WHERE size = ? AND sample = ? AND criteria = ? AND input != ?',
+                                    (size, sample, self.criteria, str(file_path))).fetchall()
+        for source, mtime_ns, inode, source_digest, output, output_size, output_mtime_ns in rows:
+            output = Path(output)
+            try:
+                output_stat = output.stat()
+            except FileNotFoundError:
+                output_stat = None
+            if output_stat is None or (output_stat.st_size, output_stat.st_mtime_ns) != (output_size, output_mtime_ns):
+                # The output was removed or modified since it was encoded
+                with self._lock, self._db:
+                    self._db.execute('DELETE FROM encodes WHERE input = ?', (source,))
+                continue
+
+            if source_digest is None:
+                source_digest = self.__digest_of_encoded(Path(source), size, mtime_ns, inode)
+                if source_digest is None:
+                    continue
+            if digest is None:
+                if (fingerprint := self.fingerprint(file_path, is_digest_needed=True)) is None:
+                    return None
+                *_, digest = fingerprint
+            if digest == source_digest:
+                return output
+            logger.debug('"%s" and "%s" only share their sampled blocks', file_path, source)
+        return None
+
+    def __digest_of_encoded(self, file_path: Path, size: int, mtime_ns: int, inode: int) -> Optional[str]:
+        """Full hash of an encoded input, if it is still the file that was encoded"""
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns, stat.st_ino) != (size, mtime_ns, inode):
+            return None
+        if (fingerprint := self.fingerprint(file_path, is_digest_needed=True)) is None:
+            return None
+        *_, digest = fingerprint
+        with self._lock, self._db:
+            self._db.execute('UPDATE encodes SET digest = ? WHERE input = ?', (digest, str(file_path)))
+        return digest
+
+    def record(self, input_file: Path, output_file: Path):
+        """Remember the output of an input fingerprinted before it was encoded"""
+        key = str(input_file)
+        try:
+            output_stat = output_file.stat()
+        except FileNotFoundError:
+            return
+
+        with self._lock, self._db:
+            row = self._db.execute('SELECT size, mtime_ns, inode, sample, digest FROM fingerprints '
+                                   'WHERE path = ?', (key,)).fetchone()
+            if row is None:
+                return
+            self._db.execute('INSERT OR REPLACE INTO encodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, *row, self.criteria, str(output_file),
+                              output_stat.st_size, output_stat.st_mtime_ns))
+        logger.debug('Recorded "%s" as the output of "%s"', output_file, input_file)
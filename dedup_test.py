@@ -0,0 +1,132 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import App
+from app_test import make_args
+from bench.clips import read_clip, write_clip
+from bench.harness import fake_binaries
+from dedup import DedupIndex, reuse_file, sampled_hash
+from filechecker import FileCheckError
+from fileparser import probe_file
+from job import Job
+from worker import Worker
+
+CLIP = {'video_codec': 'h264', 'width': 1920, 'height': 1080, 'fps': 30, 'video_bitrate': 8_000_000,
+        'audio_codec': 'aac', 'sample_rate': 48_000, 'channels': 2, 'audio_bitrate': 192_000,
+        'duration': 600.0, 'size': 614_400_000}
+
+
+class DedupIndexTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.index = DedupIndex(self.root / 'dedup.sqlite', sample_size=4)
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    def write(self, name: str, content: bytes) -> Path:
+        path = self.root / name
+        path.write_bytes(content)
+        return path
+
+    def encoded(self, name: str, content: bytes) -> Path:
+        path = self.write(name, content)
+        self.index.fingerprint(path)
+        self.index.record(path, self.write(f'{name}.out', b'encoded ' + content))
+        return path
+
+    def test_sampled_hash(self):
+        first = self.write('first', b'head' + b'a' * 10 + b'midd' + b'b' * 10 + b'tail')
+        second = self.write('second', b'head' + b'c' * 10 + b'midd' + b'd' * 10 + b'tail')
+        self.assertEqual(sampled_hash(first, 32, 4), sampled_hash(second, 32, 4))
+        self.assertNotEqual(sampled_hash(first, 32, 4), sampled_hash(self.write('third', b'x' * 32), 32, 4))
+        # Files of up to three blocks are hashed whole
+        self.assertNotEqual(sampled_hash(first, 32, 16), sampled_hash(second, 32, 16))
+
+    def test_duplicate_is_found(self):
+        self.encoded('first', b'same content')
+        duplicate = self.write('second', b'same content')
+        self.assertEqual(self.index.find_encoded(duplicate), self.root / 'first.out')
+        self.assertIsNone(self.index.find_encoded(self.write('third', b'other content')))
+
+    def test_sample_collision_is_confirmed_by_full_hash(self):
+        self.encoded('first', b'head' + b'a' * 10 + b'midd' + b'b' * 10 + b'tail')
+        collision = self.write('second', b'head' + b'c' * 10 + b'midd' + b'd' * 10 + b'tail')
+        with self.assertLogs('reencode_job.dedup', 'DEBUG'):
+            self.assertIsNone(self.index.find_encoded(collision))
+
+    def test_removed_input_is_confirmed_from_recorded_hash(self):
+        first = self.write('first', b'same content')
+        self.index.fingerprint(first, is_digest_needed=True)
+        self.index.record(first, self.write('first.out', b'encoded'))
+        first.unlink()
+        self.assertEqual(self.index.find_encoded(self.write('second', b'same content')), self.root / 'first.out')
+
+        # Without the full hash of a removed input, a sampled match can't be confirmed
+        self.encoded('third', b'other content').unlink()
+        self.assertIsNone(self.index.find_encoded(self.write('fourth', b'other content')))
+
+    def test_entries_persist_until_output_changes(self):
+        self.encoded('first', b'same content')
+        self.index.close()
+        self.index = DedupIndex(self.root / 'dedup.sqlite', sample_size=4)
+        duplicate = self.write('second', b'same content')
+        self.assertEqual(self.index.find_encoded(duplicate), self.root / 'first.out')
+
+        (self.root / 'first.out').write_bytes(b'modified since')
+        self.assertIsNone(self.index.find_encoded(duplicate))
+        self.assertEqual(len(self.index), 0)
+
+    def test_other_criterias_are_ignored(self):
+        self.encoded('first', b'same content')
+        self.index.criteria = 'other'
+        self.assertIsNone(self.index.find_encoded(self.write('second', b'same content')))
+
+    def test_reuse_file(self):
+        source = self.write('source', b'encoded')
+        with patch('dedup.fcntl', None):
+            self.assertEqual(reuse_file(source, self.root / 'copy', is_hardlink_allowed=False), 'copy')
+            self.assertEqual(reuse_file(source, self.root / 'link', is_hardlink_allowed=True), 'hardlink')
+        self.assertEqual((self.root / 'copy').read_bytes(), b'encoded')
+        self.assertTrue((self.root / 'link').samefile(source))
+        self.assertIn(reuse_file(source, self.root / 'clone'), ('reflink', 'copy'))
+        self.assertEqual((self.root / 'clone').read_bytes(), b'encoded')
+        self.assertFalse(any(path.name.endswith('.partial') for path in self.root.iterdir()))
+
+
+class WorkerDedupTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_duplicate_reuses_output(self):
+        inputs = [self.root / 'first.mkv', self.root / 'second.mkv']
+        for input_file in inputs:
+            write_clip(input_file, CLIP)
+        with patch('app.DEDUP_INDEX_FILE', self.root / 'dedup.sqlite'):
+            app = App(make_args(self.root, dedup=True, replace=True))
+        app.encoders = None
+
+        commands = []
+        with fake_binaries(), patch.dict(os.environ, {'BENCH_OUTPUT_RATIO': '0.2'}):
+            for index, input_file in enumerate(inputs, start=1):
+                job = Job(index, input_file, app.output_for(input_file), probe_file(input_file),
+                          FileCheckError.VIDEO_CODEC, True)
+                with self.assertLogs('reencode_job', 'DEBUG') as logs:
+                    Worker(app, job).work()
+                commands.append([record.msg for record in logs.records if isinstance(record.msg, list)])
+        app.dedup.close()
+
+        self.assertEqual((len(commands[0]), len(commands[1])), (1, 0))
+        outputs = [input_file.with_suffix('.mp4') for input_file in inputs]
+        self.assertEqual(read_clip(outputs[1]), read_clip(outputs[0]))
+        self.assertEqual(read_clip(outputs[1])['video_codec'], 'hevc')
+        self.assertFalse(any(input_file.exists() for input_file in inputs))
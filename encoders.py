@@ -0,0 +1,219 @@
+import logging
+import re
+import threading
+from dataclasses import dataclass, field
+from functools import cache
+from subprocess import run, CalledProcessError
+from typing import Optional
+
+from config import CRITERIAS, ENCODER_BACKENDS
+
+logger = logging.getLogger('reencode_job.encoders')
+
+CODEC_ALIASES = {
+    'h265': 'hevc',
+    'x265': 'hevc',
+    'avc': 'h264',
+    'x264': 'h264',
+}
+
+p_encoder = re.compile(r"^\s*V[F.][S.][X.][B.][D.]\s+(?P<name>[\w-]+)\s")
+
+
+@dataclass(frozen=True)
+class Tuning:
+    """Preset and constant quality picked by sample encodes, replacing the bitrate target"""
+    encoder: str
+    preset: str
+    quality: int
+
+
+@dataclass(frozen=True)
+class TuningSpace:
+    """Settings of an encoder tried by the sample encodes"""
+    presets: tuple[str, ...]
+    """Fastest first"""
+    qualities: tuple[int, ...]
+    """Best quality first, the last one is the lowest quality accepted"""
+    quality_option: str = '-crf'
+    rate_control: tuple[str, ...] = ()
+    """Parameters switching the encoder to constant quality"""
+
+    def params(self, tuning: Tuning) -> list:
+        return ['-preset', tuning.preset, *self.rate_control, self.quality_option, tuning.quality]
+
+
+NVENC_TUNING = TuningSpace(('p2', 'p4', 'p6'), (24, 27, 30, 33), '-cq', ('-rc', 'vbr', '-b:v', 0))
+QSV_TUNING = TuningSpace(('veryfast', 'faster', 'medium'), (22, 25, 28, 31), '-global_quality')
+
+TUNING_SPACES = {
+    'libx265': TuningSpace(('veryfast', 'faster', 'fast', 'medium'), (22, 24, 26, 28, 30)),
+    'libx264': TuningSpace(('veryfast', 'faster', 'fast', 'medium'), (20, 22, 24, 26, 28)),
+    'libsvtav1': TuningSpace(('10', '8', '6'), (28, 32, 36, 40)),
+    **{encoder: NVENC_TUNING for encoder in ('hevc_nvenc', 'h264_nvenc', 'av1_nvenc')},
+    **{encoder: QSV_TUNING for encoder in ('hevc_qsv', 'h264_qsv', 'av1_qsv')},
+}
+"""Encoders that can be tuned, VAAPI encoders don't expose comparable presets"""
+
+
+@dataclass(frozen=True)
+class EncoderBackend:
+    """Stores how ffmpeg has to be invoked to encode video on a given device"""
+    name: str
+    encoders: dict[str, str]
+    """Encoder used for each target codec"""
+    hwaccel: Optional[str] = None
+    """Hardware decoder the backend relies on"""
+    input_params: tuple[str, ...] = ()
+    """Parameters placed before the input file"""
+    presets: dict[str, tuple[str, ...]] = field(default_factory=dict)
+    """Speed-tuned parameters of each encoder"""
+    scale_filter: str = 'scale'
+
+    def encoder_for(self, codec: str) -> Optional[str]:
+        return self.encoders.get(normalize_codec(codec))
+
+    def tuning_space(self, codec: str) -> Optional[TuningSpace]:
+        return TUNING_SPACES.get(self.encoder_for(codec))
+
+    def video_params(self, codec: str, tuning: Optional[Tuning] = None) -> list:
+        encoder = self.encoder_for(codec)
+        if tuning is not None and tuning.encoder == encoder:
+            return ['-c:v', encoder, *TUNING_SPACES[encoder].params(tuning)]
+        return ['-c:v', encoder, *self.presets.get(encoder, ())]
+
+
+BACKENDS = {
+    'nvenc': EncoderBackend('nvenc',
+                            {'hevc': 'hevc_nvenc', 'h264': 'h264_nvenc', 'av1': 'av1_nvenc'},
+                            hwaccel='cuda',
+                            input_params=('-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda')),
+    'qsv': EncoderBackend('qsv',
+                          {'hevc': 'hevc_qsv', 'h264': 'h264_qsv', 'av1': 'av1_qsv'},
+                          hwaccel='qsv',
+                          input_params=('-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv'),
+                          presets={encoder: ('-preset', 'veryfast') for encoder in
+                                   ('hevc_qsv', 'h264_qsv', 'av1_qsv')},
+                          scale_filter='scale_qsv'),
+    'vaapi': EncoderBackend('vaapi',
+                            {'hevc': 'hevc_vaapi', 'h264': 'h264_vaapi', 'av1': 'av1_vaapi'},
+                            hwaccel='vaapi',
+                            input_params=('-hwaccel', 'vaapi', '-hwaccel_output_format', 'vaapi'),
+                            scale_filter='scale_vaapi'),
+    'cpu': EncoderBackend('cpu',
+                          {'hevc': 'libx265', 'h264': 'libx264', 'av1': 'libsvtav1'},
+                          presets={'libx265': ('-preset', 'fast'),
+                                   'libx264': ('-preset', 'fast'),
+                                   'libsvtav1': ('-preset', '8')}),
+}
+
+
+def normalize_codec(codec: str) -> str:
+    return CODEC_ALIASES.get(codec.lower(), codec.lower())
+
+
+def target_codec(criterias: Optional[dict] = None) -> Optional[str]:
+    """Video codec files are expected to be encoded with"""
+    codec = (criterias or CRITERIAS)['video']['codec']
+    return normalize_codec(codec) if codec else None
+
+
+def configured_backend(codec: Optional[str] = None) -> EncoderBackend:
+    """Backend of the encoder set in the criterias, used when capabilities are unknown"""
+    encoder = CRITERIAS['video'].get('codec_encoder')
+    for backend in BACKENDS.values():
+        if encoder in backend.encoders.values():
+            return backend
+
+    if encoder:
+        # Encoder unknown to the builtin backends, run it on its own
+        return EncoderBackend('custom', {normalize_codec(codec or target_codec() or encoder): encoder})
+    return BACKENDS[ENCODER_BACKENDS[0]]
+
+
+@dataclass(frozen=True)
+class Capabilities:
+    """Encoders and hwaccels reported by ffmpeg"""
+    encoders: frozenset[str]
+    hwaccels: frozenset[str]
+
+    def supports(self, backend: EncoderBackend, codec: str) -> bool:
+        encoder = backend.encoder_for(codec)
+        return (encoder is not None and encoder in self.encoders
+                and (backend.hwaccel is None or backend.hwaccel in self.hwaccels))
+
+
+def parse_encoders(output: str) -> frozenset[str]:
+    return frozenset(match['name'] for line in output.splitlines() if (match := p_encoder.match(line)))
+
+
+def parse_hwaccels(output: str) -> frozenset[str]:
+    _, _, accels = output.partition('Hardware acceleration methods:')
+    return frozenset(line.strip() for line in accels.splitlines() if line.strip())
+
+
+@cache
+def detect_capabilities() -> Optional[Capabilities]:
+    """Ask ffmpeg which encoders and hwaccels it was built with, None if ffmpeg can't be run"""
+    try:
+        encoders = run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, check=True, text=True)
+        hwaccels = run(['ffmpeg', '-hide_banner', '-hwaccels'], capture_output=True, check=True, text=True)
+    except (OSError, CalledProcessError) as e:
+        logger.warning('Unable to detect ffmpeg capabilities: %s', e)
+        return None
+    return Capabilities(parse_encoders(encoders.stdout), parse_hwaccels(hwaccels.stdout))
+
+
+class EncoderSelector:
+    """Pick the fastest backend available for the target codec, falling back on failures
+
+    Backends are tried in the ENCODER_BACKENDS order, the backend of the encoder set in
+    the criterias first. Capabilities are only detected on first use.
+    """
+
+    def __init__(self, capabilities: Optional[Capabilities] = None, codec: Optional[str] = None):
+        self.codec = codec or target_codec() or 'hevc'
+        self._capabilities = capabilities
+        self._backends: Optional[list[EncoderBackend]] = None
+        self._lock = threading.Lock()
+
+    def __candidates(self) -> list[EncoderBackend]:
+        preferred = configured_backend(self.codec)
+        candidates = [preferred] + [BACKENDS[name] for name in ENCODER_BACKENDS if name != preferred.name]
+
+        capabilities = self._capabilities or detect_capabilities()
+        if capabilities is None:
+            return [preferred]
+
+        backends = [backend for backend in candidates if capabilities.supports(backend, self.codec)]
+        if not backends:
+            logger.error('No encoder available for %s, keeping %s', self.codec, preferred.name)
+            return [preferred]
+        return backends
+
+    @property
+    def backends(self) -> list[EncoderBackend]:
+        with self._lock:
+            if self._backends is None:
+                self._backends = self.__candidates()
+                logger.info('Encoder backends: %s', ', '.join(backend.name for backend in self._backends))
+            return list(self._backends)
+
+    @property
+    def current(self) -> EncoderBackend:
+        return self.backends[0]
+
+    def fallback(self, backend: EncoderBackend) -> Optional[EncoderBackend]:
+        """Backend to retry with after an encode failed with the given one"""
+        backends = self.backends
+        if backend not in backends:
+            return backends[0] if backends else None
+        index = backends.index(backend)
+        return backends[index + 1] if index + 1 < len(backends) else None
+
+    def disable(self, backend: EncoderBackend):
+        """Stop using a backend once another one succeeded where it failed"""
+        with self._lock:
+            if self._backends and backend in self._backends and len(self._backends) > 1:
+                self._backends.remove(backend)
+                logger.warning('Disabling %s encoder backend', backend.name)
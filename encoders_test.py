@@ -0,0 +1,86 @@
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from command_generator import generate_ffmpeg_command
+from encoders import BACKENDS, Capabilities, EncoderSelector, configured_backend, parse_encoders, parse_hwaccels
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+
+ENCODERS_OUTPUT = """Encoders:
+ V..... = Video
+ A..... = Audio
+ ------
+ V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+ V....D h264_nvenc           NVIDIA NVENC H.264 encoder (codec h264)
+ V....D libx265              libx265 H.265 / HEVC (codec hevc)
+ V....D hevc_nvenc           NVIDIA NVENC hevc encoder (codec hevc)
+ V....D hevc_vaapi           H.265/HEVC (VAAPI) (codec hevc)
+ A....D aac                  AAC (Advanced Audio Coding)
+"""
+
+HWACCELS_OUTPUT = """Hardware acceleration methods:
+vdpau
+cuda
+vaapi
+
+"""
+
+
+class EncodersTest(TestCase):
+    metadata = FileMetadata(Path("input_path"), 123, 30.0,
+                            AudioMetadata("aac", 48_000, 2, 128_000, {}),
+                            VideoMetadata("h264", 1920, 1080, "16/9", 30.0, 8000, {}),
+                            {})
+
+    def test_parse_encoders(self):
+        self.assertEqual(parse_encoders(ENCODERS_OUTPUT),
+                         {'libx264', 'h264_nvenc', 'libx265', 'hevc_nvenc', 'hevc_vaapi'})
+
+    def test_parse_hwaccels(self):
+        self.assertEqual(parse_hwaccels(HWACCELS_OUTPUT), {'vdpau', 'cuda', 'vaapi'})
+
+    def test_configured_backend(self):
+        self.assertEqual(configured_backend().name, 'nvenc')
+
+    def test_selector_orders_available_backends(self):
+        capabilities = Capabilities(parse_encoders(ENCODERS_OUTPUT), parse_hwaccels(HWACCELS_OUTPUT))
+        selector = EncoderSelector(capabilities, 'hevc')
+        self.assertEqual([backend.name for backend in selector.backends], ['nvenc', 'vaapi', 'cpu'])
+
+    def test_selector_skips_backend_without_hwaccel(self):
+        capabilities = Capabilities(parse_encoders(ENCODERS_OUTPUT), frozenset())
+        selector = EncoderSelector(capabilities, 'hevc')
+        self.assertEqual(selector.current.name, 'cpu')
+
+    def test_selector_without_capabilities_keeps_configured_backend(self):
+        with patch('encoders.detect_capabilities', return_value=None):
+            selector = EncoderSelector(codec='hevc')
+            self.assertEqual([backend.name for backend in selector.backends], ['nvenc'])
+
+    def test_fallback_and_disable(self):
+        capabilities = Capabilities(parse_encoders(ENCODERS_OUTPUT), parse_hwaccels(HWACCELS_OUTPUT))
+        selector = EncoderSelector(capabilities, 'hevc')
+        self.assertEqual(selector.fallback(BACKENDS['nvenc']).name, 'vaapi')
+        self.assertIsNone(selector.fallback(BACKENDS['cpu']))
+        selector.disable(BACKENDS['nvenc'])
+        self.assertEqual(selector.current.name, 'vaapi')
+
+    def test_cpu_backend_command(self):
+        with patch('command_generator.generate_tag_params'):
+            result = generate_ffmpeg_command(Path("input_path"), Path("output_path"), self.metadata,
+                                             FileCheckError.VIDEO_CODEC | FileCheckError.VIDEO_RESOLUTION,
+                                             backend=BACKENDS['cpu'])
+        self.assertEqual(result, ['ffmpeg', '-hide_banner', '-y',
+                                  '-i', 'input_path',
+                                  '-c:a', 'copy',
+                                  '-c:v', 'libx265', '-preset', 'fast',
+                                  '-vf', 'scale=1920:1080',
+                                  'output_path'])
+
+    def test_vaapi_backend_command(self):
+        with patch('command_generator.generate_tag_params'):
+            result = generate_ffmpeg_command(Path("input_path"), Path("output_path"), self.metadata,
+                                             FileCheckError.VIDEO_RESOLUTION, backend=BACKENDS['vaapi'])
+        self.assertEqual(result[3:7], ['-hwaccel', 'vaapi', '-hwaccel_output_format', 'vaapi'])
+        self.assertIn('scale_vaapi=1920:1080', result)
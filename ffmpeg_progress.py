@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class ProgressUpdate:
+    """Stores a progress report written by ffmpeg -progress"""
+    out_time: float
+    """Output timestamp in seconds"""
+    total_size: Optional[int]
+    """Output size in bytes"""
+    speed: Optional[float]
+    """Encode speed in x realtime"""
+    fps: Optional[float]
+    is_end: bool
+
+
+def _parse_float(value: Optional[bytes]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return float(value.rstrip(b'x'))
+    except ValueError:
+        # ffmpeg reports N/A until the value is known
+        return None
+
+
+class ProgressParser:
+    """Incremental parser of the key=value blocks written by ffmpeg -progress
+
+    Each block is terminated by a progress=continue or progress=end line.
+    """
+
+    def __init__(self):
+        self._fields: dict[bytes, bytes] = {}
+
+    def feed(self, line: bytes) -> Optional[ProgressUpdate]:
+        """Parse a line, returns the progress update once a block is complete"""
+        key, sep, value = line.strip().partition(b'=')
+        if not sep:
+            return None
+
+        if key != b'progress':
+            self._fields[key] = value
+            return None
+
+        fields, self._fields = self._fields, {}
+        out_time_us = _parse_float(fields.get(b'out_time_us')) or _parse_float(fields.get(b'out_time_ms'))
+        total_size = _parse_float(fields.get(b'total_size'))
+        return ProgressUpdate(out_time=max(0.0, out_time_us or 0) / 1_000_000,
+                              total_size=int(total_size) if total_size is not None else None,
+                              speed=_parse_float(fields.get(b'speed')),
+                              fps=_parse_float(fields.get(b'fps')),
+                              is_end=value == b'end')
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from ffmpeg_progress import ProgressParser
+
+
+BLOCK = b"""frame=300
+fps=150.00
+stream_0_0_q=28.0
+bitrate= 559.2kbits/s
+total_size=2097152
+out_time_us=30000000
+out_time_ms=30000000
+out_time=00:00:30.000000
+dup_frames=0
+drop_frames=0
+speed=5.01x
+"""
+
+
+class TestProgressParser(TestCase):
+    """Test case for the ffmpeg -progress parser"""
+
+    def feed(self, parser: ProgressParser, data: bytes):
+        updates = [parser.feed(line) for line in data.splitlines(keepends=True)]
+        return [update for update in updates if update]
+
+    def test_parse_block(self):
+        updates = self.feed(ProgressParser(), BLOCK + b"progress=continue\n")
+        self.assertEqual(len(updates), 1)
+        update = updates[0]
+        self.assertEqual(update.out_time, 30.0)
+        self.assertEqual(update.total_size, 2097152)
+        self.assertEqual(update.speed, 5.01)
+        self.assertEqual(update.fps, 150.0)
+        self.assertFalse(update.is_end)
+
+    def test_parse_end_block(self):
+        updates = self.feed(ProgressParser(), BLOCK + b"progress=continue\n" + BLOCK + b"progress=end\n")
+        self.assertEqual([update.is_end for update in updates], [False, True])
+
+    def test_parse_unknown_values(self):
+        updates = self.feed(ProgressParser(), b"total_size=N/A\nout_time_us=N/A\nspeed=N/A\nprogress=continue\n")
+        self.assertEqual(updates[0].out_time, 0.0)
+        self.assertIsNone(updates[0].total_size)
+        self.assertIsNone(updates[0].speed)
+
+    def test_ignore_incomplete_block(self):
+        self.assertEqual(self.feed(ProgressParser(), BLOCK), [])
@@ -1,7 +1,9 @@
 from enum import Flag, auto
 from pathlib import Path
+from typing import Optional
 
 from config import EXT_WHITELIST, CRITERIAS
+from encoders import normalize_codec, target_codec
 from fileparser import FileMetadata
 
 
@@ -33,41 +35,42 @@ def check_file_ext(file_path: Path) -> tuple[bool, str]:
     return ext in EXT_WHITELIST, ext
 
 
-def check_file(metadata: FileMetadata) -> FileCheckError:
-    """Check if the file meets the requirements"""
+def check_file(metadata: FileMetadata, criterias: Optional[dict] = None) -> FileCheckError:
+    """Check if the file meets the requirements, of the configured criterias by default"""
+    criterias = criterias or CRITERIAS
     errors = FileCheckError.NONE
 
     audio = metadata.audio
 
-    if CRITERIAS['audio']['codec'] and audio.codec != CRITERIAS['audio']['codec']:
+    if criterias['audio']['codec'] and audio.codec != criterias['audio']['codec']:
         errors |= FileCheckError.AUDIO_CODEC
 
-    if CRITERIAS['audio']['sample_rate'] and audio.sample_rate > CRITERIAS['audio']['sample_rate']:
+    if criterias['audio']['sample_rate'] and audio.sample_rate > criterias['audio']['sample_rate']:
         errors |= FileCheckError.AUDIO_SAMPLE_RATE
 
-    if CRITERIAS['audio']['channels'] and audio.channels > CRITERIAS['audio']['channels']:
+    if criterias['audio']['channels'] and audio.channels > criterias['audio']['channels']:
         errors |= FileCheckError.AUDIO_CHANNELS
 
-    if CRITERIAS['audio']['bitrate'] and (audio.bitrate == 0 or audio.bitrate > CRITERIAS['audio']['bitrate']['threshold']):
+    if criterias['audio']['bitrate'] and (audio.bitrate == 0 or audio.bitrate > criterias['audio']['bitrate']['threshold']):
         errors |= FileCheckError.AUDIO_BITRATE
 
     video = metadata.video
 
-    if CRITERIAS['video']['codec'] and video.codec != CRITERIAS['video']['codec']:
+    if (codec := target_codec(criterias)) and normalize_codec(video.codec) != codec:
         errors |= FileCheckError.VIDEO_CODEC
 
     width, height = (video.width, video.height)
     if video.is_portrait:
         width, height = height, width
 
-    target_resolution = CRITERIAS['video']['resolution']
+    target_resolution = criterias['video']['resolution']
     if target_resolution and (width > target_resolution[0] or height > target_resolution[1]):
         errors |= FileCheckError.VIDEO_RESOLUTION
 
-    if CRITERIAS['video']['fps'] and video.frame_rate > CRITERIAS['video']['fps']:
+    if criterias['video']['fps'] and video.frame_rate > criterias['video']['fps']:
         errors |= FileCheckError.VIDEO_FPS
 
-    if CRITERIAS['video']['bitrate'] and (video.bitrate == 0 or video.bitrate > CRITERIAS['video']['bitrate']['threshold']):
+    if criterias['video']['bitrate'] and (video.bitrate == 0 or video.bitrate > criterias['video']['bitrate']['threshold']):
         errors |= FileCheckError.VIDEO_BITRATE
 
     return errors
@@ -7,6 +7,8 @@ from subprocess import run, CalledProcessError
 from typing import Optional
 
 from colorized_logger import SKIP
+from config import PROBE_LEAN, PROBE_NATIVE, PROBE_SIZE, PROBE_ANALYZE_DURATION
+from container_parser import parse_container
 
 logger = logging.getLogger('reencode_job.fileparser')
 
@@ -61,15 +63,42 @@ def calc_aspect_ratio(width: int, height: int):
     return f'{width // divisor}:{height // divisor}'
 
 
-def probe_file(file_path: Path) -> Optional[FileMetadata]:
-    """Parse the ffprobe output and return a dictionary of the metadata"""
-    if not file_path.exists():
-        logger.log(SKIP, "File doesn't exist anymore")
-        return None
-
+FULL_PROBE_PARAMS = ('-show_format', '-show_streams')
+LEAN_PROBE_ENTRIES = ('format=filename,size,duration:format_tags'
+                      ':stream=codec_type,codec_name,width,height,r_frame_rate,bit_rate,sample_rate,channels'
+                      ':stream_tags')
+REQUIRED_FIELDS = {
+    'video': ('codec_name', 'width', 'height'),
+    'audio': ('codec_name',),
+}
+
+
+def lean_probe_params(probe_size: Optional[int] = PROBE_SIZE,
+                      analyze_duration: Optional[int] = PROBE_ANALYZE_DURATION) -> tuple:
+    params = ()
+    if probe_size:
+        params += ('-probesize', str(probe_size))
+    if analyze_duration:
+        params += ('-analyzeduration', str(analyze_duration))
+    return params + ('-show_entries', LEAN_PROBE_ENTRIES)
+
+
+def missing_fields(json_output: dict) -> list[str]:
+    """Fields needed to build the metadata that are absent from the ffprobe output"""
+    missing = [f'format {key}' for key in ('size', 'duration') if key not in json_output.get('format', {})]
+    for codec_type, keys in REQUIRED_FIELDS.items():
+        stream = next((stream for stream in json_output.get('streams', [])
+                       if stream.get('codec_type') == codec_type), None)
+        if stream is None:
+            missing.append(f'{codec_type} stream')
+        else:
+            missing.extend(f'{codec_type} {key}' for key in keys if not stream.get(key))
+    return missing
+
+
+def run_ffprobe(file_path: Path, params: tuple) -> Optional[dict]:
     try:
-        result = run(['ffprobe', '-v', 'error', '-print_format', 'json',
-                      '-show_format', '-show_streams', str(file_path)],
+        result = run(['ffprobe', '-v', 'error', *params, '-print_format', 'json', str(file_path)],
                      shell=False,
                      capture_output=True,
                      check=True,
@@ -82,7 +111,49 @@ def probe_file(file_path: Path) -> Optional[FileMetadata]:
     if not output:
         logger.warning("No output from ffprobe")
         return None
-    json_output: dict = load_json(output)
+    return load_json(output)
+
+
+def probe_format(file_path: Path) -> Optional[tuple[int, float]]:
+    """Size and duration of a file, whatever streams it holds"""
+    json_output = run_ffprobe(file_path, ('-show_entries', 'format=size,duration'))
+    if json_output is None:
+        return None
+    format_stream: dict = json_output.get('format', {})
+    return int(format_stream.get('size', 0)), float(format_stream.get('duration', 0))
+
+
+def probe_file(file_path: Path, is_lean: bool = PROBE_LEAN, is_native: bool = PROBE_NATIVE) -> Optional[FileMetadata]:
+    """Parse the ffprobe output and return a dictionary of the metadata
+
+    MP4 and Matroska headers are read natively when possible, ffprobe is only spawned for the
+    files the native parser can't read confidently.
+    The lean probe only requests the fields in use with a bounded probe size, the file is
+    probed again in full if some of the required fields are missing.
+    """
+    if not file_path.exists():
+        logger.log(SKIP, "File doesn't exist anymore")
+        return None
+
+    json_output = None
+    if is_native:
+        json_output = parse_container(file_path)
+        if json_output is not None and (missing := missing_fields(json_output)):
+            logger.debug('Native parser is missing %s, running ffprobe', ', '.join(missing))
+            json_output = None
+
+    if json_output is None and is_lean:
+        json_output = run_ffprobe(file_path, lean_probe_params())
+        if json_output is None:
+            return None
+        if missing := missing_fields(json_output):
+            logger.debug('Lean probe is missing %s, running a full probe', ', '.join(missing))
+            json_output = None
+
+    if json_output is None:
+        json_output = run_ffprobe(file_path, FULL_PROBE_PARAMS)
+        if json_output is None:
+            return None
 
     video_stream: dict
     audio_stream: dict
@@ -0,0 +1,65 @@
+from json import dumps as dump_json
+from pathlib import Path
+from subprocess import CompletedProcess
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from fileparser import probe_file, missing_fields, lean_probe_params, LEAN_PROBE_ENTRIES
+
+VIDEO_STREAM = {'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080,
+                'r_frame_rate': '30/1', 'bit_rate': '8000000'}
+AUDIO_STREAM = {'codec_type': 'audio', 'codec_name': 'aac', 'sample_rate': '48000', 'channels': 2,
+                'bit_rate': '192000'}
+FORMAT = {'filename': 'video.mkv', 'size': '1000', 'duration': '60.0'}
+
+
+def ffprobe_output(*streams: dict, file_format: dict = FORMAT) -> CompletedProcess:
+    return CompletedProcess([], 0, dump_json({'streams': list(streams), 'format': file_format}), '')
+
+
+class ProbeFileTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.file = Path(self.tmp_dir.name, 'video.mkv')
+        self.file.write_bytes(b'\0')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lean_probe_params(self):
+        self.assertEqual(lean_probe_params(1_000, None), ('-probesize', '1000', '-show_entries', LEAN_PROBE_ENTRIES))
+
+    def test_missing_fields(self):
+        self.assertEqual(missing_fields({'streams': [VIDEO_STREAM, AUDIO_STREAM], 'format': FORMAT}), [])
+        self.assertEqual(missing_fields({'streams': [{**VIDEO_STREAM, 'width': 0}], 'format': {'size': '1'}}),
+                         ['format duration', 'video width', 'audio stream'])
+
+    def test_lean_probe(self):
+        with patch('fileparser.run', return_value=ffprobe_output(VIDEO_STREAM, AUDIO_STREAM)) as ffprobe:
+            metadata = probe_file(self.file, is_lean=True)
+
+        ffprobe.assert_called_once()
+        cmd = ffprobe.call_args.args[0]
+        self.assertIn('-show_entries', cmd)
+        self.assertNotIn('-show_streams', cmd)
+        self.assertEqual(cmd[-1], str(self.file))
+        self.assertEqual((metadata.video.codec, metadata.video.width, metadata.audio.channels), ('h264', 1920, 2))
+        self.assertEqual((metadata.file_size, metadata.duration), (1000, 60.0))
+
+    def test_lean_probe_escalates_when_fields_are_missing(self):
+        outputs = [ffprobe_output({**VIDEO_STREAM, 'width': 0, 'height': 0}, AUDIO_STREAM),
+                   ffprobe_output(VIDEO_STREAM, AUDIO_STREAM)]
+        with patch('fileparser.run', side_effect=outputs) as ffprobe:
+            metadata = probe_file(self.file, is_lean=True)
+
+        self.assertEqual(ffprobe.call_count, 2)
+        self.assertIn('-show_streams', ffprobe.call_args.args[0])
+        self.assertEqual(metadata.video.width, 1920)
+
+    def test_full_probe(self):
+        with patch('fileparser.run', return_value=ffprobe_output(VIDEO_STREAM)) as ffprobe:
+            self.assertIsNone(probe_file(self.file, is_lean=False))
+
+        ffprobe.assert_called_once()
+        self.assertIn('-show_streams', ffprobe.call_args.args[0])
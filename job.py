@@ -0,0 +1,73 @@
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+from command_generator import check_flag_any
+from ffmpeg_progress import ProgressUpdate
+from filechecker import FileCheckError
+from fileparser import FileMetadata
+
+
+class Lane(Enum):
+    """Kind of encode a job requires"""
+    VIDEO = 'video'
+    """Full video re-encode, CPU/GPU bound"""
+    AUDIO = 'audio'
+    """Audio re-encode with video stream copy, mostly I/O bound"""
+    REMUX = 'remux'
+    """Stream copy only, I/O bound"""
+
+
+def classify_lane(errors: FileCheckError) -> Lane:
+    if check_flag_any(errors, FileCheckError.ALL_VIDEO):
+        return Lane.VIDEO
+    if check_flag_any(errors, FileCheckError.ALL_AUDIO):
+        return Lane.AUDIO
+    return Lane.REMUX
+
+
+@dataclass
+class Prediction:
+    """Expected output size of an encode"""
+    ratio: float
+    """Expected output size divided by the input size"""
+    samples: int
+    """Number of past encodes the ratio is based on, 0 when it is only estimated from the criterias"""
+
+    @property
+    def savings(self) -> float:
+        return 1 - self.ratio
+
+    @property
+    def is_from_history(self):
+        return self.samples > 0
+
+
+@dataclass
+class Job:
+    """Stores a file to process along with its probing results"""
+    index: int
+    input_filename: Path
+    output_filename: Path
+
+    metadata: Optional[FileMetadata] = None
+    errors: FileCheckError = FileCheckError.NONE
+    is_probed: bool = False
+    skip_reason: Optional[str] = None
+    """Set when the job doesn't need a worker slot to be processed"""
+    prediction: Optional[Prediction] = None
+    is_deprioritized: bool = False
+    """Set when the job should only be processed after every other job of the pass"""
+    progress: Optional[ProgressUpdate] = None
+    """Last progress reported by ffmpeg while the job is running"""
+    priority: int = 0
+    """Jobs with a higher priority start first, set when submitted through the control plane"""
+
+    @property
+    def is_skipped(self):
+        return self.skip_reason is not None
+
+    @property
+    def lane(self) -> Lane:
+        return classify_lane(self.errors)
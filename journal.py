@@ -0,0 +1,186 @@
+import logging
+import sqlite3
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+from colorized_logger import ROLLBACK
+from config import JOURNAL_BATCH_SIZE
+
+logger = logging.getLogger('reencode_job.journal')
+
+
+class JobState(Enum):
+    """States a file goes through during a pass"""
+    QUEUED = 'queued'
+    PROBING = 'probing'
+    ENCODING = 'encoding'
+    VERIFYING = 'verifying'
+    """ffmpeg exited successfully, the output is being checked and moved into place"""
+    REPLACED = 'replaced'
+    """The input was replaced or removed by the output"""
+    DONE = 'done'
+    """The output was kept next to the input"""
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+
+FINISHED_STATES = (JobState.REPLACED, JobState.DONE, JobState.SKIPPED, JobState.FAILED)
+IN_FLIGHT_STATES = (JobState.PROBING, JobState.ENCODING, JobState.VERIFYING)
+
+
+class Journal:
+    """Write-ahead journal of the current pass
+
+    Every state transition is committed before the matching action is taken so that
+    a pass interrupted by a crash or a restart can be resumed where it stopped.
+    Discovered files are committed in batches, a discovery that was interrupted runs
+    again anyway. The journal is cleared once a pass completes.
+    """
+
+    def __init__(self, db_path: Path, batch_size: int = JOURNAL_BATCH_SIZE):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.batch_size = batch_size
+        self._uncommitted = 0
+
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # Commits are durable once the WAL is checkpointed, a power loss only loses the last transitions
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                             'path TEXT PRIMARY KEY, '
+                             'output TEXT NOT NULL, '
+                             'position INTEGER NOT NULL, '
+                             'state TEXT NOT NULL, '
+                             'updated_at REAL NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS transitions ('
+                             'path TEXT NOT NULL, '
+                             'state TEXT NOT NULL, '
+                             'at REAL NOT NULL)')
+            self._position = self._db.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM jobs').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def __get_run(self, key: str) -> Optional[str]:
+        row = self._db.execute('SELECT value FROM run WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def __set_run(self, key: str, value: str):
+        self._db.execute('INSERT OR REPLACE INTO run VALUES (?, ?)', (key, value))
+
+    def start(self, content_path: Path) -> bool:
+        """Start or resume a pass over content_path, returns whether a previous pass is resumed"""
+        with self._lock, self._db:
+            previous_path = self.__get_run('content_path')
+            if previous_path is not None and previous_path != str(content_path):
+                logger.info('Discarding journal of a pass over "%s"', previous_path)
+                self.__clear()
+            self.__set_run('content_path', str(content_path))
+            is_resumed = self._db.execute('SELECT 1 FROM jobs LIMIT 1').fetchone() is not None
+        if is_resumed:
+            logger.info('Resuming interrupted pass')
+        return is_resumed
+
+    @property
+    def is_discovery_done(self) -> bool:
+        with self._lock:
+            return self.__get_run('discovery_done') == '1'
+
+    def mark_discovery_done(self):
+        with self._lock, self._db:
+            self.__set_run('discovery_done', '1')
+            self._uncommitted = 0
+
+    def queue(self, input_filename: Path, output_filename: Path) -> bool:
+        """Record a discovered file, returns False if it was already finished during this pass
+
+        The file is committed with the next batch or the next transition.
+        """
+        key = str(input_filename)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT state FROM jobs WHERE path = ?', (key,)).fetchone()
+            if row and JobState(row[0]) in FINISHED_STATES:
+                return False
+            if row is None:
+                self._db.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?)',
+                                 (key, str(output_filename), self._position, JobState.QUEUED.value, now))
+                self._db.execute('INSERT INTO transitions VALUES (?, ?, ?)', (key, JobState.QUEUED.value, now))
+                self._position += 1
+                self._uncommitted += 1
+                if self._uncommitted >= self.batch_size:
+                    self._db.commit()
+                    self._uncommitted = 0
+        return True
+
+    def transition(self, input_filename: Path, state: JobState):
+        key = str(input_filename)
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE path = ?', (state.value, now, key))
+            self._db.execute('INSERT INTO transitions VALUES (?, ?, ?)', (key, state.value, now))
+            self._uncommitted = 0
+
+    def state(self, input_filename: Path) -> Optional[JobState]:
+        with self._lock:
+            row = self._db.execute('SELECT state FROM jobs WHERE path = ?', (str(input_filename),)).fetchone()
+        return JobState(row[0]) if row else None
+
+    def pending(self) -> list[tuple[Path, Path]]:
+        """Input and output files of the pass that are not finished yet, in discovery order"""
+        finished = tuple(state.value for state in FINISHED_STATES)
+        with self._lock:
+            rows = self._db.execute(f'SELECT path, output FROM jobs '
+                                    f'WHERE state NOT IN ({", ".join("?" * len(finished))}) '
+                                    f'ORDER BY position', finished).fetchall()
+        return [(Path(path), Path(output)) for path, output in rows]
+
+    def recover(self) -> int:
+        """Roll back the files that were in flight when the previous run stopped
+
+        Partial outputs are removed and the files are queued again.
+        """
+        in_flight = tuple(state.value for state in IN_FLIGHT_STATES)
+        with self._lock:
+            rows = self._db.execute(f'SELECT path, output, state FROM jobs '
+                                    f'WHERE state IN ({", ".join("?" * len(in_flight))})', in_flight).fetchall()
+
+        for path, output, state in rows:
+            input_filename, output_filename = Path(path), Path(output)
+            new_state = JobState.QUEUED
+            if JobState(state) == JobState.PROBING:
+                pass
+            elif not input_filename.exists():
+                # The input was already replaced by its output
+                new_state = JobState.REPLACED
+            elif output_filename != input_filename and output_filename.exists():
+                logger.log(ROLLBACK, 'Removing leftover of interrupted job "%s"', output_filename)
+                output_filename.unlink()
+            self.transition(input_filename, new_state)
+
+        if rows:
+            logger.info('Recovered %d interrupted jobs', len(rows))
+        return len(rows)
+
+    def __clear(self):
+        self._db.execute('DELETE FROM jobs')
+        self._db.execute('DELETE FROM transitions')
+        self._db.execute('DELETE FROM run')
+        self._position = 0
+
+    def finish(self):
+        """Clear the journal once every file of the pass was processed"""
+        with self._lock, self._db:
+            self.__clear()
@@ -0,0 +1,135 @@
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import App
+from app_test import make_args
+from journal import Journal, JobState
+
+
+class JournalTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.db_path = self.root / 'cache' / 'journal.sqlite'
+        self.journal = Journal(self.db_path)
+
+        self.videos = []
+        for i in range(4):
+            video = self.root / f'video_{i}.mp4'
+            video.write_bytes(b'\0')
+            self.videos.append(video)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def output(video: Path):
+        return video.with_stem(f'{video.stem}_reencoded')
+
+    def reopen(self):
+        self.journal.close()
+        self.journal = Journal(self.db_path)
+
+    def test_fresh_pass_is_not_resumed(self):
+        self.assertFalse(self.journal.start(self.root))
+
+    def test_pending_keeps_discovery_order(self):
+        self.journal.start(self.root)
+        for video in reversed(self.videos):
+            self.assertTrue(self.journal.queue(video, self.output(video)))
+        self.journal.transition(self.videos[1], JobState.DONE)
+        self.assertEqual([path for path, _ in self.journal.pending()],
+                         [self.videos[3], self.videos[2], self.videos[0]])
+
+    def test_discovered_files_are_committed_in_batches(self):
+        self.journal.close()
+        self.journal = Journal(self.db_path, batch_size=2)
+        self.journal.start(self.root)
+        reader = sqlite3.connect(self.db_path)
+
+        def committed():
+            return reader.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+        self.journal.queue(self.videos[0], self.output(self.videos[0]))
+        self.assertEqual(committed(), 0)
+        self.journal.queue(self.videos[1], self.output(self.videos[1]))
+        self.assertEqual(committed(), 2)
+        self.journal.queue(self.videos[2], self.output(self.videos[2]))
+        self.journal.transition(self.videos[0], JobState.PROBING)
+        self.assertEqual(committed(), 3)
+        reader.close()
+
+        self.journal.queue(self.videos[3], self.output(self.videos[3]))
+        self.reopen()
+        self.assertTrue(self.journal.queue(self.videos[3], self.output(self.videos[3])))
+        self.assertEqual([path for path, _ in self.journal.pending()], self.videos)
+
+    def test_finished_file_is_not_queued_again(self):
+        self.journal.start(self.root)
+        self.journal.queue(self.videos[0], self.output(self.videos[0]))
+        self.journal.transition(self.videos[0], JobState.SKIPPED)
+        self.reopen()
+        self.assertTrue(self.journal.start(self.root))
+        self.assertFalse(self.journal.queue(self.videos[0], self.output(self.videos[0])))
+        self.assertTrue(self.journal.queue(self.videos[1], self.output(self.videos[1])))
+
+    def test_recover_removes_partial_output(self):
+        self.journal.start(self.root)
+        for video in self.videos[:3]:
+            self.journal.queue(video, self.output(video))
+        self.journal.transition(self.videos[0], JobState.PROBING)
+        self.journal.transition(self.videos[1], JobState.ENCODING)
+        self.output(self.videos[1]).write_bytes(b'partial')
+        self.journal.transition(self.videos[2], JobState.VERIFYING)
+        self.videos[2].unlink()
+
+        self.reopen()
+        self.assertEqual(self.journal.recover(), 3)
+        self.assertFalse(self.output(self.videos[1]).exists())
+        self.assertEqual(self.journal.state(self.videos[0]), JobState.QUEUED)
+        self.assertEqual(self.journal.state(self.videos[1]), JobState.QUEUED)
+        self.assertEqual(self.journal.state(self.videos[2]), JobState.REPLACED)
+
+    def test_other_content_path_is_discarded(self):
+        self.journal.start(self.root)
+        self.journal.queue(self.videos[0], self.output(self.videos[0]))
+        self.assertFalse(self.journal.start(self.root / 'other'))
+        self.assertEqual(len(self.journal), 0)
+
+    def test_finish_clears_pass(self):
+        self.journal.start(self.root)
+        self.journal.queue(self.videos[0], self.output(self.videos[0]))
+        self.journal.mark_discovery_done()
+        self.journal.finish()
+        self.assertEqual(len(self.journal), 0)
+        self.assertFalse(self.journal.is_discovery_done)
+
+    def test_app_fills_empty_journal(self):
+        with patch('app.JOURNAL_FILE', self.db_path):
+            app = App(make_args(self.root, no_journal=False, filter='*.mp4'))
+        self.journal.close()
+        self.journal = app.journal
+        list(app.discover())
+        self.assertEqual(len(self.journal), 4)
+        self.assertTrue(self.journal.is_discovery_done)
+
+    def test_app_resumes_from_journal(self):
+        self.journal.start(self.root)
+        for video in self.videos:
+            self.journal.queue(video, self.output(video))
+        self.journal.mark_discovery_done()
+        self.journal.transition(self.videos[0], JobState.REPLACED)
+        self.journal.transition(self.videos[1], JobState.ENCODING)
+        self.output(self.videos[1]).write_bytes(b'partial')
+        self.journal.close()
+
+        with patch('app.JOURNAL_FILE', self.db_path):
+            app = App(make_args(self.root, no_journal=False))
+        self.journal = app.journal
+        jobs = list(app.discover())
+        self.assertFalse(self.output(self.videos[1]).exists())
+        self.assertEqual([job.input_filename for job in jobs], self.videos[1:])
@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from json import dumps as dump_json, loads as load_json, JSONDecodeError
+from pathlib import Path
+from typing import Optional
+
+from config import LEASE_TTL, LEASE_HEARTBEAT_INTERVAL
+
+logger = logging.getLogger('reencode_job.lease')
+
+
+def node_id() -> str:
+    """Identifier of this process, unique across the nodes sharing a library"""
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class LeaseManager:
+    """Per-file leases stored on the filesystem shared by several nodes
+
+    A lease is a file created with O_EXCL in a directory sharded by the hash of the
+    leased path. Held leases are touched by a heartbeat thread, a lease whose mtime is
+    older than the TTL belongs to a crashed node and is reclaimed by the next node
+    wanting the file. The TTL has to exceed the clock skew between the nodes.
+
+    Files are identified by their path relative to the library root so that nodes mounting
+    the share at different mount points agree on the lease of a file.
+    """
+
+    def __init__(self,
+                 lease_dir: Path,
+                 ttl: float = LEASE_TTL,
+                 heartbeat_interval: float = LEASE_HEARTBEAT_INTERVAL,
+                 owner: Optional[str] = None,
+                 library_root: Optional[Path] = None):
+        self.lease_dir = lease_dir
+        self.library_root = library_root
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.owner = owner or node_id()
+
+        self._held: dict[str, tuple[Path, str]] = {}
+        """Lease file and token of each held lease"""
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        self._heartbeat = threading.Thread(target=self.__heartbeat_loop, name='lease-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def close(self):
+        """Stop the heartbeats and release every held lease"""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        for key in list(self._held):
+            self.release(Path(key))
+
+    def shared_key(self, file_path: Path) -> str:
+        """Identifier of a file that is the same on every node"""
+        if self.library_root is not None and file_path.is_relative_to(self.library_root):
+            return file_path.relative_to(self.library_root).as_posix()
+        return str(file_path)
+
+    def path(self, file_path: Path) -> Path:
+        digest = hashlib.sha1(self.shared_key(file_path).encode()).hexdigest()
+        return self.lease_dir / digest[:2] / f'{digest}.lease'
+
+    @staticmethod
+    def __read(lease_path: Path) -> dict:
+        try:
+            return load_json(lease_path.read_text(encoding='utf-8'))
+        except (OSError, JSONDecodeError):
+            return {}
+
+    def owner_of(self, file_path: Path) -> Optional[str]:
+        return self.__read(self.path(file_path)).get('owner')
+
+    def __is_ours(self, lease_path: Path, token: str) -> bool:
+        # Inodes are reused as soon as a lease is removed, only the token identifies a lease
+        return self.__read(lease_path).get('token') == token
+
+    def acquire(self, file_path: Path) -> bool:
+        """Lease a file, returns False if another node holds a live lease on it"""
+        key = str(file_path)
+        lease_path = self.path(file_path)
+        lease_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # A second attempt is only made after an expired lease was broken
+        for _ in range(2):
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if self.__break_expired(lease_path):
+                    continue
+                return False
+
+            token = uuid.uuid4().hex
+            with os.fdopen(fd, 'w', encoding='utf-8') as lease:
+                lease.write(dump_json({'owner': self.owner, 'token': token, 'path': self.shared_key(file_path),
+                                       'acquired_at': time.time()}))
+            with self._lock:
+                self._held[key] = (lease_path, token)
+            return True
+        return False
+
+    def release(self, file_path: Path):
+        with self._lock:
+            held = self._held.pop(str(file_path), None)
+        if held is None:
+            return
+        lease_path, token = held
+        if self.__is_ours(lease_path, token):
+            lease_path.unlink(missing_ok=True)
+
+    def is_held(self, file_path: Path) -> bool:
+        """Whether the lease is still ours, it is lost if another node reclaimed it"""
+        with self._lock:
+            held = self._held.get(str(file_path))
+        if held is None:
+            return False
+        lease_path, token = held
+        return self.__is_ours(lease_path, token)
+
+    def __break_expired(self, lease_path: Path) -> bool:
+        """Remove a lease whose owner stopped sending heartbeats, returns whether it was removed"""
+        try:
+            mtime = lease_path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if time.time() - mtime < self.ttl:
+            return False
+        token = self.__read(lease_path).get('token')
+
+        # Renaming is atomic, only one of the nodes racing for the expired lease succeeds
+        tombstone = lease_path.with_name(f'{lease_path.name}.{uuid.uuid4().hex}.expired')
+        try:
+            os.rename(lease_path, tombstone)
+        except FileNotFoundError:
+            return True
+
+        if self.__read(tombstone).get('token') != token:
+            # Another node reclaimed the lease between the stat and the rename, give it back
+            try:
+                os.link(tombstone, lease_path)
+            except FileExistsError:
+                pass
+            tombstone.unlink()
+            return False
+
+        logger.warning('Reclaiming expired lease "%s"', lease_path)
+        tombstone.unlink()
+        return True
+
+    def __heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            self.heartbeat()
+
+    def heartbeat(self):
+        """Refresh the mtime of the held leases"""
+        with self._lock:
+            held = list(self._held.items())
+        for key, (lease_path, token) in held:
+            if not self.__is_ours(lease_path, token):
+                logger.error('Lease of "%s" was reclaimed by another node', key)
+                with self._lock:
+                    self._held.pop(key, None)
+                continue
+            try:
+                os.utime(lease_path)
+            except FileNotFoundError:
+                pass
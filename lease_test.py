@@ -0,0 +1,88 @@
+import os
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from lease import LeaseManager
+
+
+class LeaseManagerTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.lease_dir = Path(self.tmp_dir.name, 'leases')
+        self.file = Path('/data/Author - Title.mkv')
+        self.node_a = LeaseManager(self.lease_dir, ttl=60, heartbeat_interval=3600, owner='node-a')
+        self.node_b = LeaseManager(self.lease_dir, ttl=60, heartbeat_interval=3600, owner='node-b')
+        self.node_a.start()
+        self.node_b.start()
+
+    def tearDown(self):
+        self.node_a.close()
+        self.node_b.close()
+        self.tmp_dir.cleanup()
+
+    def expire(self, file_path: Path):
+        expired_at = time.time() - 120
+        os.utime(self.node_a.path(file_path), (expired_at, expired_at))
+
+    def test_leases_are_sharded(self):
+        lease_path = self.node_a.path(self.file)
+        self.assertEqual(lease_path.parent.parent, self.lease_dir)
+        self.assertEqual(lease_path.parent.name, lease_path.name[:2])
+
+    def test_acquire_is_exclusive(self):
+        self.assertTrue(self.node_a.acquire(self.file))
+        self.assertFalse(self.node_b.acquire(self.file))
+        self.assertEqual(self.node_b.owner_of(self.file), 'node-a')
+
+        self.node_a.release(self.file)
+        self.assertFalse(self.node_a.path(self.file).exists())
+        self.assertTrue(self.node_b.acquire(self.file))
+
+    def test_expired_lease_is_reclaimed(self):
+        self.assertTrue(self.node_a.acquire(self.file))
+        self.expire(self.file)
+
+        self.assertTrue(self.node_b.acquire(self.file))
+        self.assertTrue(self.node_b.is_held(self.file))
+        self.assertFalse(self.node_a.is_held(self.file))
+        self.assertEqual(list(self.node_a.path(self.file).parent.glob('*.expired')), [])
+
+        # Releasing a lost lease leaves the new owner's lease alone
+        self.node_a.release(self.file)
+        self.assertEqual(self.node_a.owner_of(self.file), 'node-b')
+
+    def test_heartbeat_keeps_lease_alive(self):
+        self.assertTrue(self.node_a.acquire(self.file))
+        self.expire(self.file)
+        self.node_a.heartbeat()
+        self.assertFalse(self.node_b.acquire(self.file))
+
+    def test_heartbeat_drops_lost_leases(self):
+        self.assertTrue(self.node_a.acquire(self.file))
+        self.expire(self.file)
+        self.assertTrue(self.node_b.acquire(self.file))
+
+        with self.assertLogs('reencode_job.lease', 'ERROR'):
+            self.node_a.heartbeat()
+        self.assertFalse(self.node_a.is_held(self.file))
+        self.assertTrue(self.node_b.is_held(self.file))
+
+    def test_close_releases_leases(self):
+        self.assertTrue(self.node_a.acquire(self.file))
+        self.node_a.close()
+        self.assertTrue(self.node_b.acquire(self.file))
+
+    def test_leases_are_shared_across_mount_points(self):
+        node_c = LeaseManager(self.lease_dir, ttl=60, heartbeat_interval=3600, owner='node-c',
+                              library_root=Path('/mnt/library'))
+        node_d = LeaseManager(self.lease_dir, ttl=60, heartbeat_interval=3600, owner='node-d',
+                              library_root=Path('/media/share'))
+        try:
+            self.assertTrue(node_c.acquire(Path('/mnt/library/Author/Title.mkv')))
+            self.assertFalse(node_d.acquire(Path('/media/share/Author/Title.mkv')))
+            self.assertEqual(node_d.owner_of(Path('/media/share/Author/Title.mkv')), 'node-c')
+        finally:
+            node_c.close()
+            node_d.close()
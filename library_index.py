@@ -0,0 +1,189 @@
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+from filechecker import check_file_ext
+
+logger = logging.getLogger('reencode_job.library_index')
+
+# Directories modified this recently may still change within the same mtime tick
+MTIME_SAFETY_MARGIN_NS = 2_000_000_000
+
+
+@dataclass
+class IndexDiff:
+    """Changes found in the content path since the previous scan"""
+    added: list[Path] = field(default_factory=list)
+    modified: list[Path] = field(default_factory=list)
+    removed: list[Path] = field(default_factory=list)
+    unchanged: list[Path] = field(default_factory=list)
+
+    ext_summary: Counter = field(default_factory=Counter)
+    """Extensions skipped in the directories that had to be listed"""
+    scanned_directories: int = 0
+    skipped_directories: int = 0
+
+    @property
+    def changed(self) -> list[Path]:
+        return self.added + self.modified
+
+    @property
+    def all_files(self) -> list[Path]:
+        return self.unchanged + self.added + self.modified
+
+
+class LibraryIndex:
+    """Persistent index of the scanned tree
+
+    Stores every directory mtime and every video file stat so that rescans only list
+    the directories whose content changed. Note that in-place modifications of a file
+    don't change its parent directory mtime, those are caught by the watcher instead.
+    """
+
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Scans run in the discovery thread, one at a time
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+
+        with self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS directories ('
+                             'path TEXT PRIMARY KEY, '
+                             'parent TEXT, '
+                             'mtime_ns INTEGER NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                             'path TEXT PRIMARY KEY, '
+                             'directory TEXT NOT NULL, '
+                             'size INTEGER NOT NULL, '
+                             'mtime_ns INTEGER NOT NULL, '
+                             'inode INTEGER NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_directory ON files (directory)')
+
+    def close(self):
+        self._db.close()
+
+    def _load(self, root: Path):
+        prefix = str(root).rstrip(os.sep) + os.sep
+        args = (str(root), len(prefix), prefix)
+
+        directories: dict[str, int] = {}
+        subdirectories: defaultdict[str, list[str]] = defaultdict(list)
+        for path, parent, mtime_ns in self._db.execute(
+                'SELECT path, parent, mtime_ns FROM directories WHERE path = ? OR substr(path, 1, ?) = ?', args):
+            directories[path] = mtime_ns
+            subdirectories[parent].append(path)
+
+        files: defaultdict[str, dict[str, tuple[int, int, int]]] = defaultdict(dict)
+        for path, directory, size, mtime_ns, inode in self._db.execute(
+                'SELECT path, directory, size, mtime_ns, inode FROM files '
+                'WHERE directory = ? OR substr(directory, 1, ?) = ?', args):
+            files[directory][path] = (size, mtime_ns, inode)
+
+        return directories, subdirectories, files
+
+    def rescan(self, root: Path, on_file: Optional[Callable[[Path, bool], None]] = None) -> IndexDiff:
+        """Walk the content path, only listing directories that changed since the previous scan
+
+        on_file is called with every file as soon as it is found along with whether it changed.
+        """
+        diff = IndexDiff()
+        on_file = on_file or (lambda *_: None)
+        indexed_dirs, indexed_subdirs, indexed_files = self._load(root)
+        visited: set[str] = set()
+        now_ns = time.time_ns()
+
+        with self._db:
+            stack = [str(root)]
+            while stack:
+                directory = stack.pop()
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                visited.add(directory)
+
+                if indexed_dirs.get(directory) == mtime_ns:
+                    diff.skipped_directories += 1
+                    for path in map(Path, indexed_files[directory]):
+                        diff.unchanged.append(path)
+                        on_file(path, False)
+                    stack.extend(reversed(indexed_subdirs[directory]))
+                    continue
+
+                diff.scanned_directories += 1
+                subdirectories = self.__scan_directory(directory, indexed_files[directory], diff, on_file)
+                if subdirectories is None:
+                    # Keep the previous state so the directory gets listed again next time
+                    for path in map(Path, indexed_files[directory]):
+                        diff.unchanged.append(path)
+                        on_file(path, False)
+                    stack.extend(reversed(indexed_subdirs[directory]))
+                    continue
+                stack.extend(reversed(subdirectories))
+
+                if now_ns - mtime_ns < MTIME_SAFETY_MARGIN_NS:
+                    mtime_ns = -1
+                self._db.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                                 (directory, os.path.dirname(directory), mtime_ns))
+
+            for directory in indexed_dirs.keys() - visited:
+                diff.removed.extend(map(Path, indexed_files[directory]))
+                self._db.execute('DELETE FROM directories WHERE path = ?', (directory,))
+                self._db.execute('DELETE FROM files WHERE directory = ?', (directory,))
+
+        return diff
+
+    def __scan_directory(self,
+                         directory: str,
+                         indexed: dict[str, tuple[int, int, int]],
+                         diff: IndexDiff,
+                         on_file: Callable[[Path, bool], None]) -> Optional[list[str]]:
+        subdirectories = []
+        seen = set()
+
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError as e:
+            logger.warning('Unable to list "%s": %s', directory, e)
+            return None
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+                continue
+
+            path = Path(entry.path)
+            is_valid, ext = check_file_ext(path)
+            if not is_valid:
+                diff.ext_summary.update((ext,))
+                continue
+
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            seen.add(entry.path)
+
+            previous = indexed.get(entry.path)
+            if previous == key:
+                diff.unchanged.append(path)
+                on_file(path, False)
+                continue
+
+            (diff.added if previous is None else diff.modified).append(path)
+            on_file(path, True)
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                             (entry.path, directory, *key))
+
+        for path in indexed.keys() - seen:
+            diff.removed.append(Path(path))
+            self._db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+        return subdirectories
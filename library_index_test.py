@@ -0,0 +1,89 @@
+import os
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from library_index import LibraryIndex
+
+
+class LibraryIndexTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.root = self.tmp_path / 'library'
+        self.index = LibraryIndex(self.tmp_path / 'library.sqlite')
+
+        (self.root / 'a' / 'b').mkdir(parents=True)
+        (self.root / 'c').mkdir()
+        self.files = [self.create('a/one.mp4'), self.create('a/b/two.mkv'), self.create('c/three.avi')]
+        self.create('a/notes.txt')
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    def create(self, name: str, size: int = 10) -> Path:
+        path = self.root / name
+        path.write_bytes(b'\0' * size)
+        self.age(path)
+        return path
+
+    @staticmethod
+    def age(path: Path):
+        # Move recent mtimes out of the index safety margin
+        stat = path.stat()
+        if time.time_ns() - stat.st_mtime_ns < 5_000_000_000:
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10_000_000_000))
+
+    def age_tree(self):
+        for root, _, _ in os.walk(self.root):
+            self.age(Path(root))
+
+    def test_first_rescan_adds_every_video_file(self):
+        self.age_tree()
+        diff = self.index.rescan(self.root)
+        self.assertCountEqual(diff.added, self.files)
+        self.assertEqual(diff.ext_summary['.txt'], 1)
+        self.assertEqual(diff.skipped_directories, 0)
+
+    def test_rescan_skips_unchanged_directories(self):
+        self.age_tree()
+        self.index.rescan(self.root)
+        diff = self.index.rescan(self.root)
+        self.assertEqual(diff.changed, [])
+        self.assertCountEqual(diff.unchanged, self.files)
+        self.assertEqual(diff.scanned_directories, 0)
+        self.assertEqual(diff.skipped_directories, 4)
+
+    def test_rescan_reports_added_modified_and_removed_files(self):
+        self.age_tree()
+        self.index.rescan(self.root)
+
+        new_file = self.create('a/b/four.mp4')
+        self.files[0].unlink()
+        self.create('c/three.avi.part', size=20).replace(self.files[2])
+        self.age_tree()
+
+        diff = self.index.rescan(self.root)
+        self.assertEqual(diff.added, [new_file])
+        self.assertEqual(diff.removed, [self.files[0]])
+        self.assertEqual(diff.modified, [self.files[2]])
+        self.assertEqual(diff.scanned_directories, 3)
+
+    def test_rescan_reports_removed_directory(self):
+        self.age_tree()
+        self.index.rescan(self.root)
+
+        self.files[1].unlink()
+        (self.root / 'a' / 'b').rmdir()
+        self.age_tree()
+
+        diff = self.index.rescan(self.root)
+        self.assertEqual(diff.removed, [self.files[1]])
+        self.assertEqual(self.index.rescan(self.root).removed, [])
+
+    def test_rescan_lists_recently_modified_directory_again(self):
+        self.index.rescan(self.root)
+        diff = self.index.rescan(self.root)
+        self.assertEqual(diff.skipped_directories, 0)
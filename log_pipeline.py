@@ -0,0 +1,129 @@
+import atexit
+import logging
+import sys
+import threading
+from collections import deque
+from json import dumps as dump_json
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from queue import SimpleQueue
+from typing import Optional
+
+from tqdm import tqdm
+
+import colorized_logger
+from config import LOG_MESSAGE_FORMAT, FFMPEG_LOG_LINES
+
+CUSTOM_LEVELS = ('PROGRESS', 'SKIP', 'DESTRUCTIVE', 'STOP', 'ROLLBACK')
+
+
+class FFmpegLog:
+    """Last lines written by ffmpeg on stderr
+
+    Lines are kept in memory rather than logged as they come, the buffer is written to the
+    log in a single record when the encode fails or in verbose mode.
+    """
+
+    def __init__(self, max_lines: int = FFMPEG_LOG_LINES):
+        self.dropped = 0
+        """Number of lines that didn't fit in the buffer since the last flush"""
+        self._lines: deque[str] = deque(maxlen=max_lines)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lines)
+
+    def append(self, line: str):
+        with self._lock:
+            if len(self._lines) == self._lines.maxlen:
+                self.dropped += 1
+            self._lines.append(line)
+
+    def read(self, stream, prefix: str = ''):
+        """Buffer the lines of a stderr pipe until it is closed"""
+        for line in stream:
+            self.append(prefix + line.decode(errors='replace').rstrip())
+
+    def clear(self):
+        with self._lock:
+            self._lines.clear()
+            self.dropped = 0
+
+    def flush(self, logger: logging.Logger, level: int):
+        with self._lock:
+            lines, dropped = list(self._lines), self.dropped
+            self._lines.clear()
+            self.dropped = 0
+        if lines:
+            logger.log(level, '[FFMPEG] Last %d lines of output%s:\n%s', len(lines),
+                       f' ({dropped} earlier lines dropped)' if dropped else '', '\n'.join(lines))
+
+
+class TqdmHandler(logging.StreamHandler):
+    """Write records above the progress bars instead of through them"""
+
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record), file=self.stream)
+            self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue records as they are, leaving their formatting to the handlers of the listener
+
+    QueueHandler formats the message on the calling thread and drops exc_info, which would
+    keep the JSON events from carrying the exception. Records don't leave the process, and
+    the arguments of the records aren't modified once logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, fields passed in the event extra are added to it"""
+
+    def format(self, record):
+        event = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        event.update(getattr(record, 'event', {}))
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+        return dump_json(event, default=str)
+
+
+def start_logging(log_file: Path, is_verbose: bool, event_log: Optional[Path] = None) -> QueueListener:
+    """Log through a queue so that formatting and file writes happen on a background thread"""
+    for level in CUSTOM_LEVELS:
+        logging.addLevelName(getattr(colorized_logger, level), level)
+
+    fh = logging.FileHandler(filename=log_file, mode='w', encoding='utf-8')
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(logging.Formatter(LOG_MESSAGE_FORMAT))
+
+    ch = TqdmHandler(sys.stdout)
+    ch.setLevel(logging.DEBUG if is_verbose else logging.INFO)
+    ch.setFormatter(colorized_logger.ColoredFormatter(LOG_MESSAGE_FORMAT))
+
+    handlers = [fh, ch]
+    if event_log is not None:
+        eh = logging.FileHandler(filename=event_log, mode='a', encoding='utf-8')
+        eh.setLevel(logging.INFO)
+        eh.setFormatter(JsonFormatter())
+        handlers.append(eh)
+
+    queue = SimpleQueue()
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    logger = logging.getLogger('reencode_job')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(DeferredQueueHandler(queue))
+    listener.start()
+    # Records still queued are written before exiting
+    atexit.register(listener.stop)
+    return listener
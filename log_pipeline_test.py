@@ -0,0 +1,77 @@
+import atexit
+import io
+import logging
+from contextlib import redirect_stdout
+from json import loads as load_json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from log_pipeline import FFmpegLog, JsonFormatter, start_logging
+
+
+class FFmpegLogTest(TestCase):
+    def test_only_last_lines_are_kept(self):
+        ffmpeg_log = FFmpegLog(max_lines=3)
+        ffmpeg_log.read(io.BytesIO(b''.join(f'line {i}\n'.encode() for i in range(5))))
+        self.assertEqual((len(ffmpeg_log), ffmpeg_log.dropped), (3, 2))
+
+        logger = logging.getLogger('reencode_job.test')
+        with self.assertLogs(logger, logging.ERROR) as logs:
+            ffmpeg_log.flush(logger, logging.ERROR)
+        self.assertEqual(logs.records[0].getMessage().splitlines(),
+                         ['[FFMPEG] Last 3 lines of output (2 earlier lines dropped):', 'line 2', 'line 3', 'line 4'])
+        self.assertEqual((len(ffmpeg_log), ffmpeg_log.dropped), (0, 0))
+
+    def test_empty_log_is_not_flushed(self):
+        logger = logging.getLogger('reencode_job.test')
+        with self.assertNoLogs(logger):
+            FFmpegLog().flush(logger, logging.ERROR)
+
+
+class LoggingTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.logger = logging.getLogger('reencode_job')
+        self.handlers = list(self.logger.handlers)
+
+    def tearDown(self):
+        for handler in self.logger.handlers[len(self.handlers):]:
+            self.logger.removeHandler(handler)
+        self.tmp_dir.cleanup()
+
+    def test_json_formatter(self):
+        record = logging.LogRecord('reencode_job.worker', logging.INFO, __file__, 1, 'Encoded %s', ('a.mkv',), None)
+        record.event = {'event': 'encoded', 'path': Path('a.mkv')}
+        event = load_json(JsonFormatter().format(record))
+        self.assertEqual({key: event[key] for key in ('level', 'logger', 'message', 'event', 'path')},
+                         {'level': 'INFO', 'logger': 'reencode_job.worker', 'message': 'Encoded a.mkv',
+                          'event': 'encoded', 'path': 'a.mkv'})
+
+    def test_records_are_written_by_the_listener(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            listener = start_logging(self.root / 'job.log', False, self.root / 'events.jsonl')
+        atexit.unregister(listener.stop)
+        worker_logger = logging.getLogger('reencode_job.worker')
+        worker_logger.debug('debug details')
+        worker_logger.info('Skipped', extra={'event': {'event': 'skipped', 'path': '/library/a.mkv'}})
+        try:
+            raise ValueError('boom')
+        except ValueError as e:
+            worker_logger.exception('Unhandled exception', exc_info=e)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+        log = (self.root / 'job.log').read_text(encoding='utf-8')
+        self.assertIn('debug details', log)
+        self.assertIn('ValueError: boom', log)
+        self.assertNotIn('debug details', output.getvalue())
+        self.assertIn('Skipped', output.getvalue())
+        event, error = map(load_json, (self.root / 'events.jsonl').read_text(encoding='utf-8').splitlines())
+        self.assertEqual((event['message'], event['event'], event['path']), ('Skipped', 'skipped', '/library/a.mkv'))
+        self.assertNotIn('exception', event)
+        self.assertIn('ValueError: boom', error['exception'])
+        self.assertEqual(error['message'], 'Unhandled exception')
@@ -1,18 +1,21 @@
 import logging
-import sys
 from argparse import ArgumentParser
 from datetime import datetime
-from os.path import join
 from pathlib import Path
 from signal import signal, SIGINT, SIGTERM
-from time import sleep
 
 from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
 
 import colorized_logger
 from app import App
-from config import LOG_LOCATION, LOG_DATE_FORMAT, LOG_MESSAGE_FORMAT, STOP_FILE
+from config import LOG_LOCATION, LOG_DATE_FORMAT, PREFETCH_DEPTH, MAX_CONCURRENT_JOBS, QUEUE_ORDER, QUEUE_WINDOW, \
+    PREDICTION_ACTION, METRICS_PORT, LEASE_DIR, CONTROL_PORT, STAGING_DIR, EVENT_LOG_FILE
+from control_plane import ControlPlane
+from log_pipeline import start_logging
+from metrics import MetricsServer
+from prefetcher import Prefetcher
+from priority import QueueOrder, RankedQueue
+from scheduler import Scheduler
 from worker import Worker
 
 if __name__ == '__main__':
@@ -40,57 +43,131 @@ if __name__ == '__main__':
                         help='Force reencoding all files')
     parser.add_argument('-w', '--watch', action='store_true',
                         help='Watch for new files after processing all files instead of exiting')
-    app = App(parser.parse_args())
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always probe files with ffprobe instead of using the metadata cache')
+    parser.add_argument('--no-index', action='store_true',
+                        help='List every directory on each scan instead of using the library index')
+    parser.add_argument('--no-journal', action='store_true',
+                        help='Start over on restart instead of resuming the interrupted pass')
+    parser.add_argument('--retry-all', action='store_true',
+                        help='Retry files whose previous encode failed or did not save space '
+                             'before their retry backoff expires')
+    parser.add_argument('--lookahead', type=int, default=PREFETCH_DEPTH,
+                        help='number of upcoming files to probe ahead of the encoder')
+    parser.add_argument('-j', '--jobs', type=int, default=MAX_CONCURRENT_JOBS,
+                        help='number of files to encode concurrently')
+    parser.add_argument('--order', choices=[order.value for order in QueueOrder], default=QUEUE_ORDER,
+                        help='order in which files are encoded, savings processes files expected '
+                             'to save the most bytes per encode second first')
+    parser.add_argument('--order-window', type=int, default=QUEUE_WINDOW,
+                        help='number of probed files ranked at once, 0 ranks the whole pass')
+    parser.add_argument('--prediction', choices=['off', 'skip', 'deprioritize'], default=PREDICTION_ACTION,
+                        help='skip or deprioritize files whose similar files did not save enough space')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve OpenMetrics on this port, 0 disables the endpoint')
+    parser.add_argument('--split', action='store_true',
+                        help='encode long files as segments in parallel when using the CPU encoders')
+    parser.add_argument('--control-port', type=int, default=CONTROL_PORT,
+                        help='serve the control plane API on this port and keep running after the pass until '
+                             'drained, 0 disables the API')
+    parser.add_argument('--shared', type=Path, nargs='?', const=LEASE_DIR, metavar='LEASE_DIR',
+                        help='coordinate with other nodes processing the same library through per-file leases, '
+                             'relative lease directories are resolved against the content path')
+    parser.add_argument('--staging', type=Path, nargs='?', const=STAGING_DIR, metavar='STAGING_DIR',
+                        help='copy inputs and write outputs on local scratch space, the next input is copied '
+                             'while the current one encodes')
+    parser.add_argument('--tune', action='store_true',
+                        help='pick the fastest encoder preset and constant quality reaching the size target from '
+                             'sample encodes, decisions are reused for similar files')
+    parser.add_argument('--dedup', action='store_true',
+                        help='reuse the output of a previous encode for files with the same content instead of '
+                             'encoding them again')
+    parser.add_argument('--event-log', type=Path, default=EVENT_LOG_FILE, metavar='EVENT_LOG',
+                        help='append log events as JSON lines to this file')
+    args = parser.parse_args()
+    start_logging(Path(LOG_LOCATION) / datetime.now().strftime(LOG_DATE_FORMAT), args.verbose, args.event_log)
+    logger = logging.getLogger('reencode_job')
+
+    app = App(args)
     signal(SIGINT, app.signal_handler)
     signal(SIGTERM, app.signal_handler)
 
-    fh = logging.FileHandler(filename=join(LOG_LOCATION,
-                                           datetime.now().strftime(LOG_DATE_FORMAT)),
-                             mode='w',
-                             encoding='utf-8')
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(logging.Formatter(LOG_MESSAGE_FORMAT))
+    if app.args.metrics_port:
+        MetricsServer(app.args.metrics_port).start()
+    control_plane = ControlPlane(app, app.args.control_port).start() if app.args.control_port else None
 
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging.DEBUG if app.args.is_verbose_enabled else logging.INFO)
-    ch.setFormatter(colorized_logger.ColoredFormatter(LOG_MESSAGE_FORMAT))
+    changed_files = None
+    while True:
+        with (tqdm(total=0, unit='file', desc='Files processed') as progress,
+              Prefetcher(app, app.discover(changed_files), app.args.prefetch_depth) as prefetcher,
+              Scheduler(app, app.args.max_jobs, on_done=lambda _: progress.update()) as scheduler):
+            if control_plane is not None:
+                control_plane.attach(scheduler)
 
-    logger = logging.getLogger('reencode_job')
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+            is_pass_complete = False
+            for job in RankedQueue(prefetcher, app.args.queue_order, app.args.queue_window):
+                # Total is updated live while the discovery is still running
+                if progress.total != len(app.files):
+                    progress.total = len(app.files)
+                    progress.refresh()
 
-    def add_log_level(lvl): return logging.addLevelName(getattr(colorized_logger, lvl), lvl)
-    add_log_level('PROGRESS')
-    add_log_level('SKIP')
-    add_log_level('DESTRUCTIVE')
-    add_log_level('STOP')
-    add_log_level('ROLLBACK')
+                if job.is_skipped:
+                    # Skipped jobs don't need to wait for an encode slot
+                    try:
+                        Worker(app, job).work()
+                    except Exception as e:
+                        logger.exception('Unhandled exception', exc_info=e)
+                    progress.update()
+                else:
+                    scheduler.submit(job)
 
-    while True:
-        app.init_job()
-
-        with logging_redirect_tqdm(loggers=[logger]):
-            for i, (input_filename, output_filename) in tqdm(enumerate(zip(app.files, app.outs), start=1),
-                                                             total=len(app.files),
-                                                             unit='file',
-                                                             desc='Files processed'):
-                worker = Worker(app, i, input_filename, output_filename)
-                try:
-                    worker.work()
-                except Exception as e:
-                    logger.exception('Unhandled exception', exc_info=e)
-
-                if STOP_FILE.exists():
-                    logger.log(colorized_logger.STOP, 'Stop file found, exiting...')
+                if app.is_stop_requested:
+                    logger.log(colorized_logger.STOP, 'Stop requested, waiting for running jobs to finish...')
+                    scheduler.stop()
                     break
 
                 if app.is_interrupted:
                     logger.log(colorized_logger.STOP, 'Interrupted, exiting...')
+                    scheduler.stop()
                     break
+            else:
+                is_pass_complete = True
+
+            if control_plane is not None:
+                if app.is_interrupted or app.is_stop_requested:
+                    pass
+                elif app.args.is_watch_enabled:
+                    # Files submitted during the pass are handed to its scheduler before it is detached
+                    control_plane.wait(lambda: control_plane.is_idle or app.is_interrupted or app.is_stop_requested)
+                else:
+                    logger.info('Waiting for jobs from the control plane...')
+                    control_plane.wait(lambda: app.is_interrupted or app.is_stop_requested)
+                    scheduler.stop()
+                control_plane.detach()
+
+        for stats in (app.metadata_cache, app.predictor):
+            if stats is not None:
+                stats.log_stats()
+                stats.reset_stats()
+
+        if app.journal is not None and is_pass_complete and not app.is_interrupted:
+            # Every file of the pass was processed, nothing to resume anymore
+            app.journal.finish()
 
         if not app.args.is_watch_enabled or app.is_interrupted:
             break
 
-        logger.info("Waiting 30 seconds...")
-        sleep(30)
+        logger.info("Waiting for changes...")
+        # Files submitted through the control plane wake the watcher and start a pass without changed files
+        changed_files = app.watcher.wait(lambda: app.is_interrupted or app.is_stop_requested
+                                         or (control_plane is not None and not control_plane.is_idle))
+        if app.is_stop_requested:
+            logger.log(colorized_logger.STOP, 'Stop requested, exiting...')
+            break
+
+    if control_plane is not None:
+        control_plane.close()
+    if app.leases is not None:
+        app.leases.close()
+    if app.staging is not None:
+        app.staging.close()
@@ -0,0 +1,168 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from json import dumps as dump_json, loads as load_json
+from pathlib import Path
+from typing import Iterator, Optional
+
+from colorized_logger import SKIP
+from config import METADATA_CACHE_MAX_ENTRIES
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata, probe_file
+
+logger = logging.getLogger('reencode_job.metadata_cache')
+
+
+def serialize_metadata(metadata: FileMetadata) -> str:
+    data = asdict(metadata)
+    data['filepath'] = str(metadata.filepath)
+    return dump_json(data)
+
+
+def deserialize_metadata(data: str) -> FileMetadata:
+    fields: dict = load_json(data)
+    return FileMetadata(filepath=Path(fields['filepath']),
+                        file_size=fields['file_size'],
+                        duration=fields['duration'],
+                        audio=AudioMetadata(**fields['audio']),
+                        video=VideoMetadata(**fields['video']),
+                        tags=fields['tags'])
+
+
+class MetadataCache:
+    """On-disk cache of parsed ffprobe results
+
+    Entries are keyed by path and only considered valid as long as the file size,
+    mtime and inode match the ones recorded when the file was probed.
+    """
+
+    def __init__(self, db_path: Path, max_entries: int = METADATA_CACHE_MAX_ENTRIES):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                             'path TEXT PRIMARY KEY, '
+                             'size INTEGER NOT NULL, '
+                             'mtime_ns INTEGER NOT NULL, '
+                             'inode INTEGER NOT NULL, '
+                             'data TEXT NOT NULL, '
+                             'accessed_at REAL NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS metadata_accessed_at ON metadata (accessed_at)')
+            self._size: int = self._db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+
+    def __len__(self):
+        return self._size
+
+    def get(self, file_path: Path, stat: os.stat_result) -> Optional[FileMetadata]:
+        """Return the cached metadata if the file hasn't changed since it was probed"""
+        key = str(file_path)
+        with self._lock, self._db:
+            row = self._db.execute('SELECT size, mtime_ns, inode, data FROM metadata WHERE path = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            size, mtime_ns, inode, data = row
+            if (size, mtime_ns, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                self._db.execute('DELETE FROM metadata WHERE path = ?', (key,))
+                self._size -= 1
+                self.invalidations += 1
+                self.misses += 1
+                return None
+
+            self._db.execute('UPDATE metadata SET accessed_at = ? WHERE path = ?', (time.time(), key))
+            self.hits += 1
+        return deserialize_metadata(data)
+
+    def put(self, file_path: Path, stat: os.stat_result, metadata: FileMetadata):
+        key = str(file_path)
+        with self._lock, self._db:
+            is_new = self._db.execute('SELECT 1 FROM metadata WHERE path = ?', (key,)).fetchone() is None
+            self._db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                              serialize_metadata(metadata), time.time()))
+            if is_new:
+                self._size += 1
+            if self._size > self.max_entries:
+                self.__evict()
+
+    def __evict(self):
+        # Evict a bit more than needed so we don't run an eviction on every insert
+        count = self._size - self.max_entries + max(1, self.max_entries // 20)
+        self._db.execute('DELETE FROM metadata WHERE path IN '
+                         '(SELECT path FROM metadata ORDER BY accessed_at, rowid LIMIT ?)', (count,))
+        evicted = self._db.execute('SELECT changes()').fetchone()[0]
+        self._size -= evicted
+        self.evictions += evicted
+        logger.debug('Evicted %d entries from metadata cache', evicted)
+
+    def invalidate(self, file_path: Path):
+        with self._lock, self._db:
+            cursor = self._db.execute('DELETE FROM metadata WHERE path = ?', (str(file_path),))
+            if cursor.rowcount:
+                self._size -= cursor.rowcount
+                self.invalidations += cursor.rowcount
+
+    def entries(self, prefix: Optional[Path] = None) -> Iterator[FileMetadata]:
+        """Cached metadata of every file, or only the ones of the given file or directory"""
+        query = 'SELECT data FROM metadata'
+        params = ()
+        if prefix:
+            query += ' WHERE path = ? OR substr(path, 1, ?) = ?'
+            directory = str(prefix).rstrip(os.sep) + os.sep
+            params = (str(prefix), len(directory), directory)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return (deserialize_metadata(data) for data, in rows)
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM metadata')
+            self._size = 0
+
+    def probe(self, file_path: Path) -> Optional[FileMetadata]:
+        """Return the file metadata from the cache, falling back to ffprobe on cache miss"""
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            logger.log(SKIP, "File doesn't exist anymore")
+            return None
+
+        if (metadata := self.get(file_path, stat)) is not None:
+            logger.debug('Metadata cache hit for "%s"', file_path)
+            return metadata
+
+        metadata = probe_file(file_path)
+        if metadata is not None:
+            self.put(file_path, stat, metadata)
+        return metadata
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        logger.info('Metadata cache: %d hits, %d misses (hit rate: %.1f%%), '
+                    '%d invalidations, %d evictions, %d entries',
+                    self.hits, self.misses, self.hits / total * 100 if total else 0,
+                    self.invalidations, self.evictions, self._size)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,69 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from metadata_cache import MetadataCache, serialize_metadata, deserialize_metadata
+
+
+class MetadataCacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.cache = MetadataCache(self.tmp_path / 'cache' / 'metadata.sqlite', max_entries=10)
+
+        self.video = self.tmp_path / 'video.mp4'
+        self.video.write_bytes(b'\0' * 123)
+        self.metadata = FileMetadata(
+            self.video,
+            123,
+            30.0,
+            AudioMetadata("aac", 48_000, 2, 192_000, {}),
+            VideoMetadata("hevc", 1920, 1080, "16:9", 30.0, 8000, {'language': 'und'}),
+            {}
+        )
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def test_serialize_roundtrip(self):
+        self.assertEqual(deserialize_metadata(serialize_metadata(self.metadata)), self.metadata)
+
+    def test_probe_uses_cache_on_second_call(self):
+        with patch('metadata_cache.probe_file', return_value=self.metadata) as probe_file:
+            self.assertEqual(self.cache.probe(self.video), self.metadata)
+            self.assertEqual(self.cache.probe(self.video), self.metadata)
+            probe_file.assert_called_once()
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_probe_invalidates_modified_file(self):
+        with patch('metadata_cache.probe_file', return_value=self.metadata) as probe_file:
+            self.cache.probe(self.video)
+            self.video.write_bytes(b'\0' * 456)
+            self.cache.probe(self.video)
+            self.assertEqual(probe_file.call_count, 2)
+        self.assertEqual(self.cache.invalidations, 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_probe_does_not_cache_failures(self):
+        with patch('metadata_cache.probe_file', return_value=None) as probe_file:
+            self.assertIsNone(self.cache.probe(self.video))
+            self.assertIsNone(self.cache.probe(self.video))
+            self.assertEqual(probe_file.call_count, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_put_evicts_least_recently_used(self):
+        stat = self.video.stat()
+        for i in range(11):
+            self.cache.put(Path(f'file_{i}.mp4'), stat, self.metadata)
+        self.assertLessEqual(len(self.cache), 10)
+        self.assertGreater(self.cache.evictions, 0)
+        self.assertIsNone(self.cache.get(Path('file_0.mp4'), stat))
+        self.assertIsNotNone(self.cache.get(Path('file_10.mp4'), stat))
+
+    def test_invalidate(self):
+        self.cache.put(self.video, self.video.stat(), self.metadata)
+        self.cache.invalidate(self.video)
+        self.assertIsNone(self.cache.get(self.video, self.video.stat()))
@@ -0,0 +1,288 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Optional
+
+from config import METRICS_LATENCY_BUCKETS
+
+logger = logging.getLogger('reencode_job.metrics')
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    """Base class of a metric family, children are created per label values"""
+    type_name = 'unknown'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+        self._lock = threading.Lock()
+        self._children: dict[tuple[str, ...], object] = {}
+        if not self.label_names:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values) -> 'Metric':
+        values = tuple(map(str, values))
+        if len(values) != len(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, got {values}')
+        with self._lock:
+            if values not in self._children:
+                self._children[values] = self._new_child()
+            return self._children[values]
+
+    def _samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """Yield (suffix, label names, label values, value) tuples"""
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f'# TYPE {self.name} {self.type_name}',
+                 f'# HELP {self.name} {self.documentation}']
+        for suffix, names, values, value in self._samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}')
+        return lines
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Compute the value when the metrics are collected"""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function:
+            try:
+                return self.function()
+            except Exception as e:
+                logger.debug('Unable to collect metric value', exc_info=e)
+                return math.nan
+        return self.value
+
+
+class Counter(Metric):
+    """Monotonically increasing value"""
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        if amount < 0:
+            raise ValueError('Counters can only be increased')
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in self._items():
+            yield '_total', self.label_names, values, child.get()
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+    def _samples(self):
+        for values, child in self._items():
+            yield '', self.label_names, values, child.get()
+
+
+class _Buckets:
+    def __init__(self, bounds: tuple[float, ...]):
+        self._lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 buckets: Iterable[float] = METRICS_LATENCY_BUCKETS):
+        bounds = sorted(set(buckets))
+        if not bounds or bounds[-1] != math.inf:
+            bounds.append(math.inf)
+        self.bounds = tuple(bounds)
+        super().__init__(name, documentation, label_names)
+
+    def _new_child(self):
+        return _Buckets(self.bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        names = self.label_names + ('le',)
+        for values, child in self._items():
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            for bound, bucket_count in zip(self.bounds, counts):
+                yield '_bucket', names, values + (_format_value(bound),), bucket_count
+            yield '_count', self.label_names, values, count
+            yield '_sum', self.label_names, values, total
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FILES_SCANNED = REGISTRY.register(Counter('reencode_files_scanned', 'Files found by the discovery'))
+FILES_PROBED = REGISTRY.register(Counter('reencode_files_probed', 'Files whose metadata was read'))
+FILES_SKIPPED = REGISTRY.register(Counter('reencode_files_skipped', 'Files skipped without encoding'))
+FILES_ENCODED = REGISTRY.register(Counter('reencode_files_encoded', 'Files successfully encoded'))
+FAILURES = REGISTRY.register(Counter('reencode_failures', 'Failed encodes by file check error',
+                                     ('error',)))
+BYTES_IN = REGISTRY.register(Counter('reencode_input_bytes', 'Size of the encoded input files'))
+BYTES_OUT = REGISTRY.register(Counter('reencode_output_bytes', 'Size of the produced output files'))
+BYTES_SAVED = REGISTRY.register(Counter('reencode_saved_bytes', 'Bytes saved by encodes smaller than their input'))
+ENCODE_SPEED = REGISTRY.register(Gauge('reencode_encode_speed', 'Current encode speed in x realtime',
+                                       ('slot',)))
+QUEUE_DEPTH = REGISTRY.register(Gauge('reencode_queue_depth', 'Jobs waiting in each queue', ('queue',)))
+STAGE_SECONDS = REGISTRY.register(Histogram('reencode_stage_seconds', 'Time spent in each stage of a job',
+                                            ('stage',)))
+
+
+def record_failure(errors):
+    """Count a failure once for each file check error flag of the job"""
+    flags = [flag.name for flag in type(errors) if flag in errors] or ['NONE']
+    for flag in flags:
+        FAILURES.labels(flag).inc()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logger.debug('%s - %s', self.address_string(), fmt % args)
+
+
+class MetricsServer:
+    """HTTP server exposing the registry on /metrics from a daemon thread"""
+
+    def __init__(self, port: int, host: str = '', registry: Registry = REGISTRY):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        logger.info('Serving metrics on port %d', self.port)
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,66 @@
+from unittest import TestCase
+from urllib.request import urlopen
+
+from filechecker import FileCheckError
+from metrics import Counter, Gauge, Histogram, MetricsServer, Registry, FAILURES, record_failure
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.register(Counter('files', 'Files'))
+        counter.inc()
+        counter.inc(2)
+        self.assertIn('files_total 3\n', self.registry.render())
+        with self.assertRaises(ValueError):
+            counter.inc(-1)
+
+    def test_gauge_with_labels(self):
+        gauge = self.registry.register(Gauge('depth', 'Depth', ('queue',)))
+        gauge.labels('encode').set(4)
+        gauge.labels('probe').set_function(lambda: 2.5)
+        rendered = self.registry.render()
+        self.assertIn('depth{queue="encode"} 4\n', rendered)
+        self.assertIn('depth{queue="probe"} 2.5\n', rendered)
+
+    def test_special_values(self):
+        gauge = self.registry.register(Gauge('speed', 'Speed', ('slot',)))
+        gauge.labels('0').set_function(lambda: 1 / 0)
+        gauge.labels('1').set(float('-inf'))
+        rendered = self.registry.render()
+        self.assertIn('speed{slot="0"} NaN\n', rendered)
+        self.assertIn('speed{slot="1"} -Inf\n', rendered)
+
+    def test_histogram(self):
+        histogram = self.registry.register(Histogram('latency', 'Latency', ('stage',), buckets=(1, 10)))
+        for value in (0.5, 5, 50):
+            histogram.labels('probe').observe(value)
+        rendered = self.registry.render()
+        self.assertIn('latency_bucket{stage="probe",le="1"} 1\n', rendered)
+        self.assertIn('latency_bucket{stage="probe",le="10"} 2\n', rendered)
+        self.assertIn('latency_bucket{stage="probe",le="+Inf"} 3\n', rendered)
+        self.assertIn('latency_count{stage="probe"} 3\n', rendered)
+        self.assertIn('latency_sum{stage="probe"} 55.5\n', rendered)
+
+    def test_render_ends_with_eof(self):
+        self.registry.register(Counter('files', 'Files'))
+        rendered = self.registry.render()
+        self.assertTrue(rendered.startswith('# TYPE files counter\n# HELP files Files\n'))
+        self.assertTrue(rendered.endswith('# EOF\n'))
+
+    def test_record_failure_by_flag(self):
+        before = FAILURES.labels('VIDEO_CODEC').get()
+        record_failure(FileCheckError.VIDEO_CODEC | FileCheckError.AUDIO_BITRATE)
+        self.assertEqual(FAILURES.labels('VIDEO_CODEC').get(), before + 1)
+
+    def test_server(self):
+        self.registry.register(Counter('files', 'Files')).inc()
+        server = MetricsServer(0, '127.0.0.1', self.registry).start()
+        try:
+            with urlopen(f'http://127.0.0.1:{server.port}/metrics') as response:
+                self.assertIn('openmetrics-text', response.headers['Content-Type'])
+                self.assertIn('files_total 1', response.read().decode())
+        finally:
+            server.close()
@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from datetime import datetime
+from enum import Enum
+from json import dumps as dump_json
+from pathlib import Path
+from typing import Optional
+
+from config import CRITERIAS, OUTCOME_CACHE_FILE, OUTCOME_RETRY_BACKOFF, OUTCOME_MAX_BACKOFF
+
+logger = logging.getLogger('reencode_job.outcome_cache')
+
+
+class Outcome(Enum):
+    """Results of an encode that are not worth retrying right away"""
+    FAILED = 'failed'
+    """ffmpeg exited with an error"""
+    LARGER = 'larger'
+    """The output was, or was projected to be, larger than the input"""
+    CORRUPT = 'corrupt'
+    """The output could not be verified"""
+
+
+@dataclass
+class OutcomeEntry:
+    """Stores the last unsuccessful outcome of a file"""
+    path: Path
+    outcome: Outcome
+    attempts: int
+    recorded_at: float
+    retry_at: float
+    detail: Optional[str]
+
+
+def criteria_hash() -> str:
+    """Fingerprint of the criterias, entries recorded with other criterias are ignored"""
+    return hashlib.sha256(dump_json(CRITERIAS, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class OutcomeCache:
+    """Persistent record of the files whose last encode was unsuccessful
+
+    Entries are keyed by path and only considered valid as long as the file size, mtime
+    and inode as well as the criterias match the ones recorded. The retry backoff doubles
+    with each unsuccessful attempt.
+    """
+
+    def __init__(self,
+                 db_path: Path,
+                 backoff: float = OUTCOME_RETRY_BACKOFF,
+                 max_backoff: float = OUTCOME_MAX_BACKOFF):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.criteria = criteria_hash()
+
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS outcomes ('
+                             'path TEXT PRIMARY KEY, '
+                             'size INTEGER NOT NULL, '
+                             'mtime_ns INTEGER NOT NULL, '
+                             'inode INTEGER NOT NULL, '
+                             'criteria TEXT NOT NULL, '
+                             'outcome TEXT NOT NULL, '
+                             'attempts INTEGER NOT NULL, '
+                             'recorded_at REAL NOT NULL, '
+                             'retry_at REAL NOT NULL, '
+                             'detail TEXT)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM outcomes').fetchone()[0]
+
+    def __identity(self, stat: os.stat_result):
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino, self.criteria
+
+    def get(self, file_path: Path, stat: Optional[os.stat_result] = None) -> Optional[OutcomeEntry]:
+        """Return the recorded outcome if the file should not be retried yet"""
+        key = str(file_path)
+        try:
+            stat = stat or file_path.stat()
+        except FileNotFoundError:
+            return None
+
+        with self._lock, self._db:
+            row = self._db.execute('SELECT size, mtime_ns, inode, criteria, outcome, attempts, recorded_at, '
+                                   'retry_at, detail FROM outcomes WHERE path = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            if tuple(row[:4]) != self.__identity(stat):
+                # File or criterias changed since the outcome was recorded
+                self._db.execute('DELETE FROM outcomes WHERE path = ?', (key,))
+                return None
+
+        outcome, attempts, recorded_at, retry_at, detail = row[4:]
+        if retry_at <= time.time():
+            return None
+        return OutcomeEntry(file_path, Outcome(outcome), attempts, recorded_at, retry_at, detail)
+
+    def record(self, file_path: Path, outcome: Outcome, detail: Optional[str] = None):
+        key = str(file_path)
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            return
+
+        identity = self.__identity(stat)
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute('SELECT size, mtime_ns, inode, criteria, attempts FROM outcomes '
+                                   'WHERE path = ?', (key,)).fetchone()
+            attempts = row[4] + 1 if row and tuple(row[:4]) == identity else 1
+            retry_at = now + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            self._db.execute('INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, *identity, outcome.value, attempts, now, retry_at, detail))
+        logger.debug('Recorded %s outcome for "%s", retrying after %s', outcome.value, file_path,
+                     datetime.fromtimestamp(retry_at).isoformat(timespec='seconds'))
+
+    def discard(self, file_path: Path):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM outcomes WHERE path = ?', (str(file_path),))
+
+    def entries(self, prefix: Optional[Path] = None) -> list[OutcomeEntry]:
+        query = 'SELECT path, outcome, attempts, recorded_at, retry_at, detail FROM outcomes'
+        params = ()
+        if prefix:
+            query += ' WHERE path = ? OR substr(path, 1, ?) = ?'
+            directory = str(prefix).rstrip(os.sep) + os.sep
+            params = (str(prefix), len(directory), directory)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY path', params).fetchall()
+        return [OutcomeEntry(Path(path), Outcome(outcome), *rest) for path, outcome, *rest in rows]
+
+    def clear(self, prefix: Optional[Path] = None) -> int:
+        """Remove every entry, or only the ones of the given file or directory"""
+        with self._lock, self._db:
+            if prefix:
+                directory = str(prefix).rstrip(os.sep) + os.sep
+                cursor = self._db.execute('DELETE FROM outcomes WHERE path = ? OR substr(path, 1, ?) = ?',
+                                          (str(prefix), len(directory), directory))
+            else:
+                cursor = self._db.execute('DELETE FROM outcomes')
+        return cursor.rowcount
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = ArgumentParser(description='Manage the files skipped because of a previous unsuccessful encode')
+    parser.add_argument('--db', type=Path, default=OUTCOME_CACHE_FILE, help='path to the outcome cache')
+    commands = parser.add_subparsers(dest='command', required=True)
+    list_parser = commands.add_parser('list', help='list recorded outcomes')
+    list_parser.add_argument('path', type=Path, nargs='?', help='only list entries of this file or directory')
+    clear_parser = commands.add_parser('clear', help='forget recorded outcomes so the files are retried')
+    clear_parser.add_argument('path', type=Path, nargs='?', help='only clear entries of this file or directory')
+    args = parser.parse_args(argv)
+
+    cache = OutcomeCache(args.db)
+    try:
+        if args.command == 'list':
+            for entry in cache.entries(args.path):
+                retry_at = datetime.fromtimestamp(entry.retry_at).isoformat(timespec='seconds')
+                print(f'{entry.outcome.value}\t{entry.attempts}\t{retry_at}\t{entry.path}'
+                      + (f'\t{entry.detail}' if entry.detail else ''))
+        else:
+            print(f'Cleared {cache.clear(args.path)} entries')
+    finally:
+        cache.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import io
+import os
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+import outcome_cache
+from outcome_cache import Outcome, OutcomeCache
+
+
+class OutcomeCacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.db_path = self.root / 'cache' / 'outcomes.sqlite'
+        self.cache = OutcomeCache(self.db_path, backoff=100, max_backoff=300)
+        self.video = self.root / 'videos' / 'video.mp4'
+        self.video.parent.mkdir()
+        self.video.write_bytes(b'\0' * 10)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def test_unknown_file(self):
+        self.assertIsNone(self.cache.get(self.video))
+
+    def test_recorded_file_is_skipped(self):
+        self.cache.record(self.video, Outcome.FAILED, 'return code 1')
+        entry = self.cache.get(self.video)
+        self.assertEqual(entry.outcome, Outcome.FAILED)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.detail, 'return code 1')
+
+    def test_modified_file_is_retried(self):
+        self.cache.record(self.video, Outcome.LARGER)
+        self.video.write_bytes(b'\0' * 20)
+        self.assertIsNone(self.cache.get(self.video))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_criteria_change_is_retried(self):
+        self.cache.record(self.video, Outcome.LARGER)
+        self.cache.criteria = 'other'
+        self.assertIsNone(self.cache.get(self.video))
+
+    def test_backoff_doubles_until_max(self):
+        now = time.time()
+        for attempts, delay in ((1, 100), (2, 200), (3, 300), (4, 300)):
+            with patch('outcome_cache.time.time', return_value=now):
+                self.cache.record(self.video, Outcome.CORRUPT)
+            entry = self.cache.get(self.video)
+            self.assertEqual(entry.attempts, attempts)
+            self.assertAlmostEqual(entry.retry_at - now, delay)
+
+    def test_expired_entry_is_retried(self):
+        with patch('outcome_cache.time.time', return_value=time.time() - 1000):
+            self.cache.record(self.video, Outcome.FAILED)
+        self.assertIsNone(self.cache.get(self.video))
+
+    def test_clear_directory(self):
+        other = self.root / 'videos_other.mp4'
+        other.write_bytes(b'\0')
+        self.cache.record(self.video, Outcome.FAILED)
+        self.cache.record(other, Outcome.FAILED)
+        self.assertEqual(self.cache.clear(self.root / 'videos'), 1)
+        self.assertEqual([entry.path for entry in self.cache.entries()], [other])
+
+    def test_cli(self):
+        self.cache.record(self.video, Outcome.LARGER, '20 bytes')
+        output = io.StringIO()
+        with redirect_stdout(output):
+            outcome_cache.main(['--db', str(self.db_path), 'list', str(self.video.parent)])
+            outcome_cache.main(['--db', str(self.db_path), 'clear'])
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('larger\t1\t'))
+        self.assertTrue(lines[0].endswith(f'{os.fspath(self.video)}\t20 bytes'))
+        self.assertEqual(lines[1], 'Cleared 1 entries')
@@ -0,0 +1,232 @@
+import copy
+import logging
+import sys
+from argparse import ArgumentParser
+from dataclasses import dataclass, field, asdict
+from json import dumps as dump_json, loads as load_json
+from pathlib import Path
+from typing import Iterable, Optional
+
+from config import CRITERIAS, ENCODE_SPEED_ESTIMATES, METADATA_CACHE_FILE
+from encoders import normalize_codec, target_codec
+from filechecker import FileCheckError
+from fileparser import FileMetadata
+from metadata_cache import MetadataCache
+from priority import CODEC_EFFICIENCY, DEFAULT_CODEC_EFFICIENCY, REFERENCE_PIXELS
+
+try:
+    import numpy as np
+except ImportError:  # Only needed to plan criteria changes
+    np = None
+
+logger = logging.getLogger('reencode_job.planner')
+
+SINGLE_ERRORS = [error for error in FileCheckError if error.name and error.value.bit_count() == 1]
+
+
+@dataclass
+class Plan:
+    """What a criteria set would cost on the files of the table"""
+    name: str
+    files: int
+    affected: int = 0
+    errors: dict[str, int] = field(default_factory=dict)
+    """Number of affected files per check error, a file can have several"""
+    lanes: dict[str, int] = field(default_factory=dict)
+    input_bytes: int = 0
+    """Size of the affected files"""
+    estimated_bytes_saved: int = 0
+    """Outputs estimated larger than their input are discarded and save nothing"""
+    estimated_encode_seconds: float = 0.0
+
+
+class MetadataTable:
+    """Columnar view of the probed metadata of a library"""
+
+    def __init__(self, entries: Iterable[FileMetadata]):
+        if np is None:
+            raise RuntimeError('Planning requires numpy, install it with "pip install numpy"')
+        entries = list(entries)
+        self.paths = [metadata.filepath for metadata in entries]
+
+        def column(values, dtype):
+            return np.fromiter(values, dtype=dtype, count=len(entries))
+
+        self.file_size = column((metadata.file_size for metadata in entries), np.int64)
+        self.duration = column((metadata.duration for metadata in entries), np.float64)
+        self.audio_codec = np.array([metadata.audio.codec for metadata in entries], dtype=object)
+        self.sample_rate = column((metadata.audio.sample_rate for metadata in entries), np.int64)
+        self.channels = column((metadata.audio.channels for metadata in entries), np.int64)
+        self.audio_bitrate = column((metadata.audio.bitrate for metadata in entries), np.int64)
+        self.video_codec = np.array([metadata.video.codec for metadata in entries], dtype=object)
+        self.width = column((metadata.video.width for metadata in entries), np.int64)
+        self.height = column((metadata.video.height for metadata in entries), np.int64)
+        self.frame_rate = column((metadata.video.frame_rate for metadata in entries), np.float64)
+        self.video_bitrate = column((metadata.video.bitrate for metadata in entries), np.int64)
+
+        # Codecs are mapped once per distinct value rather than once per file
+        codecs, inverse = np.unique(self.video_codec.astype(str), return_inverse=True)
+        self.normalized_video_codec = np.array([normalize_codec(codec) for codec in codecs], dtype=object)[inverse]
+        self.codec_efficiency = np.array([CODEC_EFFICIENCY.get(codec, DEFAULT_CODEC_EFFICIENCY)
+                                          for codec in codecs])[inverse]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def check(self, criterias: dict) -> 'np.ndarray':
+        """FileCheckError values of every file, the vectorized equivalent of check_file"""
+        errors = np.zeros(len(self), dtype=np.int64)
+
+        def flag(error: FileCheckError, mask):
+            errors[mask] |= error.value
+
+        audio, video = criterias['audio'], criterias['video']
+        if audio['codec']:
+            flag(FileCheckError.AUDIO_CODEC, self.audio_codec != audio['codec'])
+        if audio['sample_rate']:
+            flag(FileCheckError.AUDIO_SAMPLE_RATE, self.sample_rate > audio['sample_rate'])
+        if audio['channels']:
+            flag(FileCheckError.AUDIO_CHANNELS, self.channels > audio['channels'])
+        if audio['bitrate']:
+            flag(FileCheckError.AUDIO_BITRATE,
+                 (self.audio_bitrate == 0) | (self.audio_bitrate > audio['bitrate']['threshold']))
+
+        if codec := target_codec(criterias):
+            flag(FileCheckError.VIDEO_CODEC, self.normalized_video_codec != codec)
+        if resolution := video['resolution']:
+            is_portrait = self.width < self.height
+            width = np.where(is_portrait, self.height, self.width)
+            height = np.where(is_portrait, self.width, self.height)
+            flag(FileCheckError.VIDEO_RESOLUTION, (width > resolution[0]) | (height > resolution[1]))
+        if video['fps']:
+            flag(FileCheckError.VIDEO_FPS, self.frame_rate > video['fps'])
+        if video['bitrate']:
+            flag(FileCheckError.VIDEO_BITRATE,
+                 (self.video_bitrate == 0) | (self.video_bitrate > video['bitrate']['threshold']))
+        return errors
+
+    def estimate_output_size(self, errors: 'np.ndarray', criterias: dict) -> 'np.ndarray':
+        """Vectorized equivalent of priority.estimate_output_size"""
+        def has(error: FileCheckError):
+            return (errors & error.value) != 0
+
+        has_duration = self.duration != 0
+        duration = np.where(has_duration, self.duration, 1.0)
+        audio_bitrate = self.audio_bitrate.astype(np.float64)
+        video_bitrate = self.video_bitrate.astype(np.float64)
+        video_bitrate = np.where((video_bitrate == 0) & has_duration,
+                                 np.maximum(0.0, self.file_size * 8 / duration - audio_bitrate),
+                                 video_bitrate)
+
+        video = criterias['video']
+        is_other_video = ~has(FileCheckError.VIDEO_BITRATE) & has(FileCheckError.ALL_VIDEO)
+        if video['bitrate']:
+            video_bitrate = np.where(has(FileCheckError.VIDEO_BITRATE), video['bitrate']['target'], video_bitrate)
+        video_bitrate = np.where(is_other_video & has(FileCheckError.VIDEO_CODEC),
+                                 video_bitrate * self.codec_efficiency, video_bitrate)
+        if video['resolution']:
+            width, height = video['resolution']
+            scale = np.minimum(1.0, width * height / np.maximum(1, self.width * self.height))
+            video_bitrate = np.where(is_other_video & has(FileCheckError.VIDEO_RESOLUTION),
+                                     video_bitrate * scale, video_bitrate)
+        if video['fps']:
+            has_frame_rate = self.frame_rate > 0
+            scale = np.minimum(1.0, video['fps'] / np.where(has_frame_rate, self.frame_rate, 1.0))
+            video_bitrate = np.where(is_other_video & has(FileCheckError.VIDEO_FPS) & has_frame_rate,
+                                     video_bitrate * scale, video_bitrate)
+
+        if criterias['audio']['bitrate']:
+            audio_bitrate = np.where(has(FileCheckError.AUDIO_BITRATE)
+                                     | (has(FileCheckError.ALL_AUDIO) & (audio_bitrate == 0)),
+                                     criterias['audio']['bitrate']['target'], audio_bitrate)
+
+        output_size = ((video_bitrate + audio_bitrate) * duration / 8).astype(np.int64)
+        return np.where(has_duration, output_size, self.file_size)
+
+    def estimate_encode_seconds(self, errors: 'np.ndarray') -> 'np.ndarray':
+        """Vectorized equivalent of priority.estimate_encode_seconds"""
+        is_video = (errors & FileCheckError.ALL_VIDEO.value) != 0
+        is_audio = ~is_video & ((errors & FileCheckError.ALL_AUDIO.value) != 0)
+        speed = np.select([is_video, is_audio],
+                          [ENCODE_SPEED_ESTIMATES['video'] * (REFERENCE_PIXELS / np.maximum(1, self.width * self.height)),
+                           ENCODE_SPEED_ESTIMATES['audio']],
+                          ENCODE_SPEED_ESTIMATES['remux'])
+        return np.maximum(1.0, self.duration / speed)
+
+    def plan(self, name: str, criterias: dict) -> Plan:
+        errors = self.check(criterias)
+        affected = errors != 0
+        plan = Plan(name, len(self), int(affected.sum()))
+        plan.errors = {error.name: int(((errors & error.value) != 0).sum()) for error in SINGLE_ERRORS}
+
+        affected_errors = errors[affected]
+        is_video = (affected_errors & FileCheckError.ALL_VIDEO.value) != 0
+        plan.lanes = {'video': int(is_video.sum()), 'audio': int((~is_video).sum())}
+
+        input_size = self.file_size[affected]
+        output_size = self.estimate_output_size(errors, criterias)[affected]
+        plan.input_bytes = int(input_size.sum())
+        plan.estimated_bytes_saved = int(np.maximum(0, input_size - output_size).sum())
+        plan.estimated_encode_seconds = round(float(self.estimate_encode_seconds(errors)[affected].sum()), 1)
+        return plan
+
+
+def merge_criterias(base: dict, overrides: dict) -> dict:
+    """Criterias with the values of overrides replacing the ones of base, nested dicts are merged"""
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_criterias(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_candidate(candidate: str, index: int) -> tuple[str, dict]:
+    """Name and criterias of a candidate given as a JSON file or a JSON object overriding CRITERIAS"""
+    path = Path(candidate)
+    if not candidate.lstrip().startswith('{') and path.is_file():
+        return path.stem, merge_criterias(CRITERIAS, load_json(path.read_text(encoding='utf-8')))
+    return f'candidate {index}', merge_criterias(CRITERIAS, load_json(candidate))
+
+
+def format_plan(plan: Plan, current: Optional[Plan] = None) -> str:
+    lines = [f'{plan.name}: {plan.affected}/{plan.files} files'
+             + (f' ({plan.affected - current.affected:+d})' if current and current is not plan else ''),
+             f'  lanes: {", ".join(f"{lane} {count}" for lane, count in plan.lanes.items())}',
+             f'  errors: {", ".join(f"{error} {count}" for error, count in plan.errors.items() if count) or "none"}',
+             f'  input bytes: {plan.input_bytes}',
+             f'  estimated bytes saved: {plan.estimated_bytes_saved}',
+             f'  estimated encode seconds: {plan.estimated_encode_seconds}']
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = ArgumentParser(description='Estimate what criteria changes would cost on the probed files of the library')
+    parser.add_argument('--db', type=Path, default=METADATA_CACHE_FILE, help='path to the metadata cache')
+    parser.add_argument('-c', '--candidate', action='append', default=[],
+                        help='JSON file or JSON object overriding CRITERIAS, can be repeated')
+    parser.add_argument('--json', action='store_true', help='print the plans as JSON')
+    parser.add_argument('path', type=Path, nargs='?', help='only plan the files of this file or directory')
+    args = parser.parse_args(argv)
+
+    if np is None:
+        sys.exit('Planning requires numpy, install it with "pip install numpy"')
+
+    candidates = [('current', CRITERIAS)] + [load_candidate(candidate, index)
+                                              for index, candidate in enumerate(args.candidate, 1)]
+    cache = MetadataCache(args.db)
+    try:
+        table = MetadataTable(cache.entries(args.path))
+    finally:
+        cache.close()
+
+    plans = [table.plan(name, criterias) for name, criterias in candidates]
+    if args.json:
+        print(dump_json([asdict(plan) for plan in plans], indent=2))
+    else:
+        print('\n'.join(format_plan(plan, plans[0]) for plan in plans))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import io
+import os
+import random
+from contextlib import redirect_stdout
+from dataclasses import replace
+from json import loads as load_json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+
+import planner
+from config import CRITERIAS
+from filechecker import FileCheckError, check_file
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from metadata_cache import MetadataCache
+from planner import MetadataTable, merge_criterias, np
+from priority import estimate_output_size, estimate_encode_seconds
+
+CANDIDATES = [
+    CRITERIAS,
+    merge_criterias(CRITERIAS, {'video': {'codec': 'av1', 'resolution': [1280, 720], 'fps': 24}}),
+    merge_criterias(CRITERIAS, {'audio': {'codec': None, 'bitrate': None}, 'video': {'bitrate': None}}),
+]
+
+
+def random_metadata(rng: random.Random, index: int) -> FileMetadata:
+    width, height = rng.choice([(640, 480), (1280, 720), (1920, 1080), (3840, 2160), (1080, 1920), (0, 0)])
+    return FileMetadata(
+        Path(f'/library/{index}.mkv'),
+        rng.randint(1, 4_000_000_000),
+        rng.choice([0.0, 12.5, 600.0, 5400.25]),
+        AudioMetadata(rng.choice(['aac', 'opus', 'ac3', 'dts']), rng.choice([44_100, 48_000, 96_000]),
+                      rng.choice([1, 2, 6, 8]), rng.choice([0, 96_000, 128_000, 640_000]), {}),
+        VideoMetadata(rng.choice(['h264', 'hevc', 'HEVC', 'h265', 'av1', 'mpeg4', 'vp9']), width, height, '16:9',
+                      rng.choice([0.0, 23.976, 25.0, 30.0, 60.0]), rng.choice([0, 800_000, 3_000_000, 20_000_000]), {}),
+        {}
+    )
+
+
+@skipIf(np is None, 'numpy is not installed')
+class PlannerTest(TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.entries = [random_metadata(rng, index) for index in range(500)]
+        self.table = MetadataTable(self.entries)
+
+    def test_check_matches_check_file(self):
+        for index, criterias in enumerate(CANDIDATES):
+            with self.subTest(candidate=index):
+                errors = self.table.check(criterias)
+                self.assertEqual([FileCheckError(int(value)) for value in errors],
+                                 [check_file(metadata, criterias) for metadata in self.entries])
+
+    def test_estimates_match_priority(self):
+        for index, criterias in enumerate(CANDIDATES):
+            with self.subTest(candidate=index):
+                errors = self.table.check(criterias)
+                flags = [FileCheckError(int(value)) for value in errors]
+                self.assertEqual(self.table.estimate_output_size(errors, criterias).tolist(),
+                                 [estimate_output_size(metadata, error, criterias)
+                                  for metadata, error in zip(self.entries, flags)])
+                self.assertEqual(self.table.estimate_encode_seconds(errors).tolist(),
+                                 [estimate_encode_seconds(metadata, error)
+                                  for metadata, error in zip(self.entries, flags)])
+
+    def test_plan(self):
+        criterias = CANDIDATES[1]
+        plan = self.table.plan('smaller', criterias)
+        affected = [(metadata, errors) for metadata in self.entries
+                    if (errors := check_file(metadata, criterias))]
+
+        self.assertEqual((plan.files, plan.affected), (500, len(affected)))
+        self.assertEqual(plan.errors['VIDEO_FPS'],
+                         sum(bool(errors & FileCheckError.VIDEO_FPS) for _, errors in affected))
+        self.assertEqual(sum(plan.lanes.values()), plan.affected)
+        self.assertEqual(plan.estimated_bytes_saved,
+                         sum(max(0, metadata.file_size - estimate_output_size(metadata, errors, criterias))
+                             for metadata, errors in affected))
+        self.assertAlmostEqual(plan.estimated_encode_seconds,
+                               sum(estimate_encode_seconds(metadata, errors) for metadata, errors in affected),
+                               delta=0.1)
+
+    def test_cli(self):
+        with TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir)
+            video = root / 'library' / 'video.mkv'
+            video.parent.mkdir()
+            video.write_bytes(b'\0')
+            cache = MetadataCache(root / 'metadata.sqlite')
+            cache.put(video, os.stat(video), replace(self.entries[0], filepath=video))
+            cache.close()
+
+            output = io.StringIO()
+            with redirect_stdout(output):
+                planner.main(['--db', str(root / 'metadata.sqlite'), '--json',
+                              '-c', '{"video": {"codec": "av1"}, "audio": {"codec": null}}', str(video.parent)])
+        current, candidate = load_json(output.getvalue())
+        self.assertEqual((current['name'], current['files']), ('current', 1))
+        self.assertEqual((candidate['name'], candidate['files'], candidate['affected']), ('candidate 1', 1, 1))
+        self.assertEqual(candidate['errors']['VIDEO_CODEC'], 1)
+        self.assertEqual(candidate['errors']['AUDIO_CODEC'], 0)
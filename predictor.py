@@ -0,0 +1,124 @@
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from config import PREDICTION_MIN_SAMPLES, PREDICTION_MAX_SAMPLES, PREDICTION_MAX_AGE, PREDICTION_RESAMPLE_INTERVAL
+from filechecker import FileCheckError
+from fileparser import FileMetadata
+from job import Prediction, classify_lane
+from outcome_cache import criteria_hash
+from priority import estimate_output_size, source_bitrates
+
+logger = logging.getLogger('reencode_job.predictor')
+
+HEIGHT_CLASSES = (480, 720, 1080, 1440, 2160)
+
+
+def bucket_key(metadata: FileMetadata, errors: FileCheckError) -> str:
+    """Group files that are expected to compress the same way with the current criterias"""
+    height = min(metadata.video.width, metadata.video.height)
+    height_class = next((h for h in HEIGHT_CLASSES if height <= h), HEIGHT_CLASSES[-1] * 2)
+    video_bitrate, _ = source_bitrates(metadata)
+    bitrate_class = int(math.log2(max(1.0, video_bitrate / 1000)))
+    fps_class = round(metadata.video.frame_rate / 5) * 5
+    return '|'.join(map(str, (metadata.video.codec, height_class, bitrate_class, fps_class,
+                              classify_lane(errors).value, criteria_hash())))
+
+
+class SizePredictor:
+    """Predict output sizes from the ratios achieved by previous encodes of similar files
+
+    Only the most recent encodes of a group are used, and encodes older than the maximum age
+    are removed so that the history follows changes of the encoders and of the library. Groups
+    whose files are skipped still get one file encoded every resample interval.
+    """
+
+    def __init__(self,
+                 db_path: Path,
+                 min_samples: int = PREDICTION_MIN_SAMPLES,
+                 max_samples: int = PREDICTION_MAX_SAMPLES,
+                 max_age: float = PREDICTION_MAX_AGE,
+                 resample_interval: int = PREDICTION_RESAMPLE_INTERVAL):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.max_age = max_age
+        self.resample_interval = resample_interval
+
+        self._errors_sum = 0.0
+        self._errors_count = 0
+        self._skips: Counter[str] = Counter()
+
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS results ('
+                             'path TEXT NOT NULL, '
+                             'bucket TEXT NOT NULL, '
+                             'predicted_ratio REAL, '
+                             'actual_ratio REAL NOT NULL, '
+                             'recorded_at REAL NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_bucket ON results (bucket, recorded_at)')
+            self._db.execute('DELETE FROM results WHERE recorded_at < ?', (time.time() - self.max_age,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def predict(self, metadata: FileMetadata, errors: FileCheckError) -> Prediction:
+        with self._lock:
+            row = self._db.execute('SELECT COUNT(*), SUM(actual_ratio) FROM ('
+                                   'SELECT actual_ratio FROM results WHERE bucket = ? AND recorded_at >= ? '
+                                   'ORDER BY recorded_at DESC LIMIT ?)',
+                                   (bucket_key(metadata, errors), time.time() - self.max_age,
+                                    self.max_samples)).fetchone()
+        if row[0] >= self.min_samples:
+            count, ratio_sum = row
+            return Prediction(ratio_sum / count, count)
+
+        if not metadata.file_size:
+            return Prediction(1.0, 0)
+        return Prediction(estimate_output_size(metadata, errors) / metadata.file_size, 0)
+
+    def record(self,
+               metadata: FileMetadata,
+               errors: FileCheckError,
+               in_size: int,
+               out_size: int,
+               prediction: Optional[Prediction] = None):
+        if not in_size:
+            return
+
+        bucket = bucket_key(metadata, errors)
+        ratio = out_size / in_size
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO results VALUES (?, ?, ?, ?, ?)',
+                             (str(metadata.filepath), bucket, prediction.ratio if prediction else None,
+                              ratio, time.time()))
+            self._db.execute('DELETE FROM results WHERE bucket = ? AND rowid NOT IN ('
+                             'SELECT rowid FROM results WHERE bucket = ? ORDER BY recorded_at DESC LIMIT ?)',
+                             (bucket, bucket, self.max_samples))
+            if prediction:
+                self._errors_sum += abs(prediction.ratio - ratio)
+                self._errors_count += 1
+
+    def is_resample_due(self, metadata: FileMetadata, errors: FileCheckError) -> bool:
+        """Whether a file that would be skipped should be encoded to refresh the history of its group"""
+        bucket = bucket_key(metadata, errors)
+        with self._lock:
+            self._skips[bucket] += 1
+            return self._skips[bucket] % self.resample_interval == 0
+
+    def log_stats(self):
+        if self._errors_count:
+            logger.info('Size predictions: mean absolute error of %.3f over %d encodes',
+                        self._errors_sum / self._errors_count, self._errors_count)
+
+    def reset_stats(self):
+        self._errors_sum = 0.0
+        self._errors_count = 0
@@ -0,0 +1,72 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from config import CRITERIAS
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from predictor import SizePredictor, bucket_key
+
+
+class SizePredictorTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.predictor = SizePredictor(Path(self.tmp_dir.name, 'predictions.sqlite'), min_samples=2)
+        self.metadata = FileMetadata(
+            Path("input_path"),
+            100_000_000,
+            600.0,
+            AudioMetadata("aac", 48_000, 2, 128_000, {}),
+            VideoMetadata("h264", 1920, 1080, "16:9", 29.97, 1_200_000, {}),
+            {}
+        )
+
+    def tearDown(self):
+        self.predictor.close()
+        self.tmp_dir.cleanup()
+
+    def test_bucket_key_groups_similar_files(self):
+        similar = FileMetadata(Path("other"), 1, 1.0, self.metadata.audio,
+                               VideoMetadata("h264", 1920, 1072, "16:9", 30, 1_100_000, {}), {})
+        self.assertEqual(bucket_key(self.metadata, FileCheckError.VIDEO_CODEC),
+                         bucket_key(similar, FileCheckError.VIDEO_CODEC))
+        self.assertNotEqual(bucket_key(self.metadata, FileCheckError.VIDEO_CODEC),
+                            bucket_key(self.metadata, FileCheckError.AUDIO_CODEC))
+        key = bucket_key(self.metadata, FileCheckError.VIDEO_CODEC)
+        with patch.dict(CRITERIAS['video']['bitrate'], target=1_000_000):
+            self.assertNotEqual(bucket_key(self.metadata, FileCheckError.VIDEO_CODEC), key)
+
+    def test_predict_estimates_without_history(self):
+        prediction = self.predictor.predict(self.metadata, FileCheckError.VIDEO_CODEC)
+        self.assertFalse(prediction.is_from_history)
+        self.assertLess(prediction.ratio, 1)
+
+    def test_predict_uses_history(self):
+        errors = FileCheckError.VIDEO_CODEC
+        self.predictor.record(self.metadata, errors, 100, 90)
+        self.assertFalse(self.predictor.predict(self.metadata, errors).is_from_history)
+
+        self.predictor.record(self.metadata, errors, 100, 130)
+        prediction = self.predictor.predict(self.metadata, errors)
+        self.assertEqual(prediction.samples, 2)
+        self.assertAlmostEqual(prediction.ratio, 1.1)
+        self.assertAlmostEqual(prediction.savings, -0.1)
+
+    def test_history_is_bounded(self):
+        predictor = SizePredictor(Path(self.tmp_dir.name, 'bounded.sqlite'), min_samples=2, max_samples=2,
+                                  max_age=3600)
+        errors = FileCheckError.VIDEO_CODEC
+        with patch('predictor.time.time', return_value=1_000_000.0):
+            for out_size in (200, 50, 70):
+                predictor.record(self.metadata, errors, 100, out_size)
+            self.assertAlmostEqual(predictor.predict(self.metadata, errors).ratio, 0.6)
+        with patch('predictor.time.time', return_value=1_000_000.0 + 7200):
+            self.assertFalse(predictor.predict(self.metadata, errors).is_from_history)
+        predictor.close()
+
+    def test_skipped_groups_are_resampled(self):
+        predictor = SizePredictor(Path(self.tmp_dir.name, 'resample.sqlite'), resample_interval=3)
+        due = [predictor.is_resample_due(self.metadata, FileCheckError.VIDEO_CODEC) for _ in range(6)]
+        predictor.close()
+        self.assertEqual(due, [False, False, True, False, False, True])
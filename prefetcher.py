@@ -0,0 +1,122 @@
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterable, Iterator
+
+from app import App
+from config import PROBE_WORKERS, MIN_PREDICTED_SAVINGS
+from filechecker import check_file, FileCheckError
+from job import Job
+from journal import JobState
+from metrics import FILES_PROBED, QUEUE_DEPTH, STAGE_SECONDS
+
+logger = logging.getLogger('reencode_job.prefetcher')
+
+
+def prepare_job(app: App, job: Job) -> Job:
+    """Probe and classify the job input file"""
+    if app.journal is not None:
+        app.journal.transition(job.input_filename, JobState.PROBING)
+
+    if app.outcome_cache is not None and not app.args.is_reencode_forced:
+        if entry := app.outcome_cache.get(job.input_filename):
+            job.is_probed = True
+            job.skip_reason = (f'Previous encode {entry.outcome.value} ({entry.attempts} attempts), '
+                               f'retrying after {datetime.fromtimestamp(entry.retry_at):%Y-%m-%d %H:%M}')
+            return job
+    with STAGE_SECONDS.labels('probe').time():
+        job.metadata = app.probe(job.input_filename)
+    job.is_probed = True
+
+    if job.metadata is None:
+        job.skip_reason = 'Skipping'
+        return job
+    FILES_PROBED.inc()
+
+    if app.args.is_reencode_forced:
+        job.errors = FileCheckError.ALL
+    else:
+        job.errors = check_file(job.metadata)
+
+    # An already existing output is still replaced even if the input file matches expectations
+    if not job.errors and not (app.args.is_replace_enabled and job.output_filename.exists()):
+        job.skip_reason = 'Video matches expectations, skipping'
+        return job
+
+    if app.predictor is not None and job.errors:
+        _apply_prediction(app, job)
+
+    # Sampled hashes are read ahead of the encoder, duplicates are looked up right before encoding
+    if app.dedup is not None and not job.is_skipped:
+        with STAGE_SECONDS.labels('fingerprint').time():
+            app.dedup.fingerprint(job.input_filename)
+
+    return job
+
+
+def _apply_prediction(app: App, job: Job):
+    job.prediction = app.predictor.predict(job.metadata, job.errors)
+
+    # Estimations from the criterias alone are too rough to discard files
+    if (app.args.is_reencode_forced
+            or not job.prediction.is_from_history
+            or job.prediction.savings >= MIN_PREDICTED_SAVINGS):
+        return
+
+    # Skipped groups would otherwise never record the ratios that could lift the skip
+    if app.args.prediction_action == 'skip' and not app.predictor.is_resample_due(job.metadata, job.errors):
+        job.skip_reason = (f'Predicted ratio of {job.prediction.ratio:.2f}x '
+                           f'over {job.prediction.samples} similar files, skipping')
+    else:
+        logger.debug('Predicted ratio of %.2fx, deprioritizing', job.prediction.ratio)
+        job.is_deprioritized = True
+
+
+class Prefetcher:
+    """Probe and classify upcoming jobs in a thread pool ahead of the encoder
+
+    Jobs are yielded in their original order, the lookahead depth bounds how many
+    jobs are probed in advance.
+    """
+
+    def __init__(self, app: App, jobs: Iterable[Job], depth: int, workers: int = PROBE_WORKERS):
+        self.app = app
+        self.depth = depth
+
+        self._jobs = jobs
+        self._pending: deque[Future[Job]] = deque()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='probe')
+        QUEUE_DEPTH.labels('prefetch').set_function(lambda: len(self._pending))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __iter__(self) -> Iterator[Job]:
+        for job in self._jobs:
+            if self.app.is_interrupted:
+                return
+
+            self._pending.append(self._pool.submit(self._prepare_job, job))
+            if len(self._pending) > self.depth:
+                yield self._pending.popleft().result()
+
+        while self._pending and not self.app.is_interrupted:
+            yield self._pending.popleft().result()
+
+    def _prepare_job(self, job: Job) -> Job:
+        try:
+            return prepare_job(self.app, job)
+        except Exception as e:
+            logger.exception('Unable to prepare "%s"', job.input_filename, exc_info=e)
+            job.is_probed = True
+            job.skip_reason = 'Skipping'
+            return job
+
+    def close(self):
+        while self._pending:
+            self._pending.popleft().cancel()
+        self._pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,95 @@
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from job import Job, Prediction
+from prefetcher import Prefetcher, prepare_job
+
+
+class PrefetcherTest(TestCase):
+    def setUp(self):
+        self.app = MagicMock()
+        self.app.is_interrupted = False
+        self.app.args = SimpleNamespace(is_reencode_forced=False, is_replace_enabled=False,
+                                        prediction_action='skip')
+        self.app.probe.side_effect = self.probe
+        self.app.predictor = None
+        self.app.outcome_cache = None
+
+    @staticmethod
+    def probe(file_path: Path):
+        if file_path.stem == 'broken':
+            return None
+        codec = 'hevc' if file_path.stem.startswith('ok') else 'h264'
+        return FileMetadata(file_path, 123, 30.0,
+                            AudioMetadata("aac", 48_000, 2, 192_000, {}),
+                            VideoMetadata(codec, 1920, 1080, "16:9", 30.0, 2_000_000, {}),
+                            {})
+
+    @staticmethod
+    def jobs(*names: str):
+        return [Job(i, Path(f'{name}.mp4'), Path(f'{name}_reencoded.mp4')) for i, name in enumerate(names, 1)]
+
+    def test_prepare_job_skips_matching_file(self):
+        job = prepare_job(self.app, self.jobs('ok')[0])
+        self.assertEqual(job.errors, FileCheckError.NONE)
+        self.assertTrue(job.is_skipped)
+
+    def test_prepare_job_skips_unprobed_file(self):
+        job = prepare_job(self.app, self.jobs('broken')[0])
+        self.assertTrue(job.is_probed)
+        self.assertTrue(job.is_skipped)
+
+    def test_prepare_job_keeps_file_to_encode(self):
+        job = prepare_job(self.app, self.jobs('encode')[0])
+        self.assertEqual(job.errors, FileCheckError.VIDEO_CODEC)
+        self.assertFalse(job.is_skipped)
+
+    def test_prepare_job_forced(self):
+        self.app.args.is_reencode_forced = True
+        job = prepare_job(self.app, self.jobs('ok')[0])
+        self.assertEqual(job.errors, FileCheckError.ALL)
+        self.assertFalse(job.is_skipped)
+
+    def test_prepare_job_skips_file_predicted_larger(self):
+        self.app.predictor = MagicMock()
+        self.app.predictor.predict.return_value = Prediction(1.2, 10)
+        self.app.predictor.is_resample_due.return_value = False
+        job = prepare_job(self.app, self.jobs('encode')[0])
+        self.assertTrue(job.is_skipped)
+
+        self.app.predictor.is_resample_due.return_value = True
+        job = prepare_job(self.app, self.jobs('encode')[0])
+        self.assertFalse(job.is_skipped)
+
+    def test_prepare_job_deprioritizes_file_predicted_larger(self):
+        self.app.args.prediction_action = 'deprioritize'
+        self.app.predictor = MagicMock()
+        self.app.predictor.predict.return_value = Prediction(1.2, 10)
+        job = prepare_job(self.app, self.jobs('encode')[0])
+        self.assertFalse(job.is_skipped)
+        self.assertTrue(job.is_deprioritized)
+
+    def test_prepare_job_ignores_estimated_prediction(self):
+        self.app.predictor = MagicMock()
+        self.app.predictor.predict.return_value = Prediction(1.2, 0)
+        job = prepare_job(self.app, self.jobs('encode')[0])
+        self.assertFalse(job.is_skipped)
+        self.assertFalse(job.is_deprioritized)
+
+    def test_prefetcher_preserves_order(self):
+        names = [f'ok_{i}' if i % 3 else f'encode_{i}' for i in range(20)]
+        with Prefetcher(self.app, self.jobs(*names), depth=4, workers=3) as prefetcher:
+            jobs = list(prefetcher)
+        self.assertEqual([job.input_filename.stem for job in jobs], names)
+        self.assertTrue(all(job.is_probed for job in jobs))
+
+    def test_prefetcher_stops_when_interrupted(self):
+        with Prefetcher(self.app, self.jobs(*(f'ok_{i}' for i in range(20))), depth=2) as prefetcher:
+            for job in prefetcher:
+                if job.index == 5:
+                    self.app.is_interrupted = True
+        self.assertEqual(job.index, 5)
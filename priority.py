@@ -0,0 +1,153 @@
+import heapq
+import logging
+from enum import Enum
+from itertools import count
+from typing import Iterable, Iterator, Optional
+
+from config import CRITERIAS, ENCODE_SPEED_ESTIMATES
+from filechecker import FileCheckError
+from fileparser import FileMetadata
+from job import Job, Lane, classify_lane
+
+logger = logging.getLogger('reencode_job.priority')
+
+# Rough size ratio of an HEVC encode compared to the source at the same quality
+CODEC_EFFICIENCY = {
+    'hevc': 1.0,
+    'av1': 1.0,
+    'vp9': 1.0,
+    'h264': 0.6,
+}
+DEFAULT_CODEC_EFFICIENCY = 0.5
+REFERENCE_PIXELS = 1920 * 1080
+
+
+class QueueOrder(Enum):
+    """Order in which probed files are handed to the encoder"""
+    SCAN = 'scan'
+    SAVINGS = 'savings'
+    OLDEST = 'oldest'
+    SMALLEST = 'smallest'
+    LARGEST = 'largest'
+
+
+def source_bitrates(metadata: FileMetadata) -> tuple[float, float]:
+    audio_bitrate = metadata.audio.bitrate
+    video_bitrate = metadata.video.bitrate
+    if not video_bitrate and metadata.duration:
+        # Some containers don't report stream bitrates, deduce it from the overall bitrate
+        video_bitrate = max(0.0, metadata.file_size * 8 / metadata.duration - audio_bitrate)
+    return video_bitrate, audio_bitrate
+
+
+def estimate_video_bitrate(metadata: FileMetadata, errors: FileCheckError, criterias: Optional[dict] = None) -> float:
+    """Estimate the output video bitrate from the source bitrate and the target criterias"""
+    criterias = criterias or CRITERIAS
+    video_bitrate, _ = source_bitrates(metadata)
+
+    if errors & FileCheckError.VIDEO_BITRATE:
+        video_bitrate = criterias['video']['bitrate']['target']
+    elif errors & FileCheckError.ALL_VIDEO:
+        if errors & FileCheckError.VIDEO_CODEC:
+            video_bitrate *= CODEC_EFFICIENCY.get(metadata.video.codec, DEFAULT_CODEC_EFFICIENCY)
+        if errors & FileCheckError.VIDEO_RESOLUTION:
+            width, height = criterias['video']['resolution']
+            video_bitrate *= min(1.0, width * height / max(1, metadata.video.width * metadata.video.height))
+        if errors & FileCheckError.VIDEO_FPS and metadata.video.frame_rate:
+            video_bitrate *= min(1.0, criterias['video']['fps'] / metadata.video.frame_rate)
+    return video_bitrate
+
+
+def estimate_output_size(metadata: FileMetadata, errors: FileCheckError, criterias: Optional[dict] = None) -> int:
+    """Estimate the output size in bytes from the source bitrates and the target criterias"""
+    criterias = criterias or CRITERIAS
+    if not metadata.duration:
+        return metadata.file_size
+
+    video_bitrate = estimate_video_bitrate(metadata, errors, criterias)
+    audio_bitrate = metadata.audio.bitrate
+
+    if criterias['audio']['bitrate'] and (errors & FileCheckError.AUDIO_BITRATE
+                                         or (errors & FileCheckError.ALL_AUDIO and not audio_bitrate)):
+        audio_bitrate = criterias['audio']['bitrate']['target']
+
+    return int((video_bitrate + audio_bitrate) * metadata.duration / 8)
+
+
+def estimate_encode_seconds(metadata: FileMetadata, errors: FileCheckError) -> float:
+    lane = classify_lane(errors)
+    speed = ENCODE_SPEED_ESTIMATES[lane.value]
+    if lane == Lane.VIDEO:
+        speed *= REFERENCE_PIXELS / max(1, metadata.video.width * metadata.video.height)
+    return max(1.0, metadata.duration / speed)
+
+
+def savings_rate(job: Job) -> float:
+    """Expected bytes saved per second of encode"""
+    if job.prediction:
+        saved = job.metadata.file_size * job.prediction.savings
+    else:
+        saved = job.metadata.file_size - estimate_output_size(job.metadata, job.errors)
+    return saved / estimate_encode_seconds(job.metadata, job.errors)
+
+
+def job_priority(job: Job, order: QueueOrder) -> float:
+    """Sort key of the job, lowest is processed first"""
+    if order == QueueOrder.SAVINGS:
+        return -savings_rate(job)
+    if order == QueueOrder.OLDEST:
+        try:
+            return job.input_filename.stat().st_mtime
+        except FileNotFoundError:
+            return 0
+    if order == QueueOrder.SMALLEST:
+        return job.metadata.file_size
+    if order == QueueOrder.LARGEST:
+        return -job.metadata.file_size
+    return job.index
+
+
+class RankedQueue:
+    """Reorder probed jobs by priority within a sliding window
+
+    Skipped jobs don't need to be ranked and are passed through as soon as they come in,
+    deprioritized jobs are held back until the end of the pass.
+    """
+
+    def __init__(self, jobs: Iterable[Job], order: QueueOrder, window: int):
+        self.order = order
+        self.window = window
+
+        self._jobs = jobs
+        self._heap: list[tuple[float, int, Job]] = []
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, job: Job, priority: float):
+        heapq.heappush(self._heap, (priority, next(self._counter), job))
+
+    def pop(self) -> Job:
+        priority, _, job = heapq.heappop(self._heap)
+        logger.debug('Next job "%s" (priority: %.3g)', job.input_filename, priority)
+        return job
+
+    def __iter__(self) -> Iterator[Job]:
+        deprioritized = []
+        for job in self._jobs:
+            if job.is_skipped or (self.order == QueueOrder.SCAN and not job.is_deprioritized):
+                yield job
+                continue
+
+            if job.is_deprioritized:
+                deprioritized.append(job)
+                continue
+
+            self.push(job, job_priority(job, self.order))
+            if self.window and len(self._heap) >= self.window:
+                yield self.pop()
+
+        while self._heap:
+            yield self.pop()
+        yield from deprioritized
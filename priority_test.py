@@ -0,0 +1,65 @@
+from pathlib import Path
+from unittest import TestCase
+
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from job import Job
+from priority import QueueOrder, RankedQueue, estimate_output_size, estimate_encode_seconds
+
+
+def make_job(index: int, file_size: int, video_bitrate: int, errors: FileCheckError, width: int = 1920):
+    metadata = FileMetadata(Path(f'{index}.mp4'), file_size, 600.0,
+                            AudioMetadata("aac", 48_000, 2, 128_000, {}),
+                            VideoMetadata("h264", width, width * 9 // 16, "16:9", 30.0, video_bitrate, {}),
+                            {})
+    return Job(index, metadata.filepath, Path(f'{index}_reencoded.mp4'), metadata, errors, True)
+
+
+class PriorityTest(TestCase):
+    def test_estimate_output_size_uses_bitrate_target(self):
+        job = make_job(1, 1_000_000_000, 12_000_000, FileCheckError.VIDEO_BITRATE | FileCheckError.VIDEO_CODEC)
+        self.assertEqual(estimate_output_size(job.metadata, job.errors), (2_000_000 + 128_000) * 600 // 8)
+
+    def test_estimate_output_size_keeps_copied_streams(self):
+        job = make_job(1, 1_000_000_000, 2_000_000, FileCheckError.AUDIO_BITRATE)
+        self.assertEqual(estimate_output_size(job.metadata, job.errors), (2_000_000 + 192_000) * 600 // 8)
+
+    def test_estimate_output_size_without_stream_bitrate(self):
+        job = make_job(1, 600_000_000, 0, FileCheckError.VIDEO_CODEC)
+        video_bitrate = 600_000_000 * 8 / 600 - 128_000
+        self.assertEqual(estimate_output_size(job.metadata, job.errors), int((video_bitrate * 0.6 + 128_000) * 75))
+
+    def test_estimate_encode_seconds_scales_with_resolution(self):
+        hd = make_job(1, 1, 1, FileCheckError.VIDEO_CODEC)
+        uhd = make_job(2, 1, 1, FileCheckError.VIDEO_CODEC, width=3840)
+        audio = make_job(3, 1, 1, FileCheckError.AUDIO_CODEC)
+        self.assertAlmostEqual(estimate_encode_seconds(uhd.metadata, uhd.errors),
+                               4 * estimate_encode_seconds(hd.metadata, hd.errors))
+        self.assertLess(estimate_encode_seconds(audio.metadata, audio.errors),
+                        estimate_encode_seconds(hd.metadata, hd.errors))
+
+    def test_ranked_queue_savings_first(self):
+        jobs = [make_job(1, 200_000_000, 2_500_000, FileCheckError.VIDEO_CODEC),
+                make_job(2, 4_000_000_000, 50_000_000, FileCheckError.VIDEO_BITRATE),
+                make_job(3, 900_000_000, 12_000_000, FileCheckError.VIDEO_BITRATE)]
+        result = [job.index for job in RankedQueue(jobs, QueueOrder.SAVINGS, 0)]
+        self.assertEqual(result, [2, 3, 1])
+
+    def test_ranked_queue_window(self):
+        jobs = [make_job(i, size, 2_000_000, FileCheckError.VIDEO_CODEC)
+                for i, size in enumerate((30, 20, 10, 5), 1)]
+        result = [job.index for job in RankedQueue(jobs, QueueOrder.SMALLEST, 2)]
+        self.assertEqual(result, [2, 3, 4, 1])
+
+    def test_ranked_queue_passes_skipped_jobs_through(self):
+        jobs = [make_job(1, 30, 2_000_000, FileCheckError.VIDEO_CODEC),
+                make_job(2, 10, 2_000_000, FileCheckError.VIDEO_CODEC),
+                make_job(3, 20, 2_000_000, FileCheckError.NONE)]
+        jobs[2].skip_reason = 'Skipping'
+        result = [job.index for job in RankedQueue(jobs, QueueOrder.LARGEST, 0)]
+        self.assertEqual(result, [3, 1, 2])
+
+    def test_ranked_queue_scan_order(self):
+        jobs = [make_job(i, 10 * i, 2_000_000, FileCheckError.VIDEO_CODEC) for i in range(1, 4)]
+        result = [job.index for job in RankedQueue(jobs, QueueOrder.SCAN, 0)]
+        self.assertEqual(result, [1, 2, 3])
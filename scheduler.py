@@ -0,0 +1,188 @@
+import heapq
+import itertools
+import logging
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Optional
+
+from app import App
+from config import LANE_LIMITS, FFMPEG_THREADS, SCHEDULER_BACKLOG
+from job import Job, Lane
+from metrics import QUEUE_DEPTH
+from worker import Worker
+
+logger = logging.getLogger('reencode_job.scheduler')
+
+
+def split_threads(max_jobs: int, total_threads: int = FFMPEG_THREADS) -> Optional[int]:
+    """Number of threads each ffmpeg process gets so that concurrent jobs don't oversubscribe cores"""
+    if max_jobs <= 1:
+        # Let ffmpeg decide when it has the machine for itself
+        return None
+    return max(1, total_threads // max_jobs)
+
+
+class Scheduler:
+    """Run workers concurrently across encode slots
+
+    Each lane has its own concurrency limit on top of the global slot count. Pending jobs
+    of a lane start by decreasing priority, then in submission order. Lanes accept jobs
+    however busy they are, only the total backlog is bounded.
+    """
+
+    def __init__(self,
+                 app: App,
+                 max_jobs: int,
+                 lane_limits: Optional[dict[str, int]] = None,
+                 on_done: Optional[Callable[[Job], None]] = None,
+                 backlog: int = SCHEDULER_BACKLOG):
+        lane_limits = lane_limits or LANE_LIMITS
+
+        self.app = app
+        self.max_jobs = max(1, max_jobs)
+        self.lane_limits = {lane: max(1, min(lane_limits.get(lane.value, self.max_jobs), self.max_jobs))
+                            for lane in Lane}
+        self.threads_per_job = split_threads(self.max_jobs)
+        self.on_done = on_done
+        self.backlog = max(1, backlog)
+
+        self._cond = threading.Condition()
+        self._pending: dict[Lane, list[tuple[int, int, Job]]] = {lane: [] for lane in Lane}
+        self._sequence = itertools.count()
+        self._running: Counter[Lane] = Counter()
+        self._workers: dict[int, Worker] = {}
+        self._free_slots = list(range(self.max_jobs))
+        self._threads: list[threading.Thread] = []
+        QUEUE_DEPTH.labels('encode').set_function(lambda: self.pending_count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if self.app.is_interrupted:
+            self.stop()
+        self.join()
+
+    @property
+    def pending_count(self):
+        return sum(map(len, self._pending.values()))
+
+    @property
+    def running_count(self):
+        return sum(self._running.values())
+
+    def submit(self, job: Job):
+        """Queue a job, blocks while the backlog is full unless the job has a positive priority
+
+        A job waiting for a slot of its lane doesn't hold back the submission of the next ones,
+        so audio and remux jobs found behind a run of video encodes start on their free slots.
+        """
+        lane = job.lane
+        with self._cond:
+            while self.pending_count >= self.backlog and job.priority <= 0 and not self.app.is_interrupted:
+                self._cond.wait(timeout=1)
+            if self.app.is_interrupted:
+                return
+
+            logger.debug('Queuing "%s" in %s lane', job.input_filename, lane.value)
+            heapq.heappush(self._pending[lane], (-job.priority, next(self._sequence), job))
+            self._dispatch()
+
+    def pending_jobs(self) -> list[Job]:
+        with self._cond:
+            return [job for pending in self._pending.values() for _, _, job in sorted(pending)]
+
+    def running_workers(self) -> list[Worker]:
+        with self._cond:
+            return [self._workers[slot] for slot in sorted(self._workers)]
+
+    def find_worker(self, input_filename: Path) -> Optional[Worker]:
+        with self._cond:
+            return next((worker for worker in self._workers.values()
+                         if worker.input_filename == input_filename), None)
+
+    def __remove_pending(self, input_filename: Path) -> Optional[Job]:
+        for pending in self._pending.values():
+            for i, (_, _, job) in enumerate(pending):
+                if job.input_filename == input_filename:
+                    pending.pop(i)
+                    heapq.heapify(pending)
+                    return job
+        return None
+
+    def cancel(self, input_filename: Path) -> Optional[Job]:
+        """Drop a pending job, returns it if it was found"""
+        with self._cond:
+            job = self.__remove_pending(input_filename)
+            self._cond.notify_all()
+        if job is not None and self.app.staging is not None:
+            self.app.staging.discard(input_filename)
+        return job
+
+    def reprioritize(self, input_filename: Path, priority: int) -> bool:
+        """Change the priority of a pending job, returns whether it was found"""
+        with self._cond:
+            job = self.__remove_pending(input_filename)
+            if job is None:
+                return False
+            job.priority = priority
+            heapq.heappush(self._pending[job.lane], (-priority, next(self._sequence), job))
+        return True
+
+    def _dispatch(self):
+        for lane in Lane:
+            pending = self._pending[lane]
+            while pending and self._free_slots and self._running[lane] < self.lane_limits[lane]:
+                _, _, job = heapq.heappop(pending)
+                slot = self._free_slots.pop(0)
+                self._running[lane] += 1
+                self._workers[slot] = Worker(self.app, job, slot, self.threads_per_job)
+
+                thread = threading.Thread(target=self._run,
+                                          args=(job, lane, slot),
+                                          name=f'worker-{slot}',
+                                          daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+            if pending and self.app.staging is not None:
+                # Copy the next input of the lane while the current ones encode
+                self.app.staging.prefetch(pending[0][2])
+
+    def _run(self, job: Job, lane: Lane, slot: int):
+        try:
+            self._workers[slot].work()
+        except Exception as e:
+            logger.exception('Unhandled exception', exc_info=e)
+        finally:
+            if self.on_done:
+                self.on_done(job)
+            with self._cond:
+                del self._workers[slot]
+                self._running[lane] -= 1
+                self._free_slots.append(slot)
+                self._free_slots.sort()
+                self._threads.remove(threading.current_thread())
+                if not self.app.is_interrupted:
+                    self._dispatch()
+                self._cond.notify_all()
+
+    def stop(self):
+        """Drop jobs that haven't started yet, running jobs are left to finish"""
+        with self._cond:
+            dropped = [job for pending in self._pending.values() for _, _, job in pending]
+            for pending in self._pending.values():
+                pending.clear()
+            self._cond.notify_all()
+        if self.app.staging is not None:
+            for job in dropped:
+                self.app.staging.discard(job.input_filename)
+        if dropped:
+            logger.info('Dropped %d queued jobs', len(dropped))
+
+    def join(self):
+        """Wait for every queued and running job to complete"""
+        with self._cond:
+            while self._threads or (self.pending_count and not self.app.is_interrupted):
+                self._cond.wait(timeout=1)
@@ -0,0 +1,133 @@
+import threading
+import time
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from filechecker import FileCheckError
+from job import Job, Lane, classify_lane
+from scheduler import Scheduler, split_threads
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        self.app = MagicMock()
+        self.app.is_interrupted = False
+
+        self.lock = threading.Lock()
+        self.running = {lane: 0 for lane in Lane}
+        self.max_running = {lane: 0 for lane in Lane}
+        self.slots = set()
+
+    def fake_worker(self, _, job: Job, slot: int, __):
+        lane = classify_lane(job.errors)
+
+        def work():
+            with self.lock:
+                self.assertNotIn(slot, self.slots)
+                self.slots.add(slot)
+                self.running[lane] += 1
+                self.max_running[lane] = max(self.max_running[lane], self.running[lane])
+            time.sleep(0.01)
+            with self.lock:
+                self.slots.remove(slot)
+                self.running[lane] -= 1
+
+        return MagicMock(work=work)
+
+    @staticmethod
+    def job(i: int, errors: FileCheckError):
+        return Job(i, Path(f'{i}.mp4'), Path(f'{i}_reencoded.mp4'), errors=errors)
+
+    def test_classify_lane(self):
+        self.assertEqual(classify_lane(FileCheckError.VIDEO_CODEC | FileCheckError.AUDIO_CODEC), Lane.VIDEO)
+        self.assertEqual(classify_lane(FileCheckError.AUDIO_BITRATE), Lane.AUDIO)
+        self.assertEqual(classify_lane(FileCheckError.NONE), Lane.REMUX)
+
+    def test_split_threads(self):
+        self.assertIsNone(split_threads(1, 32))
+        self.assertEqual(split_threads(4, 32), 8)
+        self.assertEqual(split_threads(64, 32), 1)
+
+    def test_scheduler_respects_lane_limits(self):
+        done = []
+        with patch('scheduler.Worker', side_effect=self.fake_worker):
+            with Scheduler(self.app, 4, {'video': 1, 'audio': 3, 'remux': 2}, on_done=done.append) as scheduler:
+                for i in range(30):
+                    errors = (FileCheckError.VIDEO_CODEC, FileCheckError.AUDIO_CODEC, FileCheckError.NONE)[i % 3]
+                    scheduler.submit(self.job(i, errors))
+
+        self.assertEqual(len(done), 30)
+        self.assertEqual(self.max_running[Lane.VIDEO], 1)
+        self.assertLessEqual(self.max_running[Lane.AUDIO], 3)
+        self.assertLessEqual(self.max_running[Lane.REMUX], 2)
+
+    def test_scheduler_stop_drops_pending_jobs(self):
+        done = []
+        with patch('scheduler.Worker', side_effect=self.fake_worker):
+            with Scheduler(self.app, 1, on_done=done.append) as scheduler:
+                scheduler.submit(self.job(1, FileCheckError.VIDEO_CODEC))
+                scheduler.submit(self.job(2, FileCheckError.VIDEO_CODEC))
+                scheduler.stop()
+        self.assertEqual([job.index for job in done], [1])
+        self.app.staging.discard.assert_called_once_with(Path('2.mp4'))
+
+    def test_scheduler_starts_higher_priority_first(self):
+        started = []
+        release = threading.Event()
+
+        def blocking_worker(_, job: Job, __, ___):
+            started.append(job.index)
+            return MagicMock(work=release.wait)
+
+        with patch('scheduler.Worker', side_effect=blocking_worker):
+            with Scheduler(self.app, 1) as scheduler:
+                scheduler.submit(self.job(0, FileCheckError.VIDEO_CODEC))
+                for i, priority in ((1, 0), (2, 5), (3, 1)):
+                    job = self.job(i, FileCheckError.VIDEO_CODEC)
+                    job.priority = priority
+                    scheduler.submit(job)
+                self.assertEqual([job.index for job in scheduler.pending_jobs()], [2, 3, 1])
+
+                self.assertTrue(scheduler.reprioritize(Path('1.mp4'), 10))
+                self.assertEqual(scheduler.cancel(Path('3.mp4')).index, 3)
+                release.set()
+        self.assertEqual(started, [0, 1, 2])
+
+    def test_busy_lane_does_not_hold_back_other_lanes(self):
+        started = []
+        release = threading.Event()
+        audio_done = threading.Event()
+
+        def blocking_worker(_, job: Job, __, ___):
+            started.append(job.index)
+            return MagicMock(work=release.wait if job.lane == Lane.VIDEO else audio_done.set)
+
+        with patch('scheduler.Worker', side_effect=blocking_worker):
+            with Scheduler(self.app, 4, {'video': 1, 'audio': 3, 'remux': 2}) as scheduler:
+                for i in range(3):
+                    scheduler.submit(self.job(i, FileCheckError.VIDEO_CODEC))
+                # Submitted behind video jobs waiting for the only video slot
+                scheduler.submit(self.job(3, FileCheckError.AUDIO_CODEC))
+                self.assertTrue(audio_done.wait(timeout=5))
+                self.assertEqual(sorted(started), [0, 3])
+                release.set()
+        self.assertEqual(sorted(started), list(range(4)))
+
+    def test_backlog_is_bounded(self):
+        release = threading.Event()
+        with patch('scheduler.Worker', return_value=MagicMock(work=release.wait)):
+            with Scheduler(self.app, 2, {'video': 1, 'audio': 1, 'remux': 1}, backlog=2) as scheduler:
+                for i in range(3):
+                    scheduler.submit(self.job(i, FileCheckError.VIDEO_CODEC))
+
+                submitter = threading.Thread(target=scheduler.submit, args=(self.job(3, FileCheckError.AUDIO_CODEC),))
+                submitter.start()
+                submitter.join(timeout=0.2)
+                self.assertTrue(submitter.is_alive())
+                # Jobs with a positive priority skip the wait
+                urgent = self.job(4, FileCheckError.VIDEO_CODEC)
+                urgent.priority = 1
+                scheduler.submit(urgent)
+                release.set()
+                submitter.join()
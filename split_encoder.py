@@ -0,0 +1,183 @@
+import logging
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from pathlib import Path
+from subprocess import Popen, PIPE, DEVNULL, run
+from tempfile import gettempdir
+from typing import Callable, Optional
+
+from command_generator import generate_split_command, generate_segment_command, generate_concat_command
+from config import SPLIT_SEGMENT_SECONDS, SPLIT_THREADS_PER_SEGMENT, FFMPEG_THREADS, OUTPUT_DURATION_TOLERANCE
+from encoders import EncoderBackend, Tuning, normalize_codec, target_codec
+from ffmpeg_progress import ProgressParser, ProgressUpdate
+from filechecker import FileCheckError
+from fileparser import FileMetadata, probe_file
+from log_pipeline import FFmpegLog
+
+logger = logging.getLogger('reencode_job.split_encoder')
+
+SPLIT_FAILED = -1
+"""Return code used when a step failed without an ffmpeg return code"""
+
+
+class SplitEncoder:
+    """Encode a long file as keyframe-aligned segments in parallel
+
+    The video stream is split without re-encoding, each segment is encoded by its own
+    ffmpeg process and the results are joined with the concat demuxer along with the
+    audio of the original file. Progress of the running segments is reported as a
+    whole through on_progress, which may call terminate.
+    """
+
+    def __init__(self,
+                 input_file: Path,
+                 output_file: Path,
+                 metadata: FileMetadata,
+                 errors: FileCheckError,
+                 backend: Optional[EncoderBackend] = None,
+                 tuning: Optional[Tuning] = None,
+                 segment_seconds: int = SPLIT_SEGMENT_SECONDS,
+                 threads_per_segment: int = SPLIT_THREADS_PER_SEGMENT,
+                 threads: Optional[int] = None,
+                 on_progress: Optional[Callable[[ProgressUpdate], None]] = None,
+                 ffmpeg_log: Optional[FFmpegLog] = None,
+                 work_root: Optional[Path] = None):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.metadata = metadata
+        self.errors = errors
+        self.backend = backend
+        self.tuning = tuning
+        self.segment_seconds = segment_seconds
+        self.threads_per_segment = threads_per_segment
+        # Segments share the threads that would have been given to a single ffmpeg process
+        self.workers = max(1, (threads or FFMPEG_THREADS) // max(1, threads_per_segment))
+        self.on_progress = on_progress
+        self.ffmpeg_log = ffmpeg_log if ffmpeg_log is not None else FFmpegLog()
+        """Output of the segment encodes, shared by the segments"""
+
+        # Segments are written on local scratch space rather than next to the output on the share
+        self.work_dir = (work_root or Path(gettempdir())) / f'segments_{sha1(str(output_file).encode()).hexdigest()[:12]}'
+        self._lock = threading.RLock()
+        self._processes: set[Popen] = set()
+        self._progress: dict[int, ProgressUpdate] = {}
+        self._is_terminated = False
+
+    def terminate(self):
+        """Stop every running ffmpeg process, the encode then fails"""
+        with self._lock:
+            self._is_terminated = True
+            for process in self._processes:
+                process.terminate()
+
+    def send_signal(self, sig: int):
+        with self._lock:
+            for process in self._processes:
+                process.send_signal(sig)
+
+    def run(self) -> int:
+        """Encode the file, returns 0 on success like an ffmpeg return code"""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.work_dir.mkdir(parents=True)
+        try:
+            segments = self._split()
+            if not segments:
+                return SPLIT_FAILED
+            logger.debug('Split "%s" into %d segments', self.input_file, len(segments))
+
+            encoded = self._encode_segments(segments)
+            if encoded is None:
+                return SPLIT_FAILED
+
+            if returncode := self._concat(encoded):
+                return returncode
+            return 0 if self._verify() else SPLIT_FAILED
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _split(self) -> list[Path]:
+        cmd = generate_split_command(self.input_file, self.work_dir / 'segment_%05d.mkv', self.segment_seconds)
+        logger.debug(cmd)
+        result = run(cmd, stdout=DEVNULL, stderr=PIPE, text=True)
+        if result.returncode != 0:
+            logger.error('Failed to split "%s": %s', self.input_file, result.stderr.strip())
+            return []
+        return sorted(self.work_dir.glob('segment_*.mkv'))
+
+    def _encode_segments(self, segments: list[Path]) -> Optional[list[Path]]:
+        encoded = [segment.with_name(f'encoded_{segment.stem.split("_")[1]}.mkv') for segment in segments]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='segment') as pool:
+            returncodes = list(pool.map(self._encode_segment, range(len(segments)), segments, encoded))
+
+        if failed := [i for i, returncode in enumerate(returncodes) if returncode != 0]:
+            logger.error('Failed to encode %d segments of "%s", first failing segment: %d',
+                         len(failed), self.input_file, failed[0])
+            return None
+        return encoded
+
+    def _encode_segment(self, index: int, segment: Path, output: Path) -> int:
+        cmd = generate_segment_command(segment, output, self.metadata, self.errors,
+                                       threads=self.threads_per_segment, backend=self.backend,
+                                       tuning=self.tuning)
+        with self._lock:
+            if self._is_terminated:
+                return SPLIT_FAILED
+            process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+            self._processes.add(process)
+
+        with process:
+            log_reader = threading.Thread(target=self.ffmpeg_log.read, args=(process.stderr, f'[{index}] '),
+                                          daemon=True)
+            log_reader.start()
+            parser = ProgressParser()
+            for line in process.stdout:
+                if update := parser.feed(line):
+                    self.__report_progress(index, update)
+            log_reader.join()
+
+        with self._lock:
+            self._processes.discard(process)
+        return process.returncode
+
+    def __report_progress(self, index: int, update: ProgressUpdate):
+        with self._lock:
+            self._progress[index] = update
+            running = [progress for progress in self._progress.values() if not progress.is_end]
+            total = ProgressUpdate(out_time=sum(progress.out_time for progress in self._progress.values()),
+                                   total_size=sum(progress.total_size or 0 for progress in self._progress.values()),
+                                   speed=sum(progress.speed or 0 for progress in running) or None,
+                                   fps=sum(progress.fps or 0 for progress in running) or None,
+                                   is_end=False)
+            if self.on_progress:
+                self.on_progress(total)
+
+    def _concat(self, encoded: list[Path]) -> int:
+        segment_list = self.work_dir / 'segments.txt'
+        segment_list.write_text(''.join(f"file '{segment.name}'\n" for segment in encoded), encoding='utf-8')
+
+        cmd = generate_concat_command(segment_list, self.input_file, self.output_file, self.metadata, self.errors)
+        logger.debug(cmd)
+        result = run(cmd, stdout=DEVNULL, stderr=PIPE, text=True)
+        if result.returncode != 0:
+            logger.error('Failed to concatenate segments of "%s": %s', self.input_file, result.stderr.strip())
+        return result.returncode
+
+    def _verify(self) -> bool:
+        """Check the joined output has the expected duration and streams"""
+        output = probe_file(self.output_file)
+        if output is None:
+            logger.error('Joined output "%s" is missing its video or audio stream', self.output_file)
+            return False
+
+        expected_codec = target_codec() or normalize_codec(self.metadata.video.codec)
+        if normalize_codec(output.video.codec) != expected_codec:
+            logger.error('Joined output has a %s video stream instead of %s', output.video.codec, expected_codec)
+            return False
+
+        tolerance = max(1.0, self.metadata.duration * OUTPUT_DURATION_TOLERANCE)
+        if abs(output.duration - self.metadata.duration) > tolerance:
+            logger.error('Joined output lasts %.1fs instead of %.1fs', output.duration, self.metadata.duration)
+            return False
+        return True
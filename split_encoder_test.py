@@ -0,0 +1,88 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from bench.clips import read_clip, write_clip
+from bench.harness import fake_binaries
+from command_generator import generate_split_command, generate_concat_command
+from encoders import BACKENDS
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from split_encoder import SplitEncoder, SPLIT_FAILED
+
+CLIP = {'video_codec': 'h264', 'width': 1920, 'height': 1080, 'fps': 30, 'video_bitrate': 8_000_000,
+        'audio_codec': 'aac', 'sample_rate': 48_000, 'channels': 2, 'audio_bitrate': 256_000,
+        'duration': 610.0, 'size': 630_000_000}
+
+
+class SplitEncoderTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.input_file = self.root / 'Author - Title.mkv'
+        self.output_file = self.root / 'Author - Title_reencoded.mkv'
+        write_clip(self.input_file, CLIP)
+        self.metadata = FileMetadata(self.input_file, CLIP['size'], CLIP['duration'],
+                                     AudioMetadata('aac', 48_000, 2, 256_000, {}),
+                                     VideoMetadata('h264', 1920, 1080, '16:9', 30.0, 8_000_000, {}),
+                                     {})
+        self.updates = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def split_encoder(self, **kwargs) -> SplitEncoder:
+        return SplitEncoder(self.input_file, self.output_file, self.metadata, FileCheckError.VIDEO_CODEC,
+                            backend=BACKENDS['cpu'], segment_seconds=120, threads_per_segment=2, threads=4,
+                            on_progress=self.updates.append, **kwargs)
+
+    def test_generate_split_command(self):
+        self.assertEqual(generate_split_command(Path('input.mkv'), Path('segments/segment_%05d.mkv'), 120),
+                         ['ffmpeg', '-hide_banner', '-y', '-v', 'error', '-i', 'input.mkv',
+                          '-map', '0:v:0', '-c', 'copy',
+                          '-f', 'segment', '-segment_time', '120', '-reset_timestamps', '1',
+                          'segments/segment_%05d.mkv'])
+
+    def test_generate_concat_command_copies_audio(self):
+        result = generate_concat_command(Path('segments.txt'), self.input_file, self.output_file,
+                                         self.metadata, FileCheckError.VIDEO_CODEC)
+        self.assertEqual(result[result.index('-map'):result.index('-metadata')],
+                         ['-map', '0:v:0', '-map', '1:a:0?', '-map_metadata', '1', '-c:v', 'copy', '-c:a', 'copy'])
+
+    def test_run(self):
+        split_encoder = self.split_encoder()
+        with fake_binaries():
+            returncode = split_encoder.run()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(split_encoder.workers, 2)
+        self.assertFalse(split_encoder.work_dir.exists())
+        self.assertEqual(sorted(path.name for path in self.root.iterdir()), [self.input_file.name,
+                                                                              self.output_file.name])
+        output = read_clip(self.output_file)
+        self.assertEqual(output['video_codec'], 'hevc')
+        self.assertEqual(output['audio_codec'], 'aac')
+        self.assertAlmostEqual(output['duration'], CLIP['duration'])
+        # Progress of the 6 segments adds up to the whole file
+        self.assertAlmostEqual(self.updates[-1].out_time, CLIP['duration'])
+
+    def test_run_fails_when_a_segment_fails(self):
+        split_encoder = self.split_encoder()
+        with fake_binaries(), patch('split_encoder.generate_segment_command',
+                                    return_value=['ffmpeg', '-i', str(self.root / 'missing.mkv'), 'out.mkv']):
+            returncode = split_encoder.run()
+
+        self.assertEqual(returncode, SPLIT_FAILED)
+        self.assertFalse(self.output_file.exists())
+        self.assertFalse(split_encoder.work_dir.exists())
+
+    def test_terminate_stops_remaining_segments(self):
+        split_encoder = self.split_encoder()
+        self.updates = None
+        split_encoder.on_progress = lambda update: split_encoder.terminate()
+        with fake_binaries():
+            returncode = split_encoder.run()
+
+        self.assertEqual(returncode, SPLIT_FAILED)
+        self.assertFalse(self.output_file.exists())
@@ -0,0 +1,342 @@
+import errno
+import logging
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+from hashlib import sha1
+from math import ceil
+from pathlib import Path
+from queue import Queue
+from tempfile import mkdtemp
+from typing import Callable, Optional
+
+from config import STAGING_BUDGET, STAGING_WAIT_TIMEOUT, COPY_CHUNK_SIZE, EARLY_ABORT_RATIO
+from job import Job
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('reencode_job.staging')
+
+# copy_file_range and sendfile refuse some filesystem combinations, the copy then goes through user space
+KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def _copy_file_range(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+
+
+def _sendfile(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    return os.sendfile(destination_fd, source_fd, offset, count)
+
+
+KERNEL_COPIES = tuple(copy for copy, name in ((_copy_file_range, 'copy_file_range'), (_sendfile, 'sendfile'))
+                      if hasattr(os, name))
+
+
+def fsync_directory(directory: Path):
+    """Persist the entries of a directory, some filesystems and platforms don't support it"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def copy_file(source: Path, destination: Path) -> int:
+    """Copy the content of a file with copy_file_range or sendfile and flush it to disk
+
+    The data stays in kernel space, and copy_file_range lets NFS and SMB servers copy it
+    server side. Returns the number of bytes copied.
+    """
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        source_fd, destination_fd = source_file.fileno(), destination_file.fileno()
+        size = os.fstat(source_fd).st_size
+        offset = 0
+        for copy in KERNEL_COPIES:
+            try:
+                while offset < size:
+                    copied = copy(source_fd, destination_fd, offset, min(COPY_CHUNK_SIZE, size - offset))
+                    if not copied:
+                        break
+                    offset += copied
+                break
+            except OSError as e:
+                if e.errno not in KERNEL_COPY_FALLBACK_ERRNOS or offset:
+                    raise
+        else:
+            shutil.copyfileobj(source_file, destination_file, COPY_CHUNK_SIZE)
+            offset = destination_file.tell()
+
+        destination_file.flush()
+        os.fsync(destination_fd)
+    return offset
+
+
+def atomic_copy(source: Path, destination: Path) -> int:
+    """Copy a file next to its destination then rename it, the destination is never partially written"""
+    partial = destination.with_name(f'.{destination.name}.partial')
+    try:
+        copied = copy_file(source, partial)
+        os.replace(partial, destination)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    fsync_directory(destination.parent)
+    return copied
+
+
+def move_file(source: Path, destination: Path):
+    """Rename a file, copying it when the destination is on another filesystem"""
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        atomic_copy(source, destination)
+        source.unlink()
+
+
+@dataclass
+class StagedInput:
+    """Copy of an input on the scratch space"""
+    source: Path
+    path: Path
+    size: int = 0
+    is_ready: threading.Event = field(default_factory=threading.Event)
+    is_started: bool = False
+    is_staged: bool = False
+    is_discarded: bool = False
+
+
+@dataclass
+class StagedFiles:
+    """Files an encode reads and writes, either on the scratch space or the original ones"""
+    input: Path
+    output: Path
+    output_reserved: int = 0
+    staged_input: Optional[StagedInput] = None
+
+    @property
+    def is_output_staged(self) -> bool:
+        return self.output_reserved > 0
+
+
+class Staging:
+    """Scratch space on local storage for the inputs and outputs of the encodes
+
+    The next queued input is copied in the background while the current file encodes, the
+    output is written locally then copied onto the share and renamed once verified. Files
+    that don't fit in the byte budget are read and written in place.
+
+    Each run works in its own directory, locked for as long as the run lasts so that the
+    directories left by crashed runs can be told apart and removed on start.
+    """
+
+    def __init__(self,
+                 directory: Path,
+                 budget: int = STAGING_BUDGET,
+                 output_ratio: float = EARLY_ABORT_RATIO,
+                 wait_timeout: float = STAGING_WAIT_TIMEOUT):
+        self.directory = directory
+        self.budget = budget
+        self.output_ratio = output_ratio
+        self.wait_timeout = wait_timeout
+        self.used = 0
+        self._work_dir: Optional[Path] = None
+        self._work_lock: Optional[int] = None
+        self._lock = threading.Lock()
+        self._inputs: dict[Path, StagedInput] = {}
+        self._prefetch_queue: Queue[Optional[StagedInput]] = Queue()
+        self._thread = threading.Thread(target=self.__prefetch_loop, name='staging', daemon=True)
+
+    @property
+    def work_dir(self) -> Optional[Path]:
+        """Scratch directory of this run, removed when closing"""
+        return self._work_dir
+
+    @staticmethod
+    def __lock_path(work_dir: Path) -> Path:
+        return work_dir.with_name(f'{work_dir.name}.lock')
+
+    @classmethod
+    def __lock(cls, work_dir: Path) -> Optional[int]:
+        """Lock a work directory, returns None if another run holds it"""
+        fd = os.open(cls.__lock_path(work_dir), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def __remove_stale(self):
+        """Remove the work directories of runs that didn't close their staging"""
+        if fcntl is None:
+            return
+        for work_dir in self.directory.glob('reencode_*'):
+            if not work_dir.is_dir() or (fd := self.__lock(work_dir)) is None:
+                continue
+            logger.info('Removing stale scratch directory "%s"', work_dir)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            self.__lock_path(work_dir).unlink(missing_ok=True)
+            os.close(fd)
+
+    def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.__remove_stale()
+        self._work_dir = Path(mkdtemp(prefix='reencode_', dir=self.directory))
+        if fcntl is not None:
+            self._work_lock = self.__lock(self._work_dir)
+        self._thread.start()
+        logger.info('Staging files in "%s" with a budget of %d bytes', self._work_dir, self.budget)
+        return self
+
+    def close(self):
+        # A prefetch in progress isn't waited for, its copy is removed with the directory
+        self._prefetch_queue.put(None)
+        if self._work_dir is not None:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+        if self._work_lock is not None:
+            self.__lock_path(self._work_dir).unlink(missing_ok=True)
+            os.close(self._work_lock)
+            self._work_lock = None
+
+    def __reserve(self, size: int) -> bool:
+        with self._lock:
+            if self.used + size > self.budget:
+                return False
+            self.used += size
+            return True
+
+    def __release(self, size: int):
+        with self._lock:
+            self.used -= size
+
+    def __scratch_path(self, file_path: Path) -> Path:
+        # The name is kept since ffmpeg tags the output with the title and author found in it
+        directory = self._work_dir / sha1(str(file_path).encode()).hexdigest()[:12]
+        directory.mkdir(exist_ok=True)
+        return directory / file_path.name
+
+    @staticmethod
+    def __remove_scratch(file_path: Path):
+        file_path.unlink(missing_ok=True)
+        try:
+            file_path.parent.rmdir()
+        except OSError:
+            pass
+
+    def prefetch(self, job: Job):
+        """Copy the input of a queued job in the background"""
+        with self._lock:
+            if job.input_filename in self._inputs:
+                return
+            staged_input = StagedInput(job.input_filename, self.__scratch_path(job.input_filename))
+            self._inputs[job.input_filename] = staged_input
+        self._prefetch_queue.put(staged_input)
+
+    def __prefetch_loop(self):
+        while (staged_input := self._prefetch_queue.get()) is not None:
+            with self._lock:
+                staged_input.is_started = not staged_input.is_discarded
+            try:
+                if staged_input.is_started:
+                    self.__stage_input(staged_input)
+            finally:
+                with self._lock:
+                    staged_input.is_ready.set()
+                    is_discarded = staged_input.is_discarded
+                if is_discarded:
+                    self.__remove_input(staged_input)
+
+    def __stage_input(self, staged_input: StagedInput):
+        try:
+            size = staged_input.source.stat().st_size
+        except OSError:
+            return
+        if not self.__reserve(size):
+            logger.debug('Not enough scratch space to prefetch "%s"', staged_input.source)
+            return
+
+        staged_input.size = size
+        try:
+            copy_file(staged_input.source, staged_input.path)
+        except OSError as e:
+            logger.warning('Failed to prefetch "%s": %s', staged_input.source, e)
+            self.__remove_scratch(staged_input.path)
+            staged_input.size = 0
+            self.__release(size)
+            return
+        staged_input.is_staged = True
+        logger.debug('Prefetched "%s"', staged_input.source)
+
+    def acquire(self, job: Job, should_stop: Callable[[], bool] = lambda: False) -> StagedFiles:
+        """Files to encode the job with
+
+        The input is waited for if it is being prefetched, for up to wait_timeout seconds or until
+        should_stop returns True. An input whose copy didn't start, or takes too long, is read in
+        place rather than delaying the encode.
+        """
+        staged = StagedFiles(job.input_filename, job.output_filename)
+        with self._lock:
+            staged_input = self._inputs.get(job.input_filename)
+            is_started = staged_input is not None and staged_input.is_started
+        if staged_input is not None and is_started:
+            deadline = time.monotonic() + self.wait_timeout
+            while not staged_input.is_ready.wait(timeout=min(1.0, max(0.0, deadline - time.monotonic()))):
+                if should_stop() or time.monotonic() >= deadline:
+                    break
+        if staged_input is not None and staged_input.is_staged:
+            staged.input = staged_input.path
+            staged.staged_input = staged_input
+        elif staged_input is not None:
+            logger.debug('Reading "%s" in place, its copy is not ready', job.input_filename)
+            self.discard(job.input_filename)
+
+        # Outputs projected over the input size times the early abort ratio are aborted, without
+        # early abort nothing bounds the output and it is written in place
+        output_size = ceil(job.metadata.file_size * self.output_ratio) if job.metadata else 0
+        if output_size and self.__reserve(output_size):
+            staged.output = self.__scratch_path(job.output_filename)
+            staged.output_reserved = output_size
+        return staged
+
+    def finalize(self, staged: StagedFiles, destination: Path):
+        """Copy the staged output onto its destination"""
+        atomic_copy(staged.output, destination)
+
+    def __remove_input(self, staged_input: StagedInput):
+        if staged_input.is_staged:
+            staged_input.is_staged = False
+            self.__release(staged_input.size)
+        self.__remove_scratch(staged_input.path)
+
+    def discard(self, input_filename: Path):
+        """Remove the prefetched copy of an input, once the copy completes if it is in progress"""
+        with self._lock:
+            staged_input = self._inputs.pop(input_filename, None)
+            if staged_input is None:
+                return
+            staged_input.is_discarded = True
+            is_ready = staged_input.is_ready.is_set()
+        if is_ready:
+            self.__remove_input(staged_input)
+
+    def release(self, staged: StagedFiles):
+        """Remove the scratch files of the job"""
+        if staged.staged_input is not None:
+            self.discard(staged.staged_input.source)
+        if staged.is_output_staged:
+            self.__remove_scratch(staged.output)
+            self.__release(staged.output_reserved)
+            staged.output_reserved = 0
@@ -0,0 +1,203 @@
+import errno
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import App
+from app_test import make_args
+from bench.clips import read_clip, write_clip
+from bench.harness import fake_binaries
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from job import Job
+from staging import Staging, copy_file, move_file, _sendfile
+from worker import Worker
+
+CLIP = {'video_codec': 'h264', 'width': 1920, 'height': 1080, 'fps': 30, 'video_bitrate': 8_000_000,
+        'audio_codec': 'aac', 'sample_rate': 48_000, 'channels': 2, 'audio_bitrate': 256_000,
+        'duration': 60.0, 'size': 61_920_000}
+
+
+def cross_device(*_):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+class CopyTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.source = self.root / 'source.bin'
+        self.content = os.urandom(3 * 1024 + 7)
+        self.source.write_bytes(self.content)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_copy_file(self):
+        with patch('staging.COPY_CHUNK_SIZE', 1024):
+            self.assertEqual(copy_file(self.source, self.root / 'copy.bin'), len(self.content))
+        self.assertEqual((self.root / 'copy.bin').read_bytes(), self.content)
+
+    def test_copy_file_falls_back(self):
+        for copies in ((cross_device, _sendfile), (cross_device,)):
+            with self.subTest(copies=len(copies)), patch('staging.KERNEL_COPIES', copies):
+                copy_file(self.source, self.root / 'copy.bin')
+                self.assertEqual((self.root / 'copy.bin').read_bytes(), self.content)
+
+    def test_move_file_across_filesystems(self):
+        destination = self.root / 'destination.bin'
+        renames = []
+
+        def replace(source, target):
+            renames.append(Path(source).name)
+            if Path(source) == self.source:
+                cross_device()
+            os.rename(source, target)
+
+        with patch('staging.os.replace', side_effect=replace):
+            move_file(self.source, destination)
+        self.assertEqual(renames, ['source.bin', '.destination.bin.partial'])
+        self.assertEqual(destination.read_bytes(), self.content)
+        self.assertFalse(self.source.exists())
+        self.assertEqual(sorted(path.name for path in self.root.iterdir()), ['destination.bin'])
+
+
+class StagingTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.scratch = self.root / 'scratch'
+        self.library = self.root / 'library'
+        self.library.mkdir()
+        self.input_file = self.library / 'Author - Title.mkv'
+        self.output_file = self.library / 'Author - Title_reencoded.mp4'
+        write_clip(self.input_file, CLIP)
+        metadata = FileMetadata(self.input_file, self.input_file.stat().st_size, CLIP['duration'],
+                                AudioMetadata('aac', 48_000, 2, 256_000, {}),
+                                VideoMetadata('h264', 1920, 1080, '16:9', 30.0, 8_000_000, {}),
+                                {})
+        self.job = Job(1, self.input_file, self.output_file, metadata, FileCheckError.VIDEO_CODEC, True)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def scratch_files(self) -> list[Path]:
+        return list(self.scratch.glob('*/*'))
+
+    @staticmethod
+    def wait_until(predicate: Callable[[], bool]):
+        deadline = time.monotonic() + 5
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_prefetch_and_release(self):
+        staging = Staging(self.scratch, budget=10_000).start()
+        staging.prefetch(self.job)
+        self.wait_until(lambda: staging.used >= self.job.metadata.file_size)
+        staged = staging.acquire(self.job)
+
+        self.assertNotEqual(staged.input, self.input_file)
+        self.assertEqual(staged.input.read_bytes(), self.input_file.read_bytes())
+        self.assertTrue(staged.is_output_staged)
+        self.assertEqual(staging.used, 2 * self.job.metadata.file_size)
+
+        staged.output.write_bytes(b'output')
+        staging.finalize(staged, self.output_file)
+        staging.release(staged)
+        self.assertEqual(self.output_file.read_bytes(), b'output')
+        self.assertEqual((staging.used, self.scratch_files()), (0, []))
+        staging.close()
+        self.assertEqual(list(self.scratch.iterdir()), [])
+
+    def test_files_over_budget_are_not_staged(self):
+        staging = Staging(self.scratch, budget=self.job.metadata.file_size).start()
+        staging.prefetch(self.job)
+        self.wait_until(lambda: staging.used >= self.job.metadata.file_size)
+        staged = staging.acquire(self.job)
+        self.assertNotEqual(staged.input, self.input_file)
+        self.assertEqual((staged.output, staged.is_output_staged), (self.output_file, False))
+
+        staging.release(staged)
+        staged = staging.acquire(self.job)
+        self.assertEqual(staged.input, self.input_file)
+        self.assertTrue(staged.is_output_staged)
+        staging.release(staged)
+        staging.close()
+
+    def test_output_reservation_follows_early_abort_ratio(self):
+        for ratio, reserved in ((0.5, self.job.metadata.file_size // 2), (0, 0)):
+            with self.subTest(ratio=ratio):
+                staging = Staging(self.scratch, budget=10_000, output_ratio=ratio).start()
+                staged = staging.acquire(self.job)
+                self.assertEqual((staged.output_reserved, staging.used), (reserved, reserved))
+                self.assertEqual(staged.is_output_staged, bool(ratio))
+                staging.release(staged)
+                staging.close()
+
+    def test_stale_work_directories_are_removed(self):
+        running = Staging(self.scratch, budget=10_000).start()
+        stale = self.scratch / 'reencode_stale'
+        (stale / 'abc').mkdir(parents=True)
+        (stale / 'abc' / 'Author - Title.mkv').write_bytes(b'partial')
+
+        staging = Staging(self.scratch, budget=10_000).start()
+        self.assertFalse(stale.exists())
+        self.assertTrue(running.work_dir.exists())
+        staging.close()
+        running.close()
+        self.assertEqual(list(self.scratch.iterdir()), [])
+
+    def test_slow_prefetch_is_not_waited_for(self):
+        other_file = self.library / 'Other.mkv'
+        write_clip(other_file, CLIP)
+        other_job = Job(2, other_file, self.library / 'Other_reencoded.mp4', self.job.metadata,
+                        FileCheckError.VIDEO_CODEC, True)
+        copying, release = threading.Event(), threading.Event()
+
+        def slow_copy(source: Path, destination: Path) -> int:
+            copying.set()
+            release.wait()
+            return copy_file(source, destination)
+
+        staging = Staging(self.scratch, budget=10_000).start()
+        with patch('staging.copy_file', side_effect=slow_copy):
+            staging.prefetch(self.job)
+            staging.prefetch(other_job)
+            self.assertTrue(copying.wait(timeout=5))
+            # Queued behind the copy in progress
+            staged_other = staging.acquire(other_job)
+            # Copy in progress, until the timeout or a stop
+            staged = staging.acquire(self.job, should_stop=lambda: True)
+            self.assertEqual((staged.input, staged_other.input), (self.input_file, other_file))
+            staging.release(staged)
+            staging.release(staged_other)
+            release.set()
+            self.wait_until(lambda: staging.used == 0)
+        self.assertEqual((staging.used, self.scratch_files()), (0, []))
+        staging.close()
+
+    def test_discard_prefetched_input(self):
+        staging = Staging(self.scratch, budget=10_000).start()
+        staging.prefetch(self.job)
+        staging.discard(self.input_file)
+        staging.close()
+        self.assertEqual(staging.used, 0)
+
+    def test_worker_encodes_on_scratch(self):
+        app = App(make_args(self.library, staging=self.scratch))
+        app.encoders = None
+        # Stub clips are much smaller than the media they describe
+        self.job.metadata.file_size = CLIP['size']
+        app.staging.prefetch(self.job)
+        self.wait_until(lambda: app.staging.used >= CLIP['size'])
+        with fake_binaries():
+            Worker(app, self.job).work()
+
+        self.assertEqual(read_clip(self.output_file)['video_codec'], 'hevc')
+        self.assertEqual((app.staging.used, self.scratch_files()), (0, []))
+        app.staging.close()
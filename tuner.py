@@ -0,0 +1,177 @@
+import logging
+import math
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from subprocess import run, DEVNULL, PIPE
+from tempfile import TemporaryDirectory
+from typing import Callable, Optional
+
+from command_generator import generate_sample_command
+from config import CRITERIAS, TUNING_SAMPLES, TUNING_SAMPLE_SECONDS
+from encoders import EncoderBackend, Tuning, TUNING_SPACES, normalize_codec, target_codec
+from filechecker import FileCheckError
+from fileparser import FileMetadata, probe_format
+from predictor import HEIGHT_CLASSES
+from priority import estimate_video_bitrate, source_bitrates
+
+logger = logging.getLogger('reencode_job.tuner')
+
+
+@dataclass
+class Measure:
+    """Speed and bitrate achieved by the sample encodes of a tuning"""
+    tuning: Tuning
+    speed: float
+    """Encode speed in x realtime"""
+    bitrate: float
+
+
+def tuning_key(encoder: str, metadata: FileMetadata, errors: FileCheckError) -> str:
+    """Group files expected to need the same settings: same encoder, output resolution and content class"""
+    video = metadata.video
+    height = min(video.width, video.height)
+    if errors & FileCheckError.VIDEO_RESOLUTION:
+        height = min(height, min(CRITERIAS['video']['resolution']))
+    height_class = next((h for h in HEIGHT_CLASSES if height <= h), HEIGHT_CLASSES[-1] * 2)
+
+    # Bits per pixel tell grainy or busy content apart from flat content at the same resolution
+    video_bitrate, _ = source_bitrates(metadata)
+    bits_per_pixel = video_bitrate / max(1.0, video.width * video.height * (video.frame_rate or 30))
+    content_class = round(math.log2(max(1e-3, bits_per_pixel)) * 2)
+    target_class = int(math.log2(max(1.0, estimate_video_bitrate(metadata, errors) / 1000)))
+    return '|'.join(map(str, (encoder, height_class, normalize_codec(video.codec), content_class, target_class)))
+
+
+class Tuner:
+    """Pick the fastest preset and constant quality keeping the output under its estimated bitrate
+
+    A few evenly spaced excerpts of the input are encoded with each candidate setting, the
+    decision is stored per encoder, output resolution and content class so that the search
+    only runs on the first file of each group.
+    """
+
+    def __init__(self, db_path: Path, samples: int = TUNING_SAMPLES, sample_seconds: float = TUNING_SAMPLE_SECONDS):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.samples = samples
+        self.sample_seconds = sample_seconds
+
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS tunings ('
+                             'key TEXT PRIMARY KEY, '
+                             'preset TEXT, '
+                             'quality INTEGER, '
+                             'speed REAL, '
+                             'bitrate REAL, '
+                             'tuned_at REAL NOT NULL)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def tune(self,
+             input_file: Path,
+             metadata: FileMetadata,
+             errors: FileCheckError,
+             backend: EncoderBackend,
+             threads: Optional[int] = None,
+             should_stop: Optional[Callable[[], bool]] = None) -> Optional[Tuning]:
+        """Tuning of the full encode, None keeps the bitrate target of the criterias
+
+        Only complete searches are stored, a search that failed or was stopped runs again on the
+        next file of the group.
+        """
+        codec = target_codec() or metadata.video.codec
+        space = backend.tuning_space(codec)
+        if (space is None or not errors & FileCheckError.ALL_VIDEO
+                or metadata.duration < 2 * self.samples * self.sample_seconds):
+            return None
+
+        key = tuning_key(backend.encoder_for(codec), metadata, errors)
+        with self._lock:
+            row = self._db.execute('SELECT preset, quality FROM tunings WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            preset, quality = row
+            logger.debug('Tuning of "%s" found: %s', key, f'{preset} at {quality}' if preset else 'none')
+            return Tuning(backend.encoder_for(codec), preset, quality) if preset else None
+
+        target = estimate_video_bitrate(metadata, errors)
+        logger.info('Tuning %s on %d samples of "%s" for %d bits/s', backend.encoder_for(codec), self.samples,
+                    input_file.name, target)
+        with TemporaryDirectory(prefix='reencode_tuning_') as work_dir:
+            measures = self.__search(input_file, Path(work_dir), metadata, errors, backend, threads, target,
+                                     should_stop or (lambda: False))
+        if measures is None:
+            logger.info('Sample encodes failed or were stopped, keeping the bitrate target')
+            return None
+
+        best = max(measures, key=lambda measure: measure.speed) if measures else None
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO tunings VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, best.tuning.preset if best else None, best.tuning.quality if best else None,
+                              best.speed if best else None, best.bitrate if best else None, time.time()))
+        if best is None:
+            logger.info('No setting reaches %d bits/s, keeping the bitrate target', target)
+            return None
+        logger.info('Tuned to preset %s at quality %d (%.2fx, %d bits/s)',
+                    best.tuning.preset, best.tuning.quality, best.speed, best.bitrate)
+        return best.tuning
+
+    def __search(self, input_file: Path, work_dir: Path, metadata: FileMetadata, errors: FileCheckError,
+                 backend: EncoderBackend, threads: Optional[int], target: float,
+                 should_stop: Callable[[], bool]) -> Optional[list[Measure]]:
+        """Setting of each preset that meets the target, None if a sample encode failed or should_stop returned True
+
+        Slower presets compress better, the quality that met the target with a faster preset
+        is the starting point of the next one.
+        """
+        encoder = backend.encoder_for(target_codec() or metadata.video.codec)
+        space = TUNING_SPACES[encoder]
+        measures = []
+        quality_index = 0
+        for preset in space.presets:
+            while True:
+                measure = self.__measure(input_file, work_dir, metadata, errors, backend, threads,
+                                         Tuning(encoder, preset, space.qualities[quality_index]))
+                if measure is None or should_stop():
+                    return None
+                logger.debug('Preset %s at quality %d: %.2fx, %d bits/s',
+                             preset, measure.tuning.quality, measure.speed, measure.bitrate)
+                if measure.bitrate <= target:
+                    measures.append(measure)
+                    break
+                if quality_index == len(space.qualities) - 1:
+                    break
+                quality_index += 1
+        return measures
+
+    def __measure(self, input_file: Path, work_dir: Path, metadata: FileMetadata, errors: FileCheckError,
+                  backend: EncoderBackend, threads: Optional[int], tuning: Tuning) -> Optional[Measure]:
+        elapsed, size, duration = 0.0, 0, 0.0
+        for i in range(self.samples):
+            start = metadata.duration * (i + 1) / (self.samples + 1) - self.sample_seconds / 2
+            output = work_dir / f'sample_{i}.mkv'
+            cmd = generate_sample_command(input_file, output, metadata, errors, start, self.sample_seconds, tuning,
+                                          threads=threads, backend=backend)
+            started_at = time.monotonic()
+            result = run(cmd, stdout=DEVNULL, stderr=PIPE, text=True)
+            elapsed += time.monotonic() - started_at
+            if result.returncode != 0:
+                logger.warning('Failed to encode a sample of "%s": %s', input_file, result.stderr.strip())
+                return None
+            # Samples cut past the last keyframe are shorter than requested, their duration is read back.
+            # They have no audio stream, only their format is probed
+            if (sample := probe_format(output)) is None:
+                logger.warning('Failed to read a sample of "%s"', input_file)
+                return None
+            sample_size, sample_duration = sample
+            size += sample_size
+            duration += sample_duration
+            output.unlink()
+
+        duration = duration or self.samples * self.sample_seconds
+        return Measure(tuning, duration / max(elapsed, 1e-3), size * 8 / duration)
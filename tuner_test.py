@@ -0,0 +1,127 @@
+import os
+from dataclasses import replace
+from pathlib import Path
+from subprocess import run
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import App
+from app_test import make_args
+from bench.clips import read_clip, write_clip
+from bench.harness import fake_binaries
+from command_generator import generate_sample_command, generate_video_params
+from config import CRITERIAS
+from encoders import BACKENDS, Tuning, TUNING_SPACES
+from filechecker import FileCheckError
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata, probe_file, probe_format
+from job import Job
+from tuner import Tuner, tuning_key
+from worker import Worker
+
+CLIP = {'video_codec': 'h264', 'width': 1920, 'height': 1080, 'fps': 30, 'video_bitrate': 8_000_000,
+        'audio_codec': 'aac', 'sample_rate': 48_000, 'channels': 2, 'audio_bitrate': 192_000,
+        'duration': 600.0, 'size': 614_400_000}
+ERRORS = FileCheckError.VIDEO_CODEC | FileCheckError.VIDEO_BITRATE
+
+
+class TunerTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.input_file = self.root / 'input.mkv'
+        write_clip(self.input_file, CLIP)
+        self.metadata = FileMetadata(self.input_file, CLIP['size'], CLIP['duration'],
+                                     AudioMetadata('aac', 48_000, 2, 192_000, {}),
+                                     VideoMetadata('h264', 1920, 1080, '16:9', 30.0, 8_000_000, {}),
+                                     {})
+        self.tuner = Tuner(self.root / 'tuning.sqlite')
+
+    def tearDown(self):
+        self.tuner.close()
+        self.tmp_dir.cleanup()
+
+    def tune(self, output_ratio: float, metadata=None):
+        with fake_binaries(), patch.dict(os.environ, {'BENCH_OUTPUT_RATIO': str(output_ratio)}):
+            return self.tuner.tune(self.input_file, metadata or self.metadata, ERRORS, BACKENDS['cpu'])
+
+    def test_fastest_setting_meeting_the_target(self):
+        # 28 is the first quality whose samples stay under the 2 Mb/s target
+        tuning = self.tune(0.2)
+        self.assertEqual(tuning.quality, 28)
+        self.assertIn(tuning.preset, TUNING_SPACES['libx265'].presets)
+
+        with patch('tuner.run') as ffmpeg:
+            self.assertEqual(self.tune(0.2), tuning)
+            similar = replace(self.metadata, video=replace(self.metadata.video, bitrate=8_200_000))
+            self.assertEqual(self.tune(0.2, similar), tuning)
+        ffmpeg.assert_not_called()
+
+    def test_unreachable_target_is_remembered(self):
+        self.assertIsNone(self.tune(1.0))
+        with patch('tuner.run') as ffmpeg:
+            self.assertIsNone(self.tune(0.2))
+        ffmpeg.assert_not_called()
+
+    def test_failed_sample_is_not_remembered(self):
+        self.input_file.write_bytes(b'not a clip')
+        with self.assertLogs('reencode_job.tuner', 'WARNING'):
+            self.assertIsNone(self.tune(0.2))
+        write_clip(self.input_file, CLIP)
+        self.assertIsNotNone(self.tune(0.2))
+
+    def test_stopped_search_is_not_remembered(self):
+        with fake_binaries(), patch.dict(os.environ, {'BENCH_OUTPUT_RATIO': '0.2'}):
+            self.assertIsNone(self.tuner.tune(self.input_file, self.metadata, ERRORS, BACKENDS['cpu'],
+                                              should_stop=lambda: True))
+        self.assertIsNotNone(self.tune(0.2))
+
+    def test_samples_have_no_audio(self):
+        sample = self.root / 'sample.mkv'
+        cmd = generate_sample_command(self.input_file, sample, self.metadata, ERRORS, 60.0, 5.0,
+                                      Tuning('libx265', 'fast', 28), backend=BACKENDS['cpu'])
+        with fake_binaries():
+            run(cmd, check=True)
+            with self.assertLogs('reencode_job', 'DEBUG'):
+                self.assertIsNone(probe_file(sample))
+            self.assertEqual(probe_format(sample), (read_clip(sample)['size'], 5.0))
+
+    def test_short_files_are_not_tuned(self):
+        with patch('tuner.run') as ffmpeg:
+            self.assertIsNone(self.tune(0.2, replace(self.metadata, duration=20.0)))
+        ffmpeg.assert_not_called()
+
+    def test_tuning_key(self):
+        key = tuning_key('libx265', self.metadata, ERRORS)
+        self.assertEqual(tuning_key('libx265', replace(self.metadata, file_size=1), ERRORS), key)
+        self.assertNotEqual(tuning_key('hevc_nvenc', self.metadata, ERRORS), key)
+        grainy = replace(self.metadata, video=replace(self.metadata.video, bitrate=30_000_000))
+        self.assertNotEqual(tuning_key('libx265', grainy, ERRORS), key)
+        uhd = replace(self.metadata, video=replace(self.metadata.video, width=3840, height=2160))
+        self.assertNotEqual(tuning_key('libx265', uhd, ERRORS), key)
+        # Downscaled files are grouped by their output resolution
+        self.assertEqual(tuning_key('libx265', uhd, ERRORS | FileCheckError.VIDEO_RESOLUTION).split('|')[1], '1080')
+
+    def test_tuned_video_params(self):
+        tuning = Tuning('libx265', 'fast', 26)
+        self.assertEqual(generate_video_params(self.metadata.video, ERRORS, BACKENDS['cpu'], tuning),
+                         ['-c:v', 'libx265', '-preset', 'fast', '-crf', 26,
+                          '-maxrate', 2_000_000, '-bufsize', 4_000_000])
+        self.assertEqual(generate_video_params(self.metadata.video, ERRORS, BACKENDS['nvenc'], tuning),
+                         ['-c:v', 'hevc_nvenc', '-b:v', 2_000_000])
+
+    def test_worker_encodes_with_tuning(self):
+        output_file = self.root / 'output.mp4'
+        with patch('app.TUNING_CACHE_FILE', self.root / 'app_tuning.sqlite'):
+            app = App(make_args(self.root, tune=True))
+        app.encoders = None
+        job = Job(1, self.input_file, output_file, self.metadata, ERRORS, True)
+        with (fake_binaries(), patch.dict(os.environ, {'BENCH_OUTPUT_RATIO': '0.2'}),
+              patch.dict(CRITERIAS['video'], codec_encoder='libx265'),
+              self.assertLogs('reencode_job', 'DEBUG') as logs):
+            Worker(app, job).work()
+        app.tuner.close()
+
+        command, = [record.msg for record in logs.records if isinstance(record.msg, list)]
+        self.assertEqual(command[command.index('-crf') + 1], '28')
+        self.assertEqual(read_clip(output_file)['video_codec'], 'hevc')
@@ -0,0 +1,238 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from config import WATCH_QUIESCENCE_SECONDS, WATCH_RESCAN_INTERVAL, WATCH_POLL_INTERVAL
+from filechecker import check_file_ext
+
+logger = logging.getLogger('reencode_job.watcher')
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+FILE_CHANGED_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal ctypes binding of the Linux inotify API"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: Path, mask: int = WATCH_MASK) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float) -> list[tuple[int, int, str]]:
+        """Wait up to timeout seconds for events and return them as (wd, mask, name) tuples"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class QuiescenceTracker:
+    """Keep track of changed files until their size and mtime stop changing"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._files: dict[Path, tuple[int, int, float]] = {}
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path: Path):
+        return path in self._files
+
+    def touch(self, path: Path):
+        """Restart the quiescence window of the file"""
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._files.pop(path, None)
+            return
+        self._files[path] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+
+    def discard(self, path: Path):
+        self._files.pop(path, None)
+
+    def pop_stable(self) -> list[Path]:
+        """Return the files that didn't change during the quiescence window"""
+        now = time.monotonic()
+        stable = []
+        for path, (size, mtime_ns, since) in list(self._files.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self._files[path]
+                continue
+
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self._files[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - since >= self.window:
+                del self._files[path]
+                stable.append(path)
+        return stable
+
+
+class Watcher:
+    """Wait for new or modified files in the content path
+
+    Relies on inotify when available with a periodic full rescan as a fallback for missed events
+    (e.g. changes made from another host on a network share). Without inotify a full rescan is
+    requested every WATCH_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self,
+                 root: Path,
+                 quiescence: float = WATCH_QUIESCENCE_SECONDS,
+                 rescan_interval: float = WATCH_RESCAN_INTERVAL):
+        self.root = root
+        self.tracker = QuiescenceTracker(quiescence)
+        self.rescan_interval = rescan_interval
+
+        self._inotify: Optional[Inotify] = None
+        self._watches: dict[int, Path] = {}
+        self._last_rescan = time.monotonic()
+        self._needs_rescan = False
+
+        if root.is_dir():
+            try:
+                self._inotify = Inotify()
+                self._watch_tree(root)
+                logger.info('Watching %d directories with inotify', len(self._watches))
+            except (OSError, AttributeError) as e:
+                logger.warning('inotify is unavailable, falling back to periodic rescans: %s', e)
+                self.close()
+
+        if self._inotify is None:
+            self.rescan_interval = min(self.rescan_interval, WATCH_POLL_INTERVAL)
+
+    def close(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+            self._watches.clear()
+
+    def _watch_tree(self, directory: Path, is_new: bool = False):
+        for root, _, filenames in os.walk(directory):
+            root = Path(root)
+            try:
+                self._watches[self._inotify.add_watch(root)] = root
+            except OSError as e:
+                logger.warning('Unable to watch "%s": %s', root, e)
+                self._needs_rescan = True
+            if is_new:
+                for filename in filenames:
+                    self.track(Path(root, filename))
+
+    def is_settled(self, path: Path) -> bool:
+        """Check whether the file hasn't been modified during the quiescence window"""
+        try:
+            return time.time() - path.stat().st_mtime >= self.tracker.window
+        except FileNotFoundError:
+            return False
+
+    def track(self, path: Path):
+        if check_file_ext(path)[0]:
+            self.tracker.touch(path)
+
+    def _handle_event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('inotify event queue overflowed')
+            self._needs_rescan = True
+            return
+
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+
+        directory = self._watches.get(wd)
+        if directory is None or not name:
+            return
+        path = directory / name
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path, is_new=True)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.tracker.discard(path)
+        elif mask & FILE_CHANGED_MASK:
+            self.track(path)
+
+    def wait(self, should_stop: Callable[[], bool]) -> Optional[list[Path]]:
+        """Block until some files are ready to be processed
+
+        Returns the list of stable files, None when a full rescan is due,
+        or an empty list if should_stop returned True.
+        """
+        while not should_stop():
+            if self._inotify:
+                for event in self._inotify.read_events(timeout=1):
+                    self._handle_event(*event)
+            else:
+                time.sleep(1)
+
+            now = time.monotonic()
+            if self._needs_rescan or now - self._last_rescan >= self.rescan_interval:
+                self._needs_rescan = False
+                self._last_rescan = now
+                return None
+
+            if stable := self.tracker.pop_stable():
+                return stable
+        return []
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from watcher import QuiescenceTracker, Watcher
+
+
+class QuiescenceTrackerTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.video = Path(self.tmp_dir.name, 'video.mp4')
+        self.video.write_bytes(b'\0' * 10)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_pop_stable_waits_for_window(self):
+        tracker = QuiescenceTracker(window=60)
+        tracker.touch(self.video)
+        self.assertEqual(tracker.pop_stable(), [])
+        self.assertIn(self.video, tracker)
+
+    def test_pop_stable_returns_settled_file(self):
+        tracker = QuiescenceTracker(window=0)
+        tracker.touch(self.video)
+        self.assertEqual(tracker.pop_stable(), [self.video])
+        self.assertEqual(len(tracker), 0)
+
+    def test_pop_stable_restarts_window_on_change(self):
+        tracker = QuiescenceTracker(window=0)
+        tracker.touch(self.video)
+        self.video.write_bytes(b'\0' * 20)
+        self.assertEqual(tracker.pop_stable(), [])
+        self.assertEqual(tracker.pop_stable(), [self.video])
+
+    def test_pop_stable_forgets_deleted_file(self):
+        tracker = QuiescenceTracker(window=0)
+        tracker.touch(self.video)
+        self.video.unlink()
+        self.assertEqual(tracker.pop_stable(), [])
+        self.assertEqual(len(tracker), 0)
+
+
+@skipUnless(sys.platform == 'linux', 'inotify is only available on Linux')
+class WatcherTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        (self.root / 'sub').mkdir()
+        self.watcher = Watcher(self.root, quiescence=0, rescan_interval=3600)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmp_dir.cleanup()
+
+    def wait(self):
+        deadline = time.monotonic() + 5
+        return self.watcher.wait(lambda: time.monotonic() > deadline)
+
+    def test_wait_returns_new_file(self):
+        video = self.root / 'sub' / 'video.mp4'
+        video.write_bytes(b'\0' * 10)
+        self.assertEqual(self.wait(), [video])
+
+    def test_wait_ignores_non_video_files(self):
+        (self.root / 'notes.txt').write_text('notes')
+        deadline = time.monotonic() + 1.5
+        self.assertEqual(self.watcher.wait(lambda: time.monotonic() > deadline), [])
+
+    def test_wait_returns_files_of_new_directory(self):
+        new_dir = self.root / 'new'
+        new_dir.mkdir()
+        (new_dir / 'nested').mkdir()
+        video = new_dir / 'nested' / 'video.mkv'
+        video.write_bytes(b'\0' * 10)
+        self.assertEqual(self.wait(), [video])
+
+    def test_wait_requests_rescan(self):
+        self.watcher.rescan_interval = 0
+        self.assertIsNone(self.wait())
+
+    def test_is_settled(self):
+        video = self.root / 'video.mp4'
+        video.write_bytes(b'\0' * 10)
+        with patch.object(self.watcher.tracker, 'window', 60):
+            self.assertFalse(self.watcher.is_settled(video))
+            os.utime(video, (time.time() - 120, time.time() - 120))
+            self.assertTrue(self.watcher.is_settled(video))
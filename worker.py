@@ -1,10 +1,11 @@
+import errno
 import logging
 import math
-import re
-from datetime import timedelta
-from os import makedirs, replace
+import signal
+from os import makedirs
 from pathlib import Path
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE
+from threading import Thread
 from typing import Optional
 
 from tqdm import tqdm
@@ -12,13 +13,27 @@ from tqdm import tqdm
 from app import App
 from colorized_logger import PROGRESS, SKIP, DESTRUCTIVE, ROLLBACK
 from command_generator import generate_ffmpeg_command
-from filechecker import check_file, FileCheckError
+from config import EARLY_ABORT_MIN_PROGRESS, EARLY_ABORT_RATIO, OUTPUT_DURATION_TOLERANCE, SPLIT_MIN_DURATION
+from dedup import reuse_file
+from encoders import EncoderBackend, Tuning, configured_backend
+from ffmpeg_progress import ProgressParser, ProgressUpdate
+from filechecker import FileCheckError
 from fileparser import probe_file
+from job import Job, Lane
+from journal import JobState
+from log_pipeline import FFmpegLog
+from metrics import FILES_SKIPPED, FILES_ENCODED, BYTES_IN, BYTES_OUT, BYTES_SAVED, ENCODE_SPEED, \
+    STAGE_SECONDS, record_failure
+from outcome_cache import Outcome
+from prefetcher import prepare_job
+from split_encoder import SplitEncoder
+from staging import StagedFiles, move_file
 
 logger = logging.getLogger('reencode_job.worker')
-p_duration = re.compile(r"Duration: (?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})\.(?P<ms>\d{2})")
-p_time = re.compile(r"time=(?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})\.(?P<ms>\d{2})")
 
+# Job control signals are not available on Windows
+SIGSTOP = getattr(signal, 'SIGSTOP', None)
+SIGCONT = getattr(signal, 'SIGCONT', None)
 
 def safe_log(num: float, base: int):
     if num == 0:
@@ -56,57 +71,152 @@ def calc_ratio(isize, osize):
 
 class Worker:
     """Worker class that processes a file"""
-    def __init__(self, app: App, i: int, input_filename: Path, output_filename: Path):
+    def __init__(self, app: App, job: Job, slot: int = 0, threads: Optional[int] = None):
         self.app = app
-        self.i = i
-        self.input_filename = input_filename
-        self.output_filename = output_filename
-
-        self._input_duration: Optional[int] = None
+        self.job = job
+        self.slot = slot
+        self.threads = threads
+        self.input_filename = job.input_filename
+        self.output_filename = job.output_filename
+        self._source = job.input_filename
+        """File read by ffmpeg, a local copy of the input when it is staged"""
+
+        self._input_duration: Optional[float] = job.metadata.duration if job.metadata else None
         self._next_log = 0
         self._progress: Optional[tqdm] = None
+        self._ffmpeg: Optional[Popen | SplitEncoder] = None
+        self._ffmpeg_log = FFmpegLog()
+        self._projected_size: Optional[int] = None
+        self.is_paused = False
+        self.is_cancelled = False
+
+    def pause(self) -> bool:
+        """Suspend the running encode, returns False if nothing is being encoded"""
+        if SIGSTOP is None or self._ffmpeg is None or self.is_cancelled:
+            return False
+        self._ffmpeg.send_signal(SIGSTOP)
+        self.is_paused = True
+        logger.info('Paused "%s"', self.input_filename)
+        return True
+
+    def resume(self) -> bool:
+        if not self.is_paused:
+            return False
+        self._ffmpeg.send_signal(SIGCONT)
+        self.is_paused = False
+        logger.info('Resumed "%s"', self.input_filename)
+        return True
 
-    def __handle_ffmpeg_output(self, line: str):
-        if not self._input_duration and (m := p_duration.search(line)):
-            self._input_duration = timedelta(hours=int(m['hour']),
-                                             minutes=int(m['min']),
-                                             seconds=int(m['sec']),
-                                             milliseconds=int(m['ms'])).total_seconds()
-            self._progress = tqdm(total=self._input_duration,
+    def cancel(self):
+        """Stop the job, its output is discarded"""
+        self.is_cancelled = True
+        if self._ffmpeg is not None:
+            self._ffmpeg.terminate()
+            if self.is_paused:
+                # Stopped processes only handle the termination signal once continued
+                self._ffmpeg.send_signal(SIGCONT)
+                self.is_paused = False
+
+    def __handle_cancel(self):
+        self.__reset_progress()
+        logger.log(SKIP, 'Cancelled')
+        FILES_SKIPPED.inc()
+        self.__transition(JobState.SKIPPED)
+        self.output_filename.unlink(missing_ok=True)
+
+    def __transition(self, state: JobState):
+        if self.app.journal is not None:
+            self.app.journal.transition(self.input_filename, state)
+
+    def __record_outcome(self, outcome: Outcome, detail: str):
+        if self.app.outcome_cache is not None:
+            self.app.outcome_cache.record(self.input_filename, outcome, detail)
+
+    def __handle_progress(self, update: ProgressUpdate):
+        self.job.progress = update
+        if self._progress is None:
+            self._progress = tqdm(total=self._input_duration or None,
                                   desc=trim_filename(self.input_filename),
                                   unit='sec',
+                                  position=self.slot + 1,
                                   leave=False)
 
-        if self._progress and (m := p_time.search(line)):
-            out_time = timedelta(hours=int(m['hour']),
-                                 minutes=int(m['min']),
-                                 seconds=int(m['sec']),
-                                 milliseconds=int(m['ms'])).total_seconds()
-            self._progress.update(out_time - self._progress.n)
+        out_time = min(update.out_time, self._input_duration) if self._input_duration else update.out_time
+        self._progress.update(out_time - self._progress.n)
+        ENCODE_SPEED.labels(self.slot).set(update.speed or 0)
+        if update.speed:
+            self._progress.set_postfix_str(f'{update.speed:.2f}x', refresh=False)
+
+        if not self._input_duration:
+            return
 
-            progress = out_time / self._input_duration
+        progress = out_time / self._input_duration
+        if progress * 10 >= self._next_log:
             time_remaining = self._input_duration - out_time
-            if progress * 10 >= self._next_log:
-                logger.log(PROGRESS, "%d secs | %.2f%%", time_remaining, progress * 100)
-                self._next_log = int(progress * 10) + 1
+            logger.log(PROGRESS, "%d secs | %.2f%% | speed: %sx", time_remaining, progress * 100,
+                       f'{update.speed:.2f}' if update.speed else '?')
+            self._next_log = int(progress * 10) + 1
+
+        if update.total_size:
+            self.__check_projected_size(update.total_size, progress)
+
+    def __check_projected_size(self, out_size: int, progress: float):
+        """Abort the encode early if the output is on track to end up larger than allowed"""
+        if not EARLY_ABORT_RATIO or self._projected_size or progress < EARLY_ABORT_MIN_PROGRESS:
+            return
+
+        in_size = self.job.metadata.file_size
+        projected_size = int(out_size / progress)
+        if projected_size > in_size * EARLY_ABORT_RATIO:
+            logger.log(SKIP, 'Projected output size %s exceeds input size %s at %.0f%%, aborting',
+                       format_bytes(projected_size), format_bytes(in_size), progress * 100)
+            self._projected_size = projected_size
+            self._ffmpeg.terminate()
+
+    def __handle_early_abort(self):
+        self.__reset_progress()
+        FILES_SKIPPED.inc()
+        self.__transition(JobState.SKIPPED)
+        in_size = self.job.metadata.file_size
+        logger.info('%s -> %s projected (ratio: %.2fx)',
+                    format_bytes(in_size), format_bytes(self._projected_size),
+                    calc_ratio(in_size, self._projected_size),
+                    extra={'event': {'event': 'aborted', 'path': self.input_filename,
+                                     'input_size': in_size, 'projected_size': self._projected_size}})
+        if self.app.predictor is not None:
+            self.app.predictor.record(self.job.metadata, self.job.errors, in_size, self._projected_size,
+                                      self.job.prediction)
+        self.__record_outcome(Outcome.LARGER, f'projected {self._projected_size} bytes')
+        if self.output_filename.exists():
+            self.output_filename.unlink()
 
     def __replace_output_file(self):
         # Replace the original file but keep the new extension
         new_name = Path(self.input_filename).with_suffix(self.output_filename.suffix)
         try:
-            replace(self.output_filename, new_name)
+            with STAGE_SECONDS.labels('replace').time():
+                move_file(self.output_filename, new_name)
+            if self.app.metadata_cache is not None:
+                self.app.metadata_cache.invalidate(new_name)
             if self.input_filename != new_name:
                 logger.log(DESTRUCTIVE, 'Extension has changed, removing original file')
                 self.input_filename.unlink()
         except OSError as e:
-            known_errors = {5}  # Access denied
-            logger.log(SKIP, 'Failed to replace', exc_info=e.winerror not in known_errors)
+            known_errors = {errno.EACCES, errno.EPERM}
+            logger.log(SKIP, 'Failed to replace', exc_info=e.errno not in known_errors)
             return False
         return True
 
-    def __handle_child_process_error(self, ffmpeg):
+    def __handle_child_process_error(self, returncode: int):
+        self.__reset_progress()
         logger.error('Failed to process "%s": return code was %d',
-                     self.input_filename, ffmpeg.returncode)
+                     self.input_filename, returncode,
+                     extra={'event': {'event': 'failed', 'path': self.input_filename, 'returncode': returncode}})
+        if not self.app.is_interrupted:
+            # Interrupted jobs are left in flight in the journal so that they are resumed
+            record_failure(self.job.errors)
+            self.__record_outcome(Outcome.FAILED, f'return code {returncode}')
+            self.__transition(JobState.FAILED)
         if self.app.args.is_clean_on_error_enabled:
             logger.log(ROLLBACK, 'Removing job leftover')
             if self.output_filename.exists():
@@ -116,84 +226,350 @@ class Worker:
         if self.app.is_interrupted:
             logger.log(SKIP, 'Interrupted')
 
+    def __flush_ffmpeg_log(self, returncode: int):
+        """Log the buffered ffmpeg output of failed encodes, or of every encode in verbose mode"""
+        if returncode != 0 and not (self.is_cancelled or self._projected_size):
+            self._ffmpeg_log.flush(logger, logging.ERROR)
+        elif self.app.args.is_verbose_enabled:
+            self._ffmpeg_log.flush(logger, logging.DEBUG)
+        else:
+            self._ffmpeg_log.clear()
+
     def __child_process_mainloop(self, ffmpeg):
-        while not self.app.is_interrupted and ffmpeg.poll() is None:
-            for line in ffmpeg.stdout:
-                logger.debug("[FFMPEG] %s", line.rstrip())
-                self.__handle_ffmpeg_output(line)
-            if self.app.is_interrupted:
+        log_reader = Thread(target=self._ffmpeg_log.read, args=(ffmpeg.stderr,), daemon=True)
+        log_reader.start()
+
+        parser = ProgressParser()
+        for line in ffmpeg.stdout:
+            if update := parser.feed(line):
+                self.__handle_progress(update)
+
+            if self.app.is_interrupted and ffmpeg.poll() is None:
                 logger.info("Sending termination signal to ffmpeg subprocess")
                 ffmpeg.terminate()
+        log_reader.join()
+
+    def __verify_output(self) -> bool:
+        """Check that the output can be read back and is as long as the input"""
+        output_metadata = probe_file(self.output_filename)
+        if output_metadata is None:
+            logger.error('Output file "%s" is unreadable', self.output_filename)
+            self.__record_outcome(Outcome.CORRUPT, 'unreadable output')
+            return False
+
+        in_duration, out_duration = self.job.metadata.duration, output_metadata.duration
+        if in_duration and abs(in_duration - out_duration) > max(1.0, in_duration * OUTPUT_DURATION_TOLERANCE):
+            logger.error('Output duration of %.1fs does not match input duration of %.1fs',
+                         out_duration, in_duration)
+            self.__record_outcome(Outcome.CORRUPT, f'duration {out_duration:.1f}s instead of {in_duration:.1f}s')
+            return False
+        return True
 
     def __log_result_stats(self, file_metadata):
         in_size = file_metadata.file_size
         out_size = self.output_filename.stat().st_size
         logger.info('%s -> %s (ratio: %.2fx) (saved: %s)',
                     format_bytes(in_size), format_bytes(out_size),
-                    calc_ratio(in_size, out_size), format_bytes(in_size - out_size))
+                    calc_ratio(in_size, out_size), format_bytes(in_size - out_size),
+                    extra={'event': {'event': 'encoded', 'path': self.input_filename,
+                                     'input_size': in_size, 'output_size': out_size}})
+        FILES_ENCODED.inc()
+        BYTES_IN.inc(in_size)
+        BYTES_OUT.inc(out_size)
+        BYTES_SAVED.inc(max(0, in_size - out_size))
+
+        if prediction := self.job.prediction:
+            logger.info('Predicted ratio: %.2fx (%s)', prediction.ratio,
+                        f'{prediction.samples} similar files' if prediction.is_from_history else 'estimated')
+        if self.app.predictor is not None:
+            self.app.predictor.record(file_metadata, self.job.errors, in_size, out_size, prediction)
         return in_size, out_size
 
-    def __generate_ffmpeg_cmd(self, file_metadata):
-        if self.app.args.is_reencode_forced:
-            errors = FileCheckError.ALL
-            logger.log(DESTRUCTIVE, 'Forcing reencode')
-        else:
-            errors = check_file(file_metadata)
-        cmd = generate_ffmpeg_command(self.input_filename,
+    def __generate_ffmpeg_cmd(self,
+                              file_metadata,
+                              backend: Optional[EncoderBackend],
+                              tuning: Optional[Tuning] = None):
+        errors = self.job.errors
+        cmd = generate_ffmpeg_command(self._source,
                                       self.output_filename,
                                       file_metadata,
-                                      errors)
+                                      errors,
+                                      threads=self.threads,
+                                      progress_url='pipe:1',
+                                      backend=backend,
+                                      tuning=tuning)
         return cmd, errors
 
-    def _cleanup(self, in_size: int, out_size: int):
+    def __reset_progress(self):
+        if self._progress:
+            self._progress.close()
+        self._progress = None
+        self._next_log = 0
+
+    def __is_split(self, file_metadata, backend: Optional[EncoderBackend]) -> bool:
+        """Whether the file is long enough to be encoded as parallel segments"""
+        return (self.app.args.is_split_enabled
+                and self.job.lane == Lane.VIDEO
+                and (backend is None or backend.hwaccel is None)
+                and file_metadata.duration >= SPLIT_MIN_DURATION)
+
+    def __run_ffmpeg(self, file_metadata, backend: Optional[EncoderBackend], tuning: Optional[Tuning]) -> int:
+        cmd, _ = self.__generate_ffmpeg_cmd(file_metadata, backend, tuning)
+        logger.debug(cmd)
+
+        with Popen(cmd, stdout=PIPE, stderr=PIPE) as ffmpeg:
+            self._ffmpeg = ffmpeg
+            self.__child_process_mainloop(ffmpeg)
+            ffmpeg.wait()
+        return ffmpeg.returncode
+
+    def __handle_split_progress(self, update: ProgressUpdate):
+        self.__handle_progress(update)
+        if self.app.is_interrupted:
+            logger.info("Sending termination signal to ffmpeg subprocesses")
+            self._ffmpeg.terminate()
+
+    def __run_split_encode(self, file_metadata, backend: Optional[EncoderBackend], tuning: Optional[Tuning]) -> int:
+        split_encoder = SplitEncoder(self._source,
+                                     self.output_filename,
+                                     file_metadata,
+                                     self.job.errors,
+                                     backend=backend,
+                                     tuning=tuning,
+                                     threads=self.threads,
+                                     on_progress=self.__handle_split_progress,
+                                     ffmpeg_log=self._ffmpeg_log,
+                                     work_root=self.app.staging.work_dir if self.app.staging is not None else None)
+        logger.info('Encoding %d segments at once', split_encoder.workers)
+        self._ffmpeg = split_encoder
+        return split_encoder.run()
+
+    def __tune(self, file_metadata, backend: Optional[EncoderBackend]) -> Optional[Tuning]:
+        """Preset and quality found by sample encodes of the input, None keeps the bitrate target"""
+        if self.app.tuner is None or self.job.lane != Lane.VIDEO:
+            return None
+        with STAGE_SECONDS.labels('tune').time():
+            return self.app.tuner.tune(self._source, file_metadata, self.job.errors,
+                                       backend or configured_backend(), self.threads,
+                                       should_stop=lambda: self.is_cancelled or self.app.is_interrupted)
+
+    def __encode(self, file_metadata) -> bool:
+        """Run ffmpeg, retrying with the next encoder backend on failure"""
+        encoders = self.app.encoders
+        backend = encoders.current if encoders else None
+        failed_backends = []
+        while not self.is_cancelled:
+            run_encode = self.__run_split_encode if self.__is_split(file_metadata, backend) else self.__run_ffmpeg
+            tuning = self.__tune(file_metadata, backend)
+            if self.is_cancelled:
+                break
+            with STAGE_SECONDS.labels('encode').time():
+                returncode = run_encode(file_metadata, backend, tuning)
+            ENCODE_SPEED.labels(self.slot).set(0)
+            self.__flush_ffmpeg_log(returncode)
+
+            if self.is_cancelled:
+                break
+
+            if self._projected_size:
+                self.__handle_early_abort()
+                return False
+
+            if returncode == 0:
+                # The file itself is fine, the backends that failed on it are broken
+                for failed_backend in failed_backends:
+                    encoders.disable(failed_backend)
+                return True
+
+            fallback = encoders.fallback(backend) if encoders and not self.app.is_interrupted else None
+            if fallback is None:
+                self.__handle_child_process_error(returncode)
+                return False
+
+            logger.warning('Encoding with %s backend failed (return code %d), retrying with %s backend',
+                           backend.name, returncode, fallback.name)
+            failed_backends.append(backend)
+            backend = fallback
+            self.__reset_progress()
+
+        self.__handle_cancel()
+        return False
+
+    def _cleanup(self, in_size: int, out_size: int) -> JobState:
         if self._progress:
             self._progress.close()
 
         if out_size > in_size:
             logger.log(SKIP, 'Output file is larger than input file, cleaning output...')
+            self.__record_outcome(Outcome.LARGER, f'{out_size} bytes')
             if not self.app.args.is_dry_run_enabled:
                 self.output_filename.unlink()
-        elif self.app.args.is_replace_enabled:
+            return JobState.DONE
+
+        if self.app.outcome_cache is not None:
+            self.app.outcome_cache.discard(self.input_filename)
+
+        if self.__is_lease_lost():
+            logger.error('Lease of "%s" was reclaimed by another node, keeping both files', self.input_filename)
+            return JobState.FAILED
+
+        if self.app.args.is_replace_enabled:
             logger.log(DESTRUCTIVE, 'Replacing "%s"', self.input_filename)
             if not self.app.args.is_dry_run_enabled:
-                self.__replace_output_file()
+                return JobState.REPLACED if self.__replace_output_file() else JobState.FAILED
         elif self.app.args.is_remove_enabled:
             logger.log(DESTRUCTIVE, 'Removing "%s"', self.input_filename)
             # Remove the original file
             if not self.app.args.is_dry_run_enabled:
                 self.input_filename.unlink()
+                return JobState.REPLACED
+        return JobState.DONE
+
+    def __is_lease_lost(self) -> bool:
+        return self.app.leases is not None and not self.app.leases.is_held(self.input_filename)
+
+    def __refresh_probe(self):
+        """Probe the input again if another node processed it since it was probed"""
+        if self.job.metadata is None:
+            return
+        try:
+            file_size = self.input_filename.stat().st_size
+        except FileNotFoundError:
+            file_size = None
+        if file_size != self.job.metadata.file_size:
+            logger.info('Input file changed since it was probed')
+            self.job.metadata = None
+            self.job.errors = FileCheckError.NONE
+            self.job.skip_reason = None
+            self.job.prediction = None
+            self.job.is_probed = False
 
     def work(self):
-        logger.log(PROGRESS, '[%d/%d] Processing "%s"', self.i, len(self.app.files), self.input_filename)
+        logger.log(PROGRESS, '[%d/%d] Processing "%s"', self.job.index, len(self.app.files), self.input_filename)
+        try:
+            self.__work()
+        finally:
+            if self.app.staging is not None:
+                # The input may have been prefetched for nothing if the job was skipped
+                self.app.staging.discard(self.input_filename)
+
+    def __work(self):
+        if self.app.leases is None or self.job.is_skipped:
+            self.__process()
+            return
 
-        file_metadata = probe_file(self.input_filename)
-        if file_metadata is None:
-            logger.log(SKIP, 'Skipping')
+        if not self.app.leases.acquire(self.input_filename):
+            logger.log(SKIP, 'Leased by %s, skipping', self.app.leases.owner_of(self.input_filename) or 'another node')
+            FILES_SKIPPED.inc()
+            self.__transition(JobState.SKIPPED)
             return
+        try:
+            self.__refresh_probe()
+            self.__process()
+        finally:
+            self.app.leases.release(self.input_filename)
+
+    def __process(self):
+        if not self.job.is_probed:
+            prepare_job(self.app, self.job)
+
+        if self.job.is_skipped:
+            logger.log(SKIP, self.job.skip_reason,
+                       extra={'event': {'event': 'skipped', 'path': self.input_filename,
+                                        'reason': self.job.skip_reason}})
+            FILES_SKIPPED.inc()
+            self.__transition(JobState.SKIPPED)
+            return
+        file_metadata = self.job.metadata
 
         if self.output_filename.exists() and self.app.args.is_overwrite_enabled:
             logger.log(DESTRUCTIVE, 'Overwriting "%s"', self.output_filename)
         elif self.output_filename.exists() and self.app.args.is_replace_enabled:
             logger.log(DESTRUCTIVE, 'Output file "%s" already exists, replacing', self.output_filename)
-            self.__replace_output_file()
+            self.__transition(JobState.REPLACED if self.__replace_output_file() else JobState.FAILED)
             return
         elif not (parent := self.output_filename.parent).exists():
             makedirs(parent)
 
-        cmd, errors = self.__generate_ffmpeg_cmd(file_metadata)
-        if not errors:
-            logger.log(SKIP, 'Video matches expectations, skipping')
-            return
+        if self.app.args.is_reencode_forced:
+            logger.log(DESTRUCTIVE, 'Forcing reencode')
 
         logger.debug(file_metadata)
-        logger.info(errors)
-        logger.debug(cmd)
+        logger.info(self.job.errors)
+
+        if self.app.args.is_dry_run_enabled:
+            backend = self.app.encoders.current if self.app.encoders else None
+            logger.debug(self.__generate_ffmpeg_cmd(file_metadata, backend)[0])
+            self.__transition(JobState.DONE)
+        else:
+            self.__transition(JobState.ENCODING)
+            if self.__reuse_duplicate_output():
+                in_size, out_size = file_metadata.file_size, self.output_filename.stat().st_size
+            else:
+                staged = self.app.staging.acquire(self.job, lambda: self.is_cancelled or self.app.is_interrupted) \
+                    if self.app.staging is not None else None
+                try:
+                    if not self.__encode_and_verify(file_metadata, staged):
+                        return
+                finally:
+                    if staged is not None:
+                        self.app.staging.release(staged)
+                in_size, out_size = self.__log_result_stats(file_metadata)
+            if self.app.dedup is not None:
+                # Inputs about to be removed are fully hashed while they still exist
+                self.app.dedup.fingerprint(self.input_filename, is_digest_needed=self.app.args.is_replace_enabled
+                                           or self.app.args.is_remove_enabled)
+            state = self._cleanup(in_size, out_size)
+            self.__transition(state)
+            self.__record_dedup_output(state)
+
+    def __reuse_duplicate_output(self) -> bool:
+        """Copy the output of a previous encode of the same content instead of encoding it again"""
+        if self.app.dedup is None or (encoded := self.app.dedup.find_encoded(self.input_filename)) is None:
+            return False
+        try:
+            with STAGE_SECONDS.labels('dedup').time():
+                method = reuse_file(encoded, self.output_filename)
+        except OSError as e:
+            logger.warning('Failed to reuse "%s", encoding: %s', encoded, e)
+            return False
+        logger.info('Same content as an encoded file, reusing its output "%s" (%s)', encoded, method,
+                    extra={'event': {'event': 'deduplicated', 'path': self.input_filename, 'source': encoded}})
+        return True
 
-        if not self.app.args.is_dry_run_enabled:
-            with Popen(cmd, stdout=PIPE, stderr=STDOUT, universal_newlines=True) as ffmpeg:
-                self.__child_process_mainloop(ffmpeg)
-                if ffmpeg.wait() != 0:
-                    self.__handle_child_process_error(ffmpeg)
-                    return
-            in_size, out_size = self.__log_result_stats(file_metadata)
-            self._cleanup(in_size, out_size)
+    def __record_dedup_output(self, state: JobState):
+        if self.app.dedup is None or state not in (JobState.DONE, JobState.REPLACED):
+            return
+        output = self.output_filename
+        if state == JobState.REPLACED and self.app.args.is_replace_enabled:
+            output = self.input_filename.with_suffix(self.output_filename.suffix)
+        # Outputs larger than their input were removed by the cleanup
+        if output.exists():
+            self.app.dedup.record(self.input_filename, output)
+
+    def __encode_and_verify(self, file_metadata, staged: Optional[StagedFiles]) -> bool:
+        """Encode and verify the output, staged outputs are moved onto the output path once verified"""
+        if staged is not None:
+            self._source, self.output_filename = staged.input, staged.output
+        try:
+            if not self.__encode(file_metadata):
+                return False
+            self.__transition(JobState.VERIFYING)
+            if not self.__verify_output():
+                self.__reset_progress()
+                logger.log(ROLLBACK, 'Removing corrupt output')
+                self.output_filename.unlink(missing_ok=True)
+                self.__transition(JobState.FAILED)
+                return False
+        finally:
+            self._source, self.output_filename = self.input_filename, self.job.output_filename
+
+        if staged is not None and staged.is_output_staged:
+            try:
+                with STAGE_SECONDS.labels('finalize').time():
+                    self.app.staging.finalize(staged, self.output_filename)
+            except OSError as e:
+                logger.error('Failed to copy the output to "%s": %s', self.output_filename, e)
+                self.__transition(JobState.FAILED)
+                return False
+        return True
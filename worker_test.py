@@ -1,6 +1,20 @@
-from unittest import TestCase
-
-from worker import format_bytes, format_float
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+from unittest.mock import MagicMock
+
+from app import App
+from app_test import make_args
+from bench.clips import write_clip
+from bench.harness import fake_binaries
+from filechecker import FileCheckError
+from ffmpeg_progress import ProgressUpdate
+from fileparser import FileMetadata, AudioMetadata, VideoMetadata
+from job import Job
+from journal import JobState
+from lease import LeaseManager
+from outcome_cache import Outcome, OutcomeCache
+from worker import Worker, SIGCONT, SIGSTOP, format_bytes, format_float
 
 
 class TestFormatFloat(TestCase):
@@ -48,3 +62,191 @@ class TestFormatBytes(TestCase):
 
     def test_negative_values(self):
         self.assertEqual(format_bytes(-1024), f"{format_float(-1)} KiB")
+
+
+class TestEarlyAbort(TestCase):
+    """Test case for the projected output size check"""
+
+    def setUp(self):
+        metadata = FileMetadata(Path("input.mp4"), 10 * 1024 ** 2, 100.0,
+                                AudioMetadata("aac", 48_000, 2, 192_000, {}),
+                                VideoMetadata("h264", 1920, 1080, "16:9", 30.0, 800_000, {}),
+                                {})
+        job = Job(1, Path("input.mp4"), Path("output.mp4"), metadata, FileCheckError.VIDEO_CODEC, True)
+        self.worker = Worker(MagicMock(), job)
+        self.worker._ffmpeg = MagicMock()
+        self.handle_progress = self.worker._Worker__handle_progress
+
+    def tearDown(self):
+        if self.worker._progress:
+            self.worker._progress.close()
+
+    def test_output_on_track_is_not_aborted(self):
+        self.handle_progress(ProgressUpdate(30.0, 2048 * 1024, 5.0, 150.0, False))
+        self.worker._ffmpeg.terminate.assert_not_called()
+
+    def test_output_too_large_is_aborted(self):
+        self.handle_progress(ProgressUpdate(12.0, 1536 * 1024, 5.0, 150.0, False))
+        self.worker._ffmpeg.terminate.assert_called_once()
+        self.assertEqual(self.worker._projected_size, 1536 * 1024 * 100 // 12)
+
+    def test_progress_bar_is_closed_on_abort(self):
+        self.handle_progress(ProgressUpdate(12.0, 1536 * 1024, 5.0, 150.0, False))
+        progress = self.worker._progress
+        self.worker._Worker__handle_early_abort()
+        self.assertIsNone(self.worker._progress)
+        self.assertTrue(progress.disable)
+
+    def test_output_too_large_is_not_aborted_too_early(self):
+        self.handle_progress(ProgressUpdate(5.0, 1024 * 1024, 5.0, 150.0, False))
+        self.worker._ffmpeg.terminate.assert_not_called()
+
+    def test_progress_is_exposed_on_job(self):
+        update = ProgressUpdate(30.0, 2048 * 1024, 5.0, 150.0, False)
+        self.handle_progress(update)
+        self.assertIs(self.worker.job.progress, update)
+        self.assertEqual(self.worker._progress.n, 30.0)
+
+
+@skipIf(SIGSTOP is None, 'job control signals are not available')
+class TestJobControl(TestCase):
+    """Test case for the control of a running encode"""
+
+    def setUp(self):
+        job = Job(1, Path("input.mp4"), Path("output.mp4"))
+        self.worker = Worker(MagicMock(), job)
+        self.ffmpeg = MagicMock()
+
+    def test_pause_requires_running_encode(self):
+        self.assertFalse(self.worker.pause())
+        self.assertFalse(self.worker.resume())
+
+    def test_pause_and_resume(self):
+        self.worker._ffmpeg = self.ffmpeg
+        self.assertTrue(self.worker.pause())
+        self.ffmpeg.send_signal.assert_called_with(SIGSTOP)
+        self.assertTrue(self.worker.resume())
+        self.ffmpeg.send_signal.assert_called_with(SIGCONT)
+        self.assertFalse(self.worker.is_paused)
+
+    def test_cancel_paused_encode(self):
+        self.worker._ffmpeg = self.ffmpeg
+        self.worker.pause()
+        self.worker.cancel()
+        self.ffmpeg.terminate.assert_called_once()
+        self.ffmpeg.send_signal.assert_called_with(SIGCONT)
+        self.assertTrue(self.worker.is_cancelled)
+        self.assertFalse(self.worker.pause())
+
+
+class TestOutcome(TestCase):
+    """Test case for the outcomes recorded after an encode"""
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        root = Path(self.tmp_dir.name)
+        self.input_file, output_file = root / "input.mp4", root / "output.mp4"
+        self.input_file.write_bytes(b'\0' * 10)
+        output_file.write_bytes(b'\0' * 20)
+
+        metadata = FileMetadata(self.input_file, 10, 100.0,
+                                AudioMetadata("aac", 48_000, 2, 192_000, {}),
+                                VideoMetadata("h264", 1920, 1080, "16:9", 30.0, 800_000, {}),
+                                {})
+        app = MagicMock()
+        app.args.is_dry_run_enabled = False
+        app.journal = None
+        app.outcome_cache = self.outcome_cache = OutcomeCache(root / "outcomes.sqlite")
+        job = Job(1, self.input_file, output_file, metadata, FileCheckError.VIDEO_CODEC, True)
+        self.worker = Worker(app, job)
+
+    def tearDown(self):
+        self.outcome_cache.close()
+        self.tmp_dir.cleanup()
+
+    def test_larger_output_is_recorded(self):
+        self.worker._cleanup(10, 20)
+        self.assertEqual(self.outcome_cache.get(self.input_file).outcome, Outcome.LARGER)
+
+
+class TestLease(TestCase):
+    """Test case for the coordination of nodes sharing a library"""
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        root = Path(self.tmp_dir.name)
+        self.input_file, self.output_file = root / "input.mp4", root / "output.mp4"
+        self.input_file.write_bytes(b'\0' * 20)
+        self.output_file.write_bytes(b'\0' * 10)
+
+        metadata = FileMetadata(self.input_file, 20, 100.0,
+                                AudioMetadata("aac", 48_000, 2, 192_000, {}),
+                                VideoMetadata("h264", 1920, 1080, "16:9", 30.0, 800_000, {}),
+                                {})
+        self.app = MagicMock()
+        self.app.args.is_dry_run_enabled = False
+        self.app.args.is_replace_enabled = True
+        self.app.journal = None
+        self.app.outcome_cache = None
+        self.app.leases = self.leases = LeaseManager(root / "leases", owner="node-a")
+        self.other_node = LeaseManager(root / "leases", owner="node-b")
+        job = Job(1, self.input_file, self.output_file, metadata, FileCheckError.VIDEO_CODEC, True)
+        self.worker = Worker(self.app, job)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_file_leased_by_another_node_is_skipped(self):
+        self.assertTrue(self.other_node.acquire(self.input_file))
+        with self.assertLogs('reencode_job.worker') as logs:
+            self.worker.work()
+        self.assertIn('Leased by node-b, skipping', logs.output[-1])
+        self.assertTrue(self.output_file.exists())
+
+    def test_lost_lease_keeps_both_files(self):
+        self.assertTrue(self.leases.acquire(self.input_file))
+        self.leases.path(self.input_file).unlink()
+        self.assertTrue(self.other_node.acquire(self.input_file))
+
+        with self.assertLogs('reencode_job.worker', 'ERROR'):
+            self.assertEqual(self.worker._cleanup(20, 10), JobState.FAILED)
+        self.assertTrue(self.input_file.exists())
+        self.assertTrue(self.output_file.exists())
+
+
+class TestFFmpegLog(TestCase):
+    """Test case for the ffmpeg output kept during an encode"""
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        root = Path(self.tmp_dir.name)
+        self.input_file, self.output_file = root / "input.mkv", root / "output.mp4"
+        self.metadata = FileMetadata(self.input_file, 10 * 1024 ** 2, 60.0,
+                                     AudioMetadata("aac", 48_000, 2, 192_000, {}),
+                                     VideoMetadata("h264", 1920, 1080, "16:9", 30.0, 800_000, {}),
+                                     {})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def work(self, verbose: bool = False):
+        app = App(make_args(self.input_file.parent, verbose=verbose))
+        app.encoders = None
+        job = Job(1, self.input_file, self.output_file, self.metadata, FileCheckError.VIDEO_CODEC, True)
+        with fake_binaries(), self.assertLogs('reencode_job.worker', 'DEBUG') as logs:
+            Worker(app, job).work()
+        return [record.getMessage() for record in logs.records if record.getMessage().startswith('[FFMPEG]')]
+
+    def test_output_is_logged_on_failure(self):
+        self.input_file.write_bytes(b'not a clip')
+        output, = self.work()
+        self.assertIn('Invalid data found when processing input', output)
+
+    def test_output_is_only_logged_in_verbose_mode(self):
+        write_clip(self.input_file, {'video_codec': 'h264', 'width': 1920, 'height': 1080, 'fps': 30,
+                                     'video_bitrate': 800_000, 'audio_codec': 'aac', 'sample_rate': 48_000,
+                                     'channels': 2, 'audio_bitrate': 192_000, 'duration': 60.0,
+                                     'size': 10 * 1024 ** 2})
+        self.assertEqual(self.work(), [])
+        output, = self.work(verbose=True)
+        self.assertEqual(output.splitlines()[1:], [f'frame={180 * step}' for step in range(1, 11)])